@@ -49,10 +49,17 @@ _pre_locals = locals().copy()
 # サブスクリプト群をインポート
 if True:
     from . import compat
+    from . import codec
     from . import common
     from . import cm3d2_data
+    from . import bone_data_property
 
+    from . import model_format
+    from . import model_cache
+    from . import profiling
+    from . import export_cache
     from . import model_import
+    from . import mesh_data
     from . import model_export
 
     from . import anm_import
@@ -127,12 +134,21 @@ class AddonPreferences(bpy.types.AddonPreferences):
 
     cm3d2_path = bpy.props.StringProperty(name="CM3D2インストールフォルダ", subtype='DIR_PATH', description="変更している場合は設定しておくと役立つかもしれません")
     backup_ext = bpy.props.StringProperty(name="バックアップの拡張子 (空欄で無効)", description="エクスポート時にバックアップを作成時この拡張子で複製します、空欄でバックアップを無効", default='bak')
+    write_buffer_size = bpy.props.IntProperty(name="Write Buffer Size (KB)", default=1024, min=8, soft_max=65536, description="Exported files are written to disk in blocks of this size. Larger blocks help on slow or network drives")
+    is_write_behind = bpy.props.BoolProperty(name="Write Files in Background", default=False, description="Write each block to disk on a background thread while the export continues")
 
     scale = bpy.props.FloatProperty(name="倍率", description="Blenderでモデルを扱うときの拡大率", default=5, min=0.01, max=100, soft_min=0.01, soft_max=100, step=10, precision=2)
     is_convert_bone_weight_names = bpy.props.BoolProperty(name="基本的にボーン名/ウェイト名をBlender用に変換", default=False, description="modelインポート時にボーン名/ウェイト名を変換するかどうかのオプションのデフォルトを設定します")
     model_default_path = bpy.props.StringProperty(name="modelファイル置き場", subtype='DIR_PATH', description="設定すれば、modelを扱う時は必ずここからファイル選択を始めます")
     model_import_path = bpy.props.StringProperty(name="modelインポート時のデフォルトパス", subtype='FILE_PATH', description="modelインポート時に最初はここが表示されます、インポート毎に保存されます")
     model_export_path = bpy.props.StringProperty(name="modelエクスポート時のデフォルトパス", subtype='FILE_PATH', description="modelエクスポート時に最初はここが表示されます、エクスポート毎に保存されます")
+    is_compact_bone_data = bpy.props.BoolProperty(name="Compact Bone Data Properties", default=False, description="Store BoneData / LocalBoneData custom properties as one set of arrays per object instead of one string per bone. Existing string properties can be converted from the bone data panel and are read as they are when exported")
+    is_model_cache = bpy.props.BoolProperty(name="Cache Imported Models", default=False, description="Keep parsed .model data on disk so re-importing an unchanged file skips parsing")
+    model_cache_path = bpy.props.StringProperty(name="Model Cache Folder", subtype='DIR_PATH', description="Where parsed .model data is cached. Uses the system temporary folder if empty")
+    is_profile_io = bpy.props.BoolProperty(name="Report Stage Timings", default=False, description="Print the time spent in each stage of .model import and export to the console")
+    is_profile_memory = bpy.props.BoolProperty(name="Trace Memory", default=False, description="Also record the peak Python memory of each stage with tracemalloc. This slows down import and export")
+    profile_log_path = bpy.props.StringProperty(name="Timing Log File", subtype='FILE_PATH', description="If set, each import and export appends its stage timings to this file as one line of JSON")
+    model_cache_size = bpy.props.IntProperty(name="Model Cache Size (MB)", default=512, min=1, soft_max=8192, description="Least recently used cache entries are removed when the cache grows beyond this size")
 
     anm_default_path = bpy.props.StringProperty(name="anmファイル置き場", subtype='DIR_PATH', description="設定すれば、anmを扱う時は必ずここからファイル選択を始めます")
     anm_import_path = bpy.props.StringProperty(name="anmインポート時のデフォルトパス", subtype='FILE_PATH', description="anmインポート時に最初はここが表示されます、インポート毎に保存されます")
@@ -246,6 +262,9 @@ class AddonPreferences(bpy.types.AddonPreferences):
 
         self.layout.prop(self, 'cm3d2_path', icon_value=common.kiss_icon())
         self.layout.prop(self, 'backup_ext', icon='FILE_BACKUP')
+        row = self.layout.row()
+        row.prop(self, 'write_buffer_size', icon='DISK_DRIVE')
+        row.prop(self, 'is_write_behind', icon='SORTTIME')
 
         box = self.layout.box()
         box.label(text="modelファイル", icon='MESH_ICOSPHERE')
@@ -254,6 +273,23 @@ class AddonPreferences(bpy.types.AddonPreferences):
         row.prop(self, 'is_convert_bone_weight_names', icon='BLENDER')
         brws_icon = compat.icon('FILEBROWSER')
         box.prop(self, 'model_default_path', icon=brws_icon, text="ファイル選択時の初期フォルダ")
+        box.prop(self, 'is_compact_bone_data', icon='CONSTRAINT_BONE')
+        row = box.row()
+        row.prop(self, 'is_model_cache', icon=compat.icon('FILE_CACHE'))
+        sub_row = row.row()
+        sub_row.enabled = self.is_model_cache
+        sub_row.prop(self, 'model_cache_size')
+        sub_row = box.row()
+        sub_row.enabled = self.is_model_cache
+        sub_row.prop(self, 'model_cache_path', icon=brws_icon)
+        row = box.row()
+        row.prop(self, 'is_profile_io', icon='TIME')
+        sub_row = row.row()
+        sub_row.enabled = self.is_profile_io
+        sub_row.prop(self, 'is_profile_memory', icon='MEMORY')
+        sub_row = box.row()
+        sub_row.enabled = self.is_profile_io
+        sub_row.prop(self, 'profile_log_path', icon=brws_icon)
 
         box = self.layout.box()
         box.label(text="anmファイル", icon='POSE_HLT')
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import re
-import struct
 import math
 import unicodedata
 import time
@@ -11,8 +10,10 @@ import mathutils
 import numpy as np
 from mathutils import Vector, Quaternion, Matrix
 from pathlib import Path
+from . import codec
 from . import common
 from . import compat
+from . import bone_data_property
 from . translations.pgettext_functions import *
 from . fileutil import serialize_to_file
 from . import misc_DOPESHEET_MT_editor_menus
@@ -97,7 +98,7 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
         self.is_backup = bool(prefs.backup_ext)
         self.key_frame_count = -1
 
-        if "BoneData:0" in arm:
+        if bone_data_property.has_bone_data(arm):
             self.bone_parent_from = 'ARMATURE_PROPERTY'
         else:
             self.bone_parent_from = 'ARMATURE'
@@ -213,27 +214,7 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
         fps = context.scene.render.fps
 
 
-        bone_parents = {}
-        if self.bone_parent_from == 'ARMATURE_PROPERTY':
-            for i in range(9999):
-                name = "BoneData:" + str(i)
-                if name not in arm:
-                    continue
-                elems = arm[name].split(",")
-                if len(elems) != 5:
-                    continue
-                if elems[0] in arm.bones:
-                    if elems[2] in arm.bones:
-                        bone_parents[elems[0]] = arm.bones[elems[2]]
-                    else:
-                        bone_parents[elems[0]] = None
-            for bone in arm.bones:
-                if bone.name in bone_parents:
-                    continue
-                bone_parents[bone.name] = bone.parent
-        else:
-            for bone in arm.bones:
-                bone_parents[bone.name] = bone.parent
+        bone_parents = AnmBuilder.get_bone_parents(arm, self.bone_parent_from == 'ARMATURE_PROPERTY')
 
         copied_action = None
         if ob.animation_data and ob.animation_data.action:
@@ -354,14 +335,15 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
 
         ''' Write data to the file '''
 
-        common.write_str(file, 'CM3D2_ANIM')
-        file.write(struct.pack('<i', self.version))
+        binary = codec.BinaryWriter(file)
+        binary.write_str('CM3D2_ANIM')
+        binary.write_int32(self.version)
 
         for bone in bones:
             if not anm_data.get(bone.name):
                 continue
 
-            file.write(struct.pack('<?', True))
+            binary.write_bool(True)
 
             bone_names = [bone.name]
             current_bone = bone
@@ -370,11 +352,11 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
                 current_bone = bone_parents[current_bone.name]
 
             bone_names.reverse()
-            common.write_str(file, "/".join(bone_names))
+            binary.write_str("/".join(bone_names))
             
             for channel_id, keyframes in sorted(anm_data[bone.name].items(), key=lambda x: x[0]):
-                file.write(struct.pack('<B', channel_id))
-                file.write(struct.pack('<i', len(keyframes)))
+                binary.write_uint8(channel_id)
+                binary.write_int32(len(keyframes))
 
                 keyframes_list = sorted(keyframes.items(), key=lambda x: x[0])
                 for i in range(len(keyframes_list)):
@@ -382,13 +364,13 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
                     y, dydx_in, dydx_out = keyframes_list[i][1]
 
                     if len(keyframes_list) <= 1:
-                        file.write(struct.pack('<f', x))
-                        file.write(struct.pack('<f', y))
-                        file.write(struct.pack('<2f', 0.0, 0.0))
+                        binary.write_float(x)
+                        binary.write_float(y)
+                        binary.pack(codec.VEC2, 0.0, 0.0)
                         continue
 
-                    file.write(struct.pack('<f', x))
-                    file.write(struct.pack('<f', y))
+                    binary.write_float(x)
+                    binary.write_float(y)
 
                     if self.is_smooth_handle and self.export_method == 'ALL':
                         if i == 0:
@@ -414,13 +396,13 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
                         tan_in  = join_rad if x - prev_x <= time_step * 1.5 else prev_rad
                         tan_out = join_rad if next_x - x <= time_step * 1.5 else next_rad
                         
-                        file.write(struct.pack('<2f', tan_in, tan_out))
-                        #file.write(struct.pack('<2f', join_rad, join_rad))
-                        #file.write(struct.pack('<2f', prev_rad, next_rad))
+                        binary.pack(codec.VEC2, tan_in, tan_out)
+                        #binary.pack(codec.VEC2, join_rad, join_rad)
+                        #binary.pack(codec.VEC2, prev_rad, next_rad)
                     else:
-                        file.write(struct.pack('<2f', dydx_in, dydx_out))
+                        binary.pack(codec.VEC2, dydx_in, dydx_out)
 
-        file.write(struct.pack('<?', False))
+        binary.write_bool(False)
 
     def write_animation_from_text(self, context, file):
         txt = context.blend_data.texts.get("AnmData")
@@ -430,25 +412,26 @@ class CNV_OT_export_cm3d2_anm(bpy.types.Operator):
         import json
         anm_data = json.loads(txt.as_string())
 
-        common.write_str(file, 'CM3D2_ANIM')
-        file.write(struct.pack('<i', self.version))
+        binary = codec.BinaryWriter(file)
+        binary.write_str('CM3D2_ANIM')
+        binary.write_int32(self.version)
 
         for base_bone_name, bone_data in anm_data.items():
             path = bone_data['path']
-            file.write(struct.pack('<?', True))
-            common.write_str(file, path)
+            binary.write_bool(True)
+            binary.write_str(path)
 
             for channel_id, channel in bone_data['channels'].items():
-                file.write(struct.pack('<B', int(channel_id)))
+                binary.write_uint8(int(channel_id))
                 channel_data_count = len(channel)
-                file.write(struct.pack('<i', channel_data_count))
+                binary.write_int32(channel_data_count)
                 for channel_data in channel:
                     frame = channel_data['frame']
                     data = ( channel_data['f0'], channel_data['f1'], channel_data['f2'] )
-                    file.write(struct.pack('<f' , frame))
-                    file.write(struct.pack('<3f', *data ))
+                    binary.write_float(frame)
+                    binary.pack(codec.VEC3, *data)
 
-        file.write(struct.pack('<?', False))
+        binary.write_bool(False)
 
     def get_anm_builder(self) -> AnmBuilder:
         builder = AnmBuilder(reporter=self)
@@ -907,18 +890,14 @@ class AnmBuilder:
     def get_bone_parents(arm: bpy.types.Armature, use_armature_property = False) -> dict[str, bpy.types.Bone]:
         bone_parents: dict[str, bpy.types.Bone] = {}
         if use_armature_property:
-            for i in range(9999):
-                name = "BoneData:" + str(i)
-                if name not in arm:
-                    continue
-                elems = arm[name].split(",")
-                if len(elems) != 5:
-                    continue
-                if elems[0] in arm.bones:
-                    if elems[2] in arm.bones:
-                        bone_parents[elems[0]] = arm.bones[elems[2]]
+            bone_data = bone_data_property.read_bone_data(arm)
+            for data in bone_data:
+                if data['name'] in arm.bones:
+                    parent_index = data['parent_index']
+                    if -1 < parent_index:
+                        bone_parents[data['name']] = arm.bones.get(bone_data[parent_index]['name'])
                     else:
-                        bone_parents[elems[0]] = None
+                        bone_parents[data['name']] = None
             for bone in arm.bones:
                 if bone.name in bone_parents:
                     continue
@@ -1,12 +1,12 @@
 from __future__ import annotations
 import re
-import struct
 import math
 import io
 from typing import Literal
 import bpy
 import mathutils
 import os
+from . import codec
 from . import common
 from . import compat
 from . fileutil import deserialize_from_file
@@ -657,18 +657,19 @@ class AnmImporter:
         txt.write( json.dumps(anm_data, ensure_ascii=False, indent=2) )
 
     def read_anm_data_OLD(self, file):
-        ext = common.read_str(file)
+        binary = codec.BinaryReader(file)
+        ext = binary.read_str()
         if ext != 'CM3D2_ANIM':
             raise CM3D2ImportError("これはカスタムメイド3D2のモーションファイルではありません")
-        anm_version = struct.unpack('<i', file.read(4))[0]
-        first_channel_id = struct.unpack('<B', file.read(1))[0]
+        anm_version = binary.read_int32()
+        first_channel_id = binary.read_uint8()
         if first_channel_id != 1:
             raise CM3D2ImportError(f_tip_("Unexpected first channel id = {id} (should be 1).", id=first_channel_id))
 
         
         anm_data = {}
         for anim_data_index in range(9**9):
-            path = common.read_str(file)
+            path = binary.read_str()
             
             base_bone_name = path.split('/')[-1]
             if base_bone_name not in anm_data:
@@ -676,15 +677,15 @@ class AnmImporter:
                 anm_data[base_bone_name]['channels'] = {}
 
             for channel_index in range(9**9):
-                channel_id = struct.unpack('<B', file.read(1))[0]
+                channel_id = binary.read_uint8()
                 channel_id_str = channel_id
                 if channel_id <= 1:
                     break
                 anm_data[base_bone_name]['channels'][channel_id_str] = []
-                channel_data_count = struct.unpack('<i', file.read(4))[0]
+                channel_data_count = binary.read_int32()
                 for channel_data_index in range(channel_data_count):
-                    frame = struct.unpack('<f', file.read(4))[0]
-                    data = struct.unpack('<3f', file.read(4 * 3))
+                    frame = binary.read_float()
+                    data = binary.unpack(codec.VEC3)
 
                     anm_data[base_bone_name]['channels'][channel_id_str].append({'frame': frame, 'f0': data[0], 'f1': data[1], 'f2': data[2]})
 
@@ -0,0 +1,313 @@
+"""CM3D2用ボーン情報 (BoneData / LocalBoneData) のカスタムプロパティへの保存と読み込み
+
+従来形式はボーン1本ごとに "BoneData:0" のような文字列のプロパティを作るが、
+コンパクト形式ではオブジェクトごとに配列をまとめたプロパティグループを1つだけ作る。
+配列は float32 / int32 (リトルエンディアン) のバイト列で保存する (IDプロパティの配列は double になるため)。
+読み込みはどちらの形式にも対応している。
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+BONE_DATA_PREFIX = "BoneData:"
+LOCAL_BONE_DATA_PREFIX = "LocalBoneData:"
+BONE_DATA_KEY = "CM3D2 BoneData"
+LOCAL_BONE_DATA_KEY = "CM3D2 LocalBoneData"
+
+def indexed_keys(container, prefix: str) -> list[str]:
+    """prefix + 数値インデックス のキーを、インデックスの昇順に返す"""
+    keys = []
+    for key in container.keys():
+        if not key.startswith(prefix):
+            continue
+        index = key[len(prefix):]
+        if index.isdigit():
+            keys.append((int(index), key))
+    keys.sort()
+    return [key for index, key in keys]
+
+
+def indexed_data_generator(container, prefix: str = ''):
+    """コンテナ内の数値インデックスをキーに持つ要素を昇順に返すジェネレーター"""
+    for key in indexed_keys(container, prefix):
+        yield container[key]
+
+
+# 従来形式 (文字列)
+
+def format_bone_data(bone_data: list[dict], model_ver: int) -> list[str]:
+    """BoneData を1行1ボーンの文字列にする"""
+    lines = []
+    for data in bone_data:
+        s = ",".join([data['name'], str(data['scl']), ""])
+        parent_index = data['parent_index']
+        if -1 < parent_index:
+            s += bone_data[parent_index]['name'] + ","
+        else:
+            s += "None" + ","
+        s += " ".join([str(data['co'][0]), str(data['co'][1]), str(data['co'][2])]) + ","
+        s += " ".join([str(data['rot'][0]), str(data['rot'][1]), str(data['rot'][2]), str(data['rot'][3])])
+        if model_ver >= 2001:
+            if 'scale' in data:
+                s += ",1," + " ".join(map(str, data['scale']))
+            else:
+                s += ",0"
+        lines.append(s)
+    return lines
+
+
+def format_local_bone_data(local_bone_data: list[dict]) -> list[str]:
+    """LocalBoneData を1行1ボーンの文字列にする"""
+    lines = []
+    for data in local_bone_data:
+        matrix = data['matrix']
+        if len(matrix) == 16:
+            mat_list = list(matrix)
+        else:
+            mat_list = [f for row in matrix for f in row]
+        lines.append(data['name'] + "," + " ".join(map(str, mat_list)))
+    return lines
+
+
+def parse_bone_data(container) -> list[dict]:
+    """BoneData テキストをパースして辞書を要素とするリストを返す"""
+    bone_data = []
+    bone_name_indices = {}
+    for line in container:
+        data = line.split(',')
+        if len(data) < 5:
+            continue
+
+        parent_name = data[2]
+        if parent_name.isdigit():
+            parent_index = int(parent_name)
+        else:
+            parent_index = bone_name_indices.get(parent_name, -1)
+
+        bone_datum = {
+            'name': data[0],
+            'scl': int(data[1]),
+            'parent_index': parent_index,
+            'co': list(map(float, data[3].split())),
+            'rot': list(map(float, data[4].split())),
+        }
+        # scale info (for version 2001 or later)
+        if len(data) >= 7:
+            if data[5] == '1':
+                bone_scale = data[6]
+                bone_datum['scale'] = list(map(float, bone_scale.split()))
+        bone_data.append(bone_datum)
+        bone_name_indices[data[0]] = len(bone_name_indices)
+    return bone_data
+
+
+def parse_local_bone_data(container) -> list[dict]:
+    """LocalBoneData テキストをパースして辞書を要素とするリストを返す"""
+    local_bone_data = []
+    for line in container:
+        data = line.split(',')
+        if len(data) != 2:
+            continue
+        local_bone_data.append({
+            'name': data[0],
+            'matrix': list(map(float, data[1].split())),
+        })
+    return local_bone_data
+
+
+# コンパクト形式 (配列)
+
+def array_to_property(values, dtype) -> bytes:
+    """配列をカスタムプロパティに保存するバイト列にする"""
+    return np.ascontiguousarray(values, dtype=dtype).tobytes()
+
+
+def array_from_property(value, dtype) -> np.ndarray:
+    """array_to_property() の逆変換 (以前の数値リストで保存されたものも読める)"""
+    if isinstance(value, (bytes, bytearray)):
+        return np.frombuffer(value, dtype=dtype)
+    return np.asarray(value, dtype=dtype)
+
+
+def pack_bone_data(bone_data: list[dict]) -> dict:
+    """BoneData をカスタムプロパティ用の配列の辞書にする"""
+    packed = {
+        'names'       : "\n".join(data['name'] for data in bone_data),
+        'scl'         : array_to_property([int(data['scl']) for data in bone_data], '<i4'),
+        'parent_index': array_to_property([int(data['parent_index']) for data in bone_data], '<i4'),
+        'co'          : array_to_property([data['co'][:] for data in bone_data], '<f4'),
+        'rot'         : array_to_property([data['rot'][:] for data in bone_data], '<f4'),
+    }
+    has_scale = [int('scale' in data) for data in bone_data]
+    if any(has_scale):
+        packed['has_scale'] = array_to_property(has_scale, '<i4')
+        scales = [data.get('scale', (1.0, 1.0, 1.0))[:] for data in bone_data]
+        packed['scale'] = array_to_property(scales, '<f4')
+    return packed
+
+
+def unpack_bone_data(packed) -> list[dict]:
+    """pack_bone_data() の逆変換"""
+    names = packed['names'].split("\n")
+    count = len(names)
+    scl = array_from_property(packed['scl'], '<i4').tolist()
+    parent_index = array_from_property(packed['parent_index'], '<i4').tolist()
+    co = array_from_property(packed['co'], '<f4').reshape((count, 3)).tolist()
+    rot = array_from_property(packed['rot'], '<f4').reshape((count, 4)).tolist()
+    has_scale = (array_from_property(packed['has_scale'], '<i4') != 0).tolist() if 'has_scale' in packed else [False] * count
+    scale = array_from_property(packed['scale'], '<f4').reshape((count, 3)).tolist() if 'scale' in packed else None
+
+    bone_data = []
+    for i, name in enumerate(names):
+        bone_datum = {
+            'name': name,
+            'scl': scl[i],
+            'parent_index': parent_index[i],
+            'co': co[i],
+            'rot': rot[i],
+        }
+        if has_scale[i]:
+            bone_datum['scale'] = scale[i]
+        bone_data.append(bone_datum)
+    return bone_data
+
+
+def pack_local_bone_data(local_bone_data: list[dict]) -> dict:
+    """LocalBoneData をカスタムプロパティ用の配列の辞書にする"""
+    matrices = [np.ravel(np.array(data['matrix'], dtype=np.float32)) for data in local_bone_data]
+    return {
+        'names' : "\n".join(data['name'] for data in local_bone_data),
+        'matrix': array_to_property(np.concatenate(matrices), '<f4'),
+    }
+
+
+def unpack_local_bone_data(packed) -> list[dict]:
+    """pack_local_bone_data() の逆変換"""
+    names = packed['names'].split("\n")
+    matrices = array_from_property(packed['matrix'], '<f4').reshape((len(names), 16)).tolist()
+    return [{'name': name, 'matrix': matrix} for name, matrix in zip(names, matrices)]
+
+
+# カスタムプロパティ (IDプロパティ) の読み書き
+
+def has_bone_data(target) -> bool:
+    """target に BoneData と LocalBoneData が保存されているか"""
+    has_bones = BONE_DATA_KEY in target or BONE_DATA_PREFIX + "0" in target
+    return has_bones and has_local_bone_data(target)
+
+
+def has_local_bone_data(target) -> bool:
+    """target に LocalBoneData が保存されているか"""
+    return LOCAL_BONE_DATA_KEY in target or LOCAL_BONE_DATA_PREFIX + "0" in target
+
+
+def is_legacy(target) -> bool:
+    """target のボーン情報が従来形式で保存されているか"""
+    return BONE_DATA_PREFIX + "0" in target or LOCAL_BONE_DATA_PREFIX + "0" in target
+
+
+def count_bone_data(target) -> int:
+    """保存されている BoneData と LocalBoneData の数の合計"""
+    count = 0
+    for key, prefix in ((BONE_DATA_KEY, BONE_DATA_PREFIX), (LOCAL_BONE_DATA_KEY, LOCAL_BONE_DATA_PREFIX)):
+        if key in target:
+            count += len(target[key]['names'].split("\n"))
+        else:
+            count += len(indexed_keys(target, prefix))
+    return count
+
+
+def read_bone_data(target) -> list[dict]:
+    if BONE_DATA_KEY in target:
+        return unpack_bone_data(target[BONE_DATA_KEY])
+    return parse_bone_data(indexed_data_generator(target, prefix=BONE_DATA_PREFIX))
+
+
+def read_local_bone_data(target) -> list[dict]:
+    if LOCAL_BONE_DATA_KEY in target:
+        return unpack_local_bone_data(target[LOCAL_BONE_DATA_KEY])
+    return parse_local_bone_data(indexed_data_generator(target, prefix=LOCAL_BONE_DATA_PREFIX))
+
+
+def read_bone_data_lines(target, model_ver: int = 2001) -> list[str]:
+    """保存形式にかかわらず BoneData を従来形式の文字列で返す (クリップボード用)"""
+    if BONE_DATA_KEY in target:
+        return format_bone_data(read_bone_data(target), model_ver)
+    return list(indexed_data_generator(target, prefix=BONE_DATA_PREFIX))
+
+
+def read_local_bone_data_lines(target) -> list[str]:
+    """保存形式にかかわらず LocalBoneData を従来形式の文字列で返す (クリップボード用)"""
+    if LOCAL_BONE_DATA_KEY in target:
+        return format_local_bone_data(read_local_bone_data(target))
+    return list(indexed_data_generator(target, prefix=LOCAL_BONE_DATA_PREFIX))
+
+
+def remove_bone_data(target):
+    """両方の形式の BoneData と LocalBoneData を削除する (BaseBone は残す)"""
+    for key in (BONE_DATA_KEY, LOCAL_BONE_DATA_KEY):
+        if key in target:
+            del target[key]
+    for prefix in (BONE_DATA_PREFIX, LOCAL_BONE_DATA_PREFIX):
+        for key in indexed_keys(target, prefix):
+            del target[key]
+
+
+def write_bone_data(target, bone_data: list[dict], model_ver: int, compact: bool = False):
+    """BoneData を保存する、既に保存されているものは形式にかかわらず置き換える"""
+    if BONE_DATA_KEY in target:
+        del target[BONE_DATA_KEY]
+    for key in indexed_keys(target, BONE_DATA_PREFIX):
+        del target[key]
+    if not bone_data:
+        return
+    if compact:
+        target[BONE_DATA_KEY] = pack_bone_data(bone_data)
+    else:
+        for i, line in enumerate(format_bone_data(bone_data, model_ver)):
+            target[BONE_DATA_PREFIX + str(i)] = line
+
+
+def write_local_bone_data(target, local_bone_data: list[dict], compact: bool = False):
+    """LocalBoneData を保存する、既に保存されているものは形式にかかわらず置き換える"""
+    if LOCAL_BONE_DATA_KEY in target:
+        del target[LOCAL_BONE_DATA_KEY]
+    for key in indexed_keys(target, LOCAL_BONE_DATA_PREFIX):
+        del target[key]
+    if not local_bone_data:
+        return
+    if compact:
+        target[LOCAL_BONE_DATA_KEY] = pack_local_bone_data(local_bone_data)
+    else:
+        for i, line in enumerate(format_local_bone_data(local_bone_data)):
+            target[LOCAL_BONE_DATA_PREFIX + str(i)] = line
+
+
+def write_bone_data_lines(target, bone_data_lines: list[str], local_bone_data_lines: list[str], compact: bool = False):
+    """従来形式の文字列 (クリップボードの内容など) から BoneData と LocalBoneData を保存する"""
+    remove_bone_data(target)
+    if compact:
+        bone_data = parse_bone_data(bone_data_lines)
+        if bone_data:
+            target[BONE_DATA_KEY] = pack_bone_data(bone_data)
+        local_bone_data = parse_local_bone_data(local_bone_data_lines)
+        if local_bone_data:
+            target[LOCAL_BONE_DATA_KEY] = pack_local_bone_data(local_bone_data)
+        return
+    bone_data_lines = [line for line in bone_data_lines if line.count(',') >= 4]
+    for i, line in enumerate(bone_data_lines):
+        target[BONE_DATA_PREFIX + str(i)] = line
+    local_bone_data_lines = [line for line in local_bone_data_lines if line.count(',') == 1]
+    for i, line in enumerate(local_bone_data_lines):
+        target[LOCAL_BONE_DATA_PREFIX + str(i)] = line
+
+
+def migrate_bone_data(target) -> bool:
+    """従来形式のボーン情報をコンパクト形式に変換する、変換した場合は True を返す"""
+    if not is_legacy(target):
+        return False
+    bone_lines = list(indexed_data_generator(target, prefix=BONE_DATA_PREFIX))
+    local_bone_lines = list(indexed_data_generator(target, prefix=LOCAL_BONE_DATA_PREFIX))
+    write_bone_data_lines(target, bone_lines, local_bone_lines, compact=True)
+    return True
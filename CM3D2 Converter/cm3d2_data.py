@@ -1,7 +1,7 @@
 """CM3D2/COM3D2用のデータ構造を扱うデータクラス"""
 import bpy
 import copy
-import struct
+from . import codec
 from . import common
 from . import compat
 from .translations.pgettext_functions import *
@@ -482,60 +482,59 @@ class Material():
         self.name2 = new_name
     
     def read(self, reader, read_header=True):
+        binary = codec.BinaryReader(reader)
         if read_header:
-            header = common.read_str(reader)
+            header = binary.read_str()
             if header != 'CM3D2_MATERIAL':
                 raise common.CM3D2ImportError(f_tip_("mateファイルではありません。ヘッダ:{}", header))
-            self.version = struct.unpack('<i', reader.read(4))[0]
-            self.name1 = common.read_str(reader)
-        self.name2 = common.read_str(reader)
+            self.version = binary.read_int32()
+            self.name1 = binary.read_str()
+        self.name2 = binary.read_str()
 
-        self.shader1 = common.read_str(reader)
-        self.shader2 = common.read_str(reader)
+        self.shader1 = binary.read_str()
+        self.shader2 = binary.read_str()
         
         peeked = reader.peek()[0]
-        print(f"type({peeked}) = {type(peeked)}")
         if self.version >= 2102 and (peeked in (0, 1)): # CR Edit Mode
-            cr_unknown_float_count = struct.unpack('<B', reader.read(1))[0]
+            cr_unknown_float_count = binary.read_uint8()
             for i in range(cr_unknown_float_count):
                 # CR TODO
-                self.custom_list[f'cr_unknown_float:{i:03d}'] = struct.unpack('<f', reader.read(4))
+                self.custom_list[f'cr_unknown_float:{i:03d}'] = binary.unpack(codec.FLOAT)
 
         for i in range(99999):
-            prop_type = common.read_str(reader)
+            prop_type = binary.read_str()
             if prop_type == 'tex':
-                prop_name = common.read_str(reader)
-                sub_type = common.read_str(reader)
+                prop_name = binary.read_str()
+                sub_type = binary.read_str()
                 if sub_type == 'tex2d':
-                    tex_name = common.read_str(reader)
-                    tex_path = common.read_str(reader)
-                    offset = struct.unpack('<2f', reader.read(4 * 2))
-                    scale = struct.unpack('<2f', reader.read(4 * 2))
+                    tex_name = binary.read_str()
+                    tex_path = binary.read_str()
+                    offset = binary.unpack(codec.VEC2)
+                    scale = binary.unpack(codec.VEC2)
                     tex_item = [prop_name, tex_name, tex_path, offset, scale]
                 else:
                     tex_item = [prop_name]
                 self.tex_list.append(tex_item)
 
             elif prop_type == 'col':
-                prop_name = common.read_str(reader)
-                col = struct.unpack('<4f', reader.read(4 * 4))
+                prop_name = binary.read_str()
+                col = binary.unpack(codec.VEC4)
                 self.col_list.append([prop_name, col])
 
             elif prop_type == 'f' or prop_type == 'range': # 'range' from CR Edit
-                prop_name = common.read_str(reader)
-                f = struct.unpack('<f', reader.read(4))[0]
+                prop_name = binary.read_str()
+                f = binary.read_float()
                 self.f_list.append([prop_name, f])
             
             # CR TODO
             elif prop_type == 'keyword':
-                prop_name = common.read_str(reader)
-                keyword_f = struct.unpack('<f', reader.read(4))[0]
-                print(keyword_f, type(keyword_f))
+                prop_name = binary.read_str()
+                keyword_f = binary.read_float()
                 self.custom_list.setdefault('keyword', dict())[prop_name] = keyword_f #.append([prop_name, keyword_f])
                 
             # CR TODO
             elif prop_type == '_ALPHAPREMULTIPLY_ON':
-                alpha_bool = struct.unpack('<?', reader.read(1))[0]
+                alpha_bool = binary.read_bool()
                 self.custom_list['_ALPHAPREMULTIPLY_ON'] = alpha_bool
 
             elif prop_type == 'end':
@@ -544,44 +543,45 @@ class Material():
                 raise common.CM3D2ImportError(f_tip_("Materialプロパティに未知の設定値タイプ({prop})が見つかりました。", prop=prop_type))
 
     def write(self, writer, write_header=True):
+        binary = codec.BinaryWriter(writer)
         if write_header:
-            common.write_str(writer, 'CM3D2_MATERIAL')
-            writer.write(struct.pack('<i', self.version))
-            common.write_str(writer, self.name1)
+            binary.write_str('CM3D2_MATERIAL')
+            binary.write_int32(self.version)
+            binary.write_str(self.name1)
 
-        common.write_str(writer, self.name2)
-        common.write_str(writer, self.shader1)
-        common.write_str(writer, self.shader2)
+        binary.write_str(self.name2)
+        binary.write_str(self.shader1)
+        binary.write_str(self.shader2)
 
         for tex_item in self.tex_list:
-            common.write_str(writer, 'tex')
-            common.write_str(writer, tex_item[0])  # prop_name
+            binary.write_str('tex')
+            binary.write_str(tex_item[0])  # prop_name
 
             if len(tex_item) < 2:
-                common.write_str(writer, 'null')
+                binary.write_str('null')
             else:
-                common.write_str(writer, 'tex2d')
-                common.write_str(writer, tex_item[1])  # tex_name
-                common.write_str(writer, tex_item[2])  # tex_path
+                binary.write_str('tex2d')
+                binary.write_str(tex_item[1])  # tex_name
+                binary.write_str(tex_item[2])  # tex_path
                 trans = tex_item[3]
-                writer.write(struct.pack('<2f', trans[0], trans[1]))
+                binary.pack(codec.VEC2, trans[0], trans[1])
                 scale = tex_item[4]
-                writer.write(struct.pack('<2f', scale[0], scale[1]))
+                binary.pack(codec.VEC2, scale[0], scale[1])
 
         for col_item in self.col_list:
-            common.write_str(writer, 'col')
-            common.write_str(writer, col_item[0])  # prop_name
+            binary.write_str('col')
+            binary.write_str(col_item[0])  # prop_name
 
             col = col_item[1]
-            writer.write(struct.pack('<4f', col[0], col[1], col[2], col[3]))
+            binary.pack(codec.VEC4, col[0], col[1], col[2], col[3])
 
         for f_item in self.f_list:
-            common.write_str(writer, 'f')
-            common.write_str(writer, f_item[0])  # prop_name
+            binary.write_str('f')
+            binary.write_str(f_item[0])  # prop_name
 
-            writer.write(struct.pack('<f', f_item[1]))
+            binary.write_float(f_item[1])
 
-        common.write_str(writer, 'end')
+        binary.write_str('end')
 
     def to_text(self):
         output_text = str(self.version) + "\n"
@@ -871,7 +871,7 @@ class MaterialHandler:
         return mat_data
 
     @classmethod
-    def apply_to(cls, override, mate, mat_data, replace_tex=True):
+    def apply_to(cls, override, mate, mat_data, replace_tex=True, image_cache=None):
         mate['shader1'] = mat_data.shader1
         mate['shader2'] = mat_data.shader2
 
@@ -893,7 +893,7 @@ class MaterialHandler:
                 tex_name = tex_item[1]
                 tex_path = tex_item[2]
                 tex_map = tex_item[3] + tex_item[4]
-                common.create_tex(override, mate, prop_name, tex_name, tex_path, tex_path, tex_map, replace_tex)
+                common.create_tex(override, mate, prop_name, tex_name, tex_path, tex_path, tex_map, replace_tex, image_cache=image_cache)
 
         for col_item in mat_data.col_list:
             prop_name = col_item[0]
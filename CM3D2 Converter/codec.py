@@ -0,0 +1,136 @@
+"""CM3D2専用ファイルに共通するバイナリの読み書き (bpy は使わない)
+
+文字列は 7bit 可変長の長さ (.NET の BinaryWriter.Write(string) と同じ) に続く UTF-8 で書かれる。
+よく使うレコードの形はコンパイル済みの struct.Struct として用意してある。
+"""
+from __future__ import annotations
+
+import struct
+
+
+BOOL = struct.Struct('<?')
+INT8 = struct.Struct('<b')
+UINT8 = struct.Struct('<B')
+INT32 = struct.Struct('<i')
+INT32x2 = struct.Struct('<2i')
+INT32x3 = struct.Struct('<3i')
+FLOAT = struct.Struct('<f')
+VEC2 = struct.Struct('<2f')
+VEC3 = struct.Struct('<3f')
+VEC4 = struct.Struct('<4f')    # クォータニオン (x, y, z, w) や色 (r, g, b, a)
+
+# 1バイトで表せる長さは毎回作らずに使い回す
+_SMALL_VARINTS = tuple(bytes((i,)) for i in range(0x80))
+
+
+def encode_varint(value: int) -> bytes:
+    """0 以上の整数を 7bit 可変長のバイト列にする"""
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(buffer, offset: int = 0) -> tuple[int, int]:
+    """buffer の offset から 7bit 可変長の整数を読み、(値, 次の位置) を返す"""
+    value = 0
+    for shift in range(0, 63, 7):
+        if offset >= len(buffer):
+            raise struct.error("unpack requires a buffer of 1 bytes")
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+    return value, offset
+
+
+def read_varint(file) -> int:
+    """ファイルオブジェクトから 7bit 可変長の整数を読む"""
+    value = 0
+    for shift in range(0, 63, 7):
+        byte = file.read(1)
+        if not byte:
+            raise struct.error("unpack requires a buffer of 1 bytes")
+        byte = byte[0]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+    return value
+
+
+def encode_str(raw_str: str) -> bytes:
+    """文字列を長さ付きのバイト列にする"""
+    data = raw_str.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def decode_str(buffer, offset: int = 0) -> tuple[str, int]:
+    """buffer の offset から長さ付きの文字列を読み、(文字列, 次の位置) を返す"""
+    length, offset = decode_varint(buffer, offset)
+    end = offset + length
+    if end > len(buffer):
+        raise struct.error(f"unpack requires a buffer of {length} bytes")
+    return bytes(buffer[offset:end]).decode('utf-8'), end
+
+
+class BinaryReader():
+    """ファイルオブジェクトから CM3D2専用ファイルの値を読み込むクラス
+
+    fileutil.MemoryMappedReader のように read_str() を持つファイルなら、それを使う。
+    """
+    def __init__(self, file):
+        self.file = file
+        self.read = file.read
+        if hasattr(file, 'read_str'):
+            self.read_str = file.read_str
+
+    def read_str(self) -> str:
+        return self.read(read_varint(self.file)).decode('utf-8')
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        return fmt.unpack(self.read(fmt.size))
+
+    def read_bool(self) -> bool:
+        return BOOL.unpack(self.read(1))[0]
+
+    def read_uint8(self) -> int:
+        return UINT8.unpack(self.read(1))[0]
+
+    def read_int32(self) -> int:
+        return INT32.unpack(self.read(4))[0]
+
+    def read_float(self) -> float:
+        return FLOAT.unpack(self.read(4))[0]
+
+
+class BinaryWriter():
+    """ファイルオブジェクトに CM3D2専用ファイルの値を書き込むクラス"""
+    def __init__(self, file):
+        self.file = file
+        self.write = file.write
+
+    def write_str(self, raw_str: str):
+        self.write(encode_str(raw_str))
+
+    def pack(self, fmt: struct.Struct, *values):
+        self.write(fmt.pack(*values))
+
+    def write_bool(self, value: bool):
+        self.write(BOOL.pack(value))
+
+    def write_int8(self, value: int):
+        self.write(INT8.pack(value))
+
+    def write_uint8(self, value: int):
+        self.write(UINT8.pack(value))
+
+    def write_int32(self, value: int):
+        self.write(INT32.pack(value))
+
+    def write_float(self, value: float):
+        self.write(FLOAT.pack(value))
@@ -1,12 +1,12 @@
 import os
 import re
 import math
-import struct
 import shutil
 from typing import Any
 import bpy
 import bmesh
 import mathutils
+from . import codec
 from . import fileutil
 from . import compat
 from . import cm3d2_data
@@ -85,37 +85,18 @@ def line_trim(line, enable=True):
 
 # CM3D2専用ファイル用の文字列書き込み
 def write_str(file, raw_str):
-    b_str = format(len(raw_str.encode('utf-8')), 'b')
-    for i in range(9):
-        if len(b_str) > 7:
-            file.write(struct.pack('<B', int("1" + b_str[-7:], 2)))
-            b_str = b_str[:-7]
-        else:
-            file.write(struct.pack('<B', int(b_str, 2)))
-            break
-    file.write(raw_str.encode('utf-8'))
+    file.write(codec.encode_str(raw_str))
 
 def pack_str(buffer, raw_str):
-    b_str = format(len(raw_str.encode('utf-8')), 'b')
-    for i in range(9):
-        if 7 < len(b_str):
-            buffer = buffer + struct.pack('<B', int("1" + b_str[-7:], 2))
-            b_str = b_str[:-7]
-        else:
-            buffer = buffer + struct.pack('<B', int(b_str, 2))
-            break
-    buffer = buffer + raw_str.encode('utf-8')
-    return buffer
+    return buffer + codec.encode_str(raw_str)
 
 
 # CM3D2専用ファイル用の文字列読み込み
-def read_str(file, total_b=""):
-    for i in range(9):
-        b_str = format(struct.unpack('<B', file.read(1))[0], '08b')
-        total_b = b_str[1:] + total_b
-        if b_str[0] == '0':
-            break
-    return file.read(int(total_b, 2)).decode('utf-8')
+def read_str(file):
+    if hasattr(file, 'read_str'):
+        # fileutil.MemoryMappedReader などは専用の実装を使う
+        return file.read_str()
+    return file.read(codec.read_varint(file)).decode('utf-8')
 
 
 # ボーン/ウェイト名を Blender → CM3D2
@@ -498,12 +479,22 @@ def default_cm3d2_dir(base_dir: str, file_name: str, new_ext: str):
 
 # 一時ファイル書き込みと自動バックアップを行うファイルオブジェクトを返す
 def open_temporary(filepath, mode, is_backup=False):
-    backup_ext = preferences().backup_ext
+    return fileutil.TemporaryFileWriter(filepath, mode, **temporary_file_options(filepath, is_backup))
+
+
+# open_temporary() で TemporaryFileWriter に渡す設定 (別スレッドで開く場合は先に取得しておく)
+def temporary_file_options(filepath, is_backup=False):
+    prefs = preferences()
+    backup_ext = prefs.backup_ext
     if is_backup and backup_ext:
         backup_filepath = filepath + '.' + backup_ext
     else:
         backup_filepath = None
-    return fileutil.TemporaryFileWriter(filepath, mode, backup_filepath=backup_filepath)
+    return {
+        'backup_filepath': backup_filepath,
+        'buffer_size': prefs.write_buffer_size * 1024,
+        'write_behind': prefs.is_write_behind,
+    }
 
 
 # ファイルを上書きするならバックアップ処理
@@ -645,11 +636,12 @@ def __replace_cm3d2_tex(img, texpath_dict: dict) -> bool:
 def load_cm3d2tex(path, skip_data=False):
 
     with open(path, 'rb') as file:
-        header_ext = read_str(file)
+        reader = codec.BinaryReader(file)
+        header_ext = reader.read_str()
         if header_ext != 'CM3D2_TEX':
             return None
-        version = struct.unpack('<i', file.read(4))[0]
-        read_str(file)
+        version = reader.read_int32()
+        reader.read_str()
 
         # default value
         tex_format = 5
@@ -657,22 +649,22 @@ def load_cm3d2tex(path, skip_data=False):
         data = None
         if version >= 1010:
             if version >= 1011:
-                num_rect = struct.unpack('<i', file.read(4))[0]
+                num_rect = reader.read_int32()
                 uv_rects = []
                 for i in range(num_rect):
                     # x, y, w, h
-                    uv_rects.append(struct.unpack('<4f', file.read(4 * 4)))
-            width = struct.unpack('<i', file.read(4))[0]
-            height = struct.unpack('<i', file.read(4))[0]
-            tex_format = struct.unpack('<i', file.read(4))[0]
+                    uv_rects.append(reader.unpack(codec.VEC4))
+            width = reader.read_int32()
+            height = reader.read_int32()
+            tex_format = reader.read_int32()
             # if tex_format == 10 or tex_format == 12: return None
         if not skip_data:
-            png_size = struct.unpack('<i', file.read(4))[0]
-            data = file.read(png_size)
+            png_size = reader.read_int32()
+            data = reader.read(png_size)
         return version, tex_format, uv_rects, data
 
 
-def create_tex(context, mate, node_name, tex_name=None, filepath=None, cm3d2path=None, tex_map_data=None, replace_tex=False, slot_index=-1):
+def create_tex(context, mate, node_name, tex_name=None, filepath=None, cm3d2path=None, tex_map_data=None, replace_tex=False, slot_index=-1, image_cache=None):
     if isinstance(context, bpy.types.Context):
         context = context.copy()
 
@@ -716,8 +708,14 @@ def create_tex(context, mate, node_name, tex_name=None, filepath=None, cm3d2path
             tex.name = tex.label = node_name
             tex.show_texture = True
 
+        is_cached_image = False
         if tex_name:
-            if tex.image is None:
+            # image_cache が渡された場合は、同じテクスチャの画像を使い回す
+            cache_key = (tex_name, cm3d2path)
+            if tex.image is None and image_cache is not None and cache_key in image_cache:
+                tex.image = image_cache[cache_key]
+                is_cached_image = True
+            elif tex.image is None:
                 if os.path.exists(filepath):
                     img = bpy.data.images.load(filepath)
                     img.name = tex_name
@@ -745,8 +743,10 @@ def create_tex(context, mate, node_name, tex_name=None, filepath=None, cm3d2path
         # tex.outputs['ALpha'].default_value = tex_data['color'][3]
 
             # tex探し
-            if replace_tex:
+            if replace_tex and not is_cached_image:
                 replaced = replace_cm3d2_tex(tex.image, reload_path=False)
+            if image_cache is not None:
+                image_cache[cache_key] = tex.image
                 # TODO 2.8での実施方法を調査. shader editorで十分？
 
     return tex
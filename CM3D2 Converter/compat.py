@@ -389,6 +389,20 @@ def convert_bl_to_cm_space(x, lossless=True):
         return mathutils.Vector((-x[0], x[2], -x[1]))
     else:
         return mul(BL_TO_CM_SPACE_MAT4, x)
+
+# (N, 3) の行ベクトル配列用の変換行列 (lossless な変換と同じく符号と軸の入れ替えのみ)
+CM_TO_BL_SPACE_ARRAY = np.array((
+    ( -1,  0,  0),
+    (  0,  0,  1),
+    (  0, -1,  0),
+), dtype=np.float32)
+BL_TO_CM_SPACE_ARRAY = CM_TO_BL_SPACE_ARRAY.T.copy()
+def convert_cm_to_bl_space_array(x: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """(N, 3) の座標配列を一度の行列演算で CM3D2 → Blender 空間に変換します (スケールも同時に掛けます)"""
+    return np.asarray(x, dtype=np.float32) @ (CM_TO_BL_SPACE_ARRAY * np.float32(scale))
+def convert_bl_to_cm_space_array(x: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """(N, 3) の座標配列を一度の行列演算で Blender → CM3D2 空間に変換します (スケールも同時に掛けます)"""
+    return np.asarray(x, dtype=np.float32) @ (BL_TO_CM_SPACE_ARRAY * np.float32(scale))
 def convert_cm_to_bl_local_space(x):
     if type(x) == mathutils.Quaternion:
         raise TypeError('Quaternion space conversions not supported')
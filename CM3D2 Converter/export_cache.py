@@ -0,0 +1,93 @@
+"""差分エクスポート用に、前回書き出したmodelファイルの部分ごとのバイト列をメモリに保持する (bpy は使わない)
+
+部分ごとに元データのハッシュ値を記録しておき、次のエクスポートで同じハッシュ値になった部分は
+書き出し処理をせずに前回のバイト列をそのまま使う。
+"""
+from __future__ import annotations
+
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+
+# 保持するファイルの数
+MAX_CACHED_FILES = 8
+
+_caches = collections.OrderedDict()
+
+
+def fingerprint(data) -> bytes:
+    """配列・数値・文字列・リスト・辞書などを組み合わせた data のハッシュ値を返す"""
+    digest = hashlib.blake2b(digest_size=16)
+
+    def update(value):
+        if isinstance(value, np.ndarray):
+            digest.update(b'A' + value.dtype.str.encode() + repr(value.shape).encode())
+            digest.update(np.ascontiguousarray(value).data)
+        elif isinstance(value, (list, tuple)):
+            digest.update(b'L%d' % len(value))
+            for item in value:
+                update(item)
+        elif isinstance(value, dict):
+            digest.update(b'D%d' % len(value))
+            for key, item in value.items():
+                update(key)
+                update(item)
+        else:
+            digest.update(b'V' + repr(value).encode())
+
+    update(data)
+    return digest.digest()
+
+
+class SectionCache():
+    """1つの出力ファイルの部分ごとの (ハッシュ値, バイト列) を保持するクラス"""
+    def __init__(self):
+        self.sections = {}
+        self.used_names = set()
+        self.reused_count = 0
+
+    def begin(self):
+        """エクスポートの開始時に呼ぶ"""
+        self.used_names = set()
+        self.reused_count = 0
+
+    def get(self, name: str, key: bytes) -> bytes | None:
+        """name の部分のハッシュ値が key と同じなら前回のバイト列を返す"""
+        self.used_names.add(name)
+        section = self.sections.get(name)
+        if section is None or section[0] != key:
+            return None
+        self.reused_count += 1
+        return section[1]
+
+    def put(self, name: str, key: bytes, data: bytes):
+        self.used_names.add(name)
+        self.sections[name] = (key, data)
+
+    def end(self):
+        """エクスポートの終了時に呼ぶ、今回使われなかった部分 (削除されたシェイプキーなど) を捨てる"""
+        for name in list(self.sections.keys()):
+            if name not in self.used_names:
+                del self.sections[name]
+
+    @property
+    def section_count(self) -> int:
+        return len(self.used_names)
+
+
+def get_section_cache(filepath) -> SectionCache:
+    """filepath の SectionCache を返す、無ければ作る (古いものから MAX_CACHED_FILES を超えた分を捨てる)"""
+    key = os.path.normcase(os.path.abspath(filepath))
+    cache = _caches.pop(key, None) or SectionCache()
+    _caches[key] = cache
+    while len(_caches) > MAX_CACHED_FILES:
+        _caches.popitem(last=False)
+    return cache
+
+
+def clear():
+    """保持しているすべてのバイト列を捨てる"""
+    _caches.clear()
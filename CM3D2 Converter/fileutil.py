@@ -1,11 +1,18 @@
 from __future__ import annotations
 
 import io
+import mmap
 import os
+import queue
 import shutil
+import struct
 import tempfile
+import threading
 from typing import TypeVar
 
+import numpy as np
+
+from . import codec
 from System.IO import MemoryStream
 from CM3D2.Serialization import CM3D2Serializer, ICM3D2Serializable
 
@@ -26,19 +33,26 @@ class TemporaryFileWriter(io.BufferedWriter):
         """一時ファイルパスを取得します。"""
         return self.__temppath
 
-    def __init__(self, filepath, mode='wb', buffer_size=io.DEFAULT_BUFFER_SIZE, backup_filepath=None):
+    def __init__(self, filepath, mode='wb', buffer_size=io.DEFAULT_BUFFER_SIZE, backup_filepath=None, write_behind=False):
         """ファイルパスを指定して初期化します。
         backup_filepath に None 以外が指定された場合、書き込み完了時に
         バックアップファイルが作成されます。
+        write_behind が True の場合、buffer_size ごとのディスクへの書き込みを
+        別スレッドで行い、その間も書き込みを続けられます。
         """
         dirpath, filename = os.path.split(filepath)
         fd, temppath = tempfile.mkstemp(prefix=filename + '.', dir=dirpath)
+        fh = None
         try:
             fh = os.fdopen(fd, mode)
+            if write_behind:
+                fh = WriteBehindRaw(fh)
             super(TemporaryFileWriter, self).__init__(fh, buffer_size)
         except:
             if fh:
                 fh.close()
+            else:
+                os.close(fd)
             os.remove(temppath)
             raise
         self.__filepath = filepath
@@ -58,8 +72,14 @@ class TemporaryFileWriter(io.BufferedWriter):
         """一時ファイルを閉じてリネームします。"""
         if self.closed:
             return
-        super(io.BufferedWriter, self).close()
-        self.raw.close()
+        try:
+            super(io.BufferedWriter, self).close()
+        finally:
+            try:
+                self.raw.close()
+            except:
+                os.remove(self.temppath)
+                raise
         try:
             if os.path.exists(self.filepath):
                 if self.backup_filepath is not None:
@@ -75,11 +95,198 @@ class TemporaryFileWriter(io.BufferedWriter):
         """一時ファイルを閉じて削除します。"""
         if self.closed:
             return
-        super(io.BufferedWriter, self).close()
+        if isinstance(self.raw, WriteBehindRaw):
+            self.raw.discard()
+        try:
+            super(io.BufferedWriter, self).close()
+        except OSError:
+            pass
         self.raw.close()
         os.remove(self.temppath)
 
 
+class WriteBehindRaw(io.RawIOBase):
+    """書き込まれたデータを別スレッドで fh に書き込みます。
+
+    TemporaryFileWriter の write_behind で使われ、バッファがいっぱいになるたびに
+    渡される内容をキューに入れてすぐに戻ります。キューが max_pending 個でいっぱいの間は待ちます。
+    別スレッドで起きたエラーは、次の write(), flush(), close() で送出されます。
+    """
+
+    def __init__(self, fh, max_pending=4):
+        super().__init__()
+        self.__fh = fh
+        self.__queue = queue.Queue(max_pending)
+        self.__error = None
+        self.__is_discarded = False
+        self.__thread = threading.Thread(target=self.__run, name='WriteBehindRaw', daemon=True)
+        self.__thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.__raise_error()
+        # BufferedWriter は渡したバッファを使い回すのでコピーする
+        data = bytes(b)
+        self.__queue.put(data)
+        return len(data)
+
+    def flush(self):
+        self.__raise_error()
+
+    def discard(self):
+        """まだ書き込んでいないデータを捨て、以降の書き込みを無視します。"""
+        self.__is_discarded = True
+
+    def close(self):
+        """残りのデータを書き込み終わるまで待ってから閉じます。"""
+        if self.closed:
+            return
+        self.__queue.put(None)
+        self.__thread.join()
+        try:
+            self.__fh.close()
+        finally:
+            super().close()
+        self.__raise_error()
+
+    def __run(self):
+        while True:
+            data = self.__queue.get()
+            if data is None:
+                return
+            if self.__error is not None or self.__is_discarded:
+                continue
+            try:
+                self.__fh.write(data)
+            except BaseException as e:
+                self.__error = e
+
+    def __raise_error(self):
+        if self.__error is not None and not self.__is_discarded:
+            raise self.__error
+
+
+class MemoryMappedReader:
+    """ファイルをメモリマップして読み込みます。
+
+    read_view() と read_array() はファイルの内容をコピーせずにビューを返します。
+    返されたビューが残っている間はマッピングも維持されます。
+    read(), peek(), tell(), seek() を備えているので、通常のファイルオブジェクトの代わりに
+    common.read_str() や MaterialHandler.read() にも渡せます。
+    """
+
+    def __init__(self, filepath):
+        self.name = filepath
+        with open(filepath, 'rb') as fh:
+            try:
+                self.__mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # 空のファイルはマップできない
+                self.__mmap = b''
+        self.__size = len(self.__mmap)
+        self.__pos = 0
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def size(self):
+        """ファイルサイズを取得します。"""
+        return self.__size
+
+    def close(self):
+        """マッピングを閉じます。ビューが残っている場合はそれらが解放された時に閉じられます。"""
+        if self.__closed:
+            return
+        self.__closed = True
+        if isinstance(self.__mmap, mmap.mmap):
+            try:
+                self.__mmap.close()
+            except BufferError:
+                pass
+        self.__mmap = b''
+
+    def tell(self):
+        return self.__pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__pos
+        elif whence == io.SEEK_END:
+            offset += self.__size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.__pos = offset
+        return self.__pos
+
+    def skip(self, size):
+        """size バイト読み飛ばします。"""
+        self.__require(size)
+        self.__pos += size
+
+    def read(self, size=-1) -> bytes:
+        """ファイルオブジェクトと同様に、最大 size バイトをコピーして返します。"""
+        start = min(self.__pos, self.__size)
+        end = self.__size if size is None or size < 0 else min(start + size, self.__size)
+        self.__pos = end
+        return self.__mmap[start:end]
+
+    def peek(self, size=1) -> bytes:
+        """読み込み位置を進めずに、少なくとも size バイトを返します。(EOFでは短くなります)"""
+        start = min(self.__pos, self.__size)
+        return self.__mmap[start:start + max(size, 1)]
+
+    def read_view(self, size) -> memoryview:
+        """size バイト分のビューをコピーせずに返します。"""
+        self.__require(size)
+        start = self.__pos
+        self.__pos += size
+        return memoryview(self.__mmap)[start:self.__pos]
+
+    def read_array(self, dtype, count) -> np.ndarray:
+        """dtype の要素 count 個を読み取り専用の配列ビューとして返します。"""
+        dtype = np.dtype(dtype)
+        size = dtype.itemsize * count
+        self.__require(size)
+        start = self.__pos
+        self.__pos += size
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.frombuffer(self.__mmap, dtype=dtype, count=count, offset=start)
+
+    def unpack(self, fmt: str | struct.Struct) -> tuple:
+        """struct のフォーマットに従って読み込みます。"""
+        if not isinstance(fmt, struct.Struct):
+            fmt = struct.Struct(fmt)
+        values = fmt.unpack_from(self.__mmap, self.__pos)
+        self.__pos += fmt.size
+        return values
+
+    def read_i32(self) -> int:
+        value = codec.INT32.unpack_from(self.__mmap, self.__pos)[0]
+        self.__pos += 4
+        return value
+
+    def read_str(self) -> str:
+        """CM3D2専用ファイル用の文字列 (7bit可変長の長さ + UTF-8) を読み込みます。"""
+        value, self.__pos = codec.decode_str(self.__mmap, self.__pos)
+        return value
+
+    def __require(self, size):
+        # 既存の読み込み処理と同じく、足りない場合や負の大きさの場合は struct.error を投げる
+        if size < 0 or self.__pos + size > self.__size:
+            raise struct.error(f"unpack requires a buffer of {size} bytes")
+
+
 def serialize_to_file(data: ICM3D2Serializable, file: io.BufferedWriter):
     serializer = CM3D2Serializer()
     memory_stream = MemoryStream()
@@ -6,6 +6,7 @@ import bpy
 from . import common
 from . import compat
 from . import cm3d2_data
+from . import fileutil
 from .translations.pgettext_functions import *
 
 
@@ -50,7 +51,7 @@ class CNV_OT_import_cm3d2_mate(bpy.types.Operator):
         prefs.mate_import_path = self.filepath
 
         try:
-            file = open(self.filepath, 'rb')
+            file = fileutil.MemoryMappedReader(self.filepath)
         except:
             self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
             return {'CANCELLED'}
@@ -120,7 +121,7 @@ class CNV_OT_import_cm3d2_mate_text(bpy.types.Operator):
             edit_text.clear()
 
         try:
-            file = open(self.filepath, 'rb')
+            file = fileutil.MemoryMappedReader(self.filepath)
         except:
             self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
             return {'CANCELLED'}
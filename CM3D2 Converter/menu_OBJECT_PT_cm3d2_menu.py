@@ -4,6 +4,7 @@ import mathutils
 import struct
 from . import common
 from . import compat
+from . import fileutil
 from . import menu_file
 
 ''' CM3D2 Menu / Object Panel Classes '''
@@ -137,9 +138,9 @@ class CM3D2MENU_OT_import(bpy.types.Operator):
     def execute(self, context):
         ob = context.object
         try:
-            file = open(self.filepath, 'rb')
-            ob.cm3d2_menu.clear()
-            ob.cm3d2_menu.unpack_from_file(file)
+            with fileutil.MemoryMappedReader(self.filepath) as file:
+                ob.cm3d2_menu.clear()
+                ob.cm3d2_menu.unpack_from_file(file)
         except IOError as e:
             self.report(type={'ERROR'}, message=e.args[0])
             return {'CANCELLED'}
@@ -183,8 +184,8 @@ class CM3D2MENU_OT_export(bpy.types.Operator):
     def execute(self, context):
         ob = context.object
         try:
-            file = common.open_temporary(self.filepath, 'wb', is_backup=self.is_backup)
-            ob.cm3d2_menu.pack_into_file(file)
+            with common.open_temporary(self.filepath, 'wb', is_backup=self.is_backup) as file:
+                ob.cm3d2_menu.pack_into_file(file)
         except IOError as e:
             self.report(type={'ERROR'}, message=e.args[0])
             return {'CANCELLED'}
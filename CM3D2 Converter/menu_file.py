@@ -1,7 +1,7 @@
 import bpy
 import math
 import mathutils
-import struct
+from . import codec
 from . import common
 from . import compat
 from .translations.pgettext_functions import *
@@ -245,7 +245,7 @@ class CM3D2MENU_PG_AttachPointCommand(bpy.types.PropertyGroup):
         self.rotation.z = float(string_list[7]) * math.pi/180
     
     def pack_into(self, buffer):
-        buffer = buffer + struct.pack('<B', 1 + 1 + 3 + 3)
+        buffer = buffer + codec.UINT8.pack(1 + 1 + 3 + 3)
         buffer = common.pack_str(buffer, self.command   )
         buffer = common.pack_str(buffer, self.point_name)
         buffer = common.pack_str(buffer, str(self.location.x)              )
@@ -293,7 +293,7 @@ class CM3D2MENU_PG_PropertyCommand(bpy.types.PropertyGroup):
         self.value      = float(string_list[2])
     
     def pack_into(self, buffer):
-        buffer = buffer + struct.pack('<B', 1 + 1 + 1)
+        buffer = buffer + codec.UINT8.pack(1 + 1 + 1)
         buffer = common.pack_str(buffer, self.command    )
         buffer = common.pack_str(buffer, self.prop_name  )
         buffer = common.pack_str(buffer, str(self.value) )
@@ -350,7 +350,7 @@ class CM3D2MENU_PG_MiscCommand(bpy.types.PropertyGroup):
             new_param.name  = param
 
     def pack_into(self, buffer):
-        buffer = buffer + struct.pack('<B', 1 + len(self.params))
+        buffer = buffer + codec.UINT8.pack(1 + len(self.params))
         buffer = common.pack_str(buffer, self.command)
         for param in self.params:
             buffer = common.pack_str(buffer, param.value)
@@ -517,23 +517,24 @@ class OBJECT_PG_CM3D2Menu(bpy.types.PropertyGroup):
         new_command.parse_list(string_list)
 
     def unpack_from_file(self, file):
-        if common.read_str(file) != 'CM3D2_MENU':
+        binary = codec.BinaryReader(file)
+        if binary.read_str() != 'CM3D2_MENU':
             raise IOError("Not a valid CM3D2 .menu file.")
 
-        self.version      = struct.unpack('<i', file.read(4))[0]
-        self.path         = common.read_str(file)
-        self.name         = common.read_str(file)
-        self.category     = common.read_str(file)
-        self.description  = common.read_str(file)
+        self.version      = binary.read_int32()
+        self.path         = binary.read_str()
+        self.name         = binary.read_str()
+        self.category     = binary.read_str()
+        self.description  = binary.read_str()
         
-        struct.unpack('<i', file.read(4))[0]
+        binary.read_int32()
         string_list = []
-        string_list_length = struct.unpack('<B', file.read(1))[0]
+        string_list_length = binary.read_uint8()
         while string_list_length > 0:
             string_list.clear()
 
             for i in range(string_list_length):
-                string_list.append(common.read_str(file))
+                string_list.append(binary.read_str())
             
             try:
                 self.parse_list(string_list)
@@ -541,31 +542,32 @@ class OBJECT_PG_CM3D2Menu(bpy.types.PropertyGroup):
                 print(e)
             
             # Check for end of file
-            chunk = file.read(1)
+            chunk = binary.read(1)
             if len(chunk) == 0:
                 break
-            string_list_length = struct.unpack('<B', chunk)[0]
+            string_list_length = codec.UINT8.unpack(chunk)[0]
 
         self.update()
     
     def pack_into_file(self, file):
         self.update()
 
-        common.write_str(file, 'CM3D2_MENU')
+        binary = codec.BinaryWriter(file)
+        binary.write_str('CM3D2_MENU')
 
-        file.write(struct.pack('<i', self.version    ))
-        common.write_str(file,       self.path       )
-        common.write_str(file,       self.name       )
-        common.write_str(file,       self.category   )
-        common.write_str(file,       self.description)
+        binary.write_int32(self.version    )
+        binary.write_str(  self.path       )
+        binary.write_str(  self.name       )
+        binary.write_str(  self.category   )
+        binary.write_str(  self.description)
                     
         buffer = bytearray()
         for command_pointer in self.commands:
             buffer = command_pointer.dereference(self).pack_into(buffer)
-        buffer = buffer + struct.pack('<B', 0x00)
+        buffer = buffer + codec.UINT8.pack(0x00)
         
-        file.write(struct.pack('<i', len(buffer)))
-        file.write(bytes(buffer))
+        binary.write_int32(len(buffer))
+        binary.write(bytes(buffer))
 
     def clear(self):
         self.property_unset('version'    )
@@ -0,0 +1,792 @@
+"""modelファイルに書き出すメッシュを配列として読み込む
+
+ObjectMeshData は1つのメッシュオブジェクトをそのまま読み込む (複製・結合・モディファイア適用済みのもの)。
+EvaluatedMeshData は複数のオブジェクトのモディファイア適用後の状態を depsgraph から読み込んでメモリ上で結合するので、
+bpy.data に作業用のオブジェクトやメッシュを作らない。
+SnapshotMeshData は読み込み済みの MeshData のシェイプキーもすべて配列に読み込んでおき、bpy を使わずに参照できるようにする。
+"""
+from __future__ import annotations
+
+import abc
+import re
+import bpy
+import mathutils
+import numpy as np
+from . import common
+from . import compat
+from .translations.pgettext_functions import *
+
+
+def read_vertex_groups(me: bpy.types.Mesh):
+    """頂点グループの割り当てを (頂点ごとの割り当て数, 頂点グループのインデックス, ウェイト) の平らな配列で返す
+
+    頂点グループのウェイトは foreach_get でまとめて読めない (頂点ごとの groups にしか無い) ので、
+    ここだけは頂点ごとに Python でループする。以降の処理はすべて配列で行う。
+    """
+    group_counts = []
+    memberships = []
+    for vert in me.vertices:
+        vgs = vert.groups
+        group_counts.append(len(vgs))
+        memberships.extend((vg.group, vg.weight) for vg in vgs)
+    memberships = np.array(memberships, dtype=[('group', np.int64), ('weight', np.float64)])
+    return np.array(group_counts, dtype=np.int64), memberships['group'], memberships['weight']
+
+
+def read_loop_normals(me: bpy.types.Mesh) -> np.ndarray:
+    """ループごとの法線 (カスタム法線を含む) を (ループ数, 3) の配列で返す"""
+    me.calc_normals_split()
+    loop_normals = np.empty((len(me.loops), 3), dtype=np.float32)
+    me.loops.foreach_get('normal', loop_normals.ravel())
+    return loop_normals
+
+
+def read_delta_normals(me: bpy.types.Mesh, name: str, out: np.ndarray) -> np.ndarray | None:
+    """シェイプキーの法線の差分を保存した属性 (頂点カラー) をループごとに out に読み込む、無ければ None"""
+    if not compat.IS_LEGACY and bpy.app.version >= (2, 92):
+        attribute = me.attributes[name] if name in me.attributes.keys() else None
+        is_color = (attribute is not None) and attribute.data_type in {'BYTE_COLOR', 'FLOAT_COLOR'}
+    else:
+        attribute = me.vertex_colors[name] if name in me.vertex_colors.keys() else None
+        is_color = True
+    if attribute is None:
+        return None
+    if is_color:
+        colors = np.empty((len(me.loops), 4), dtype=np.float64)
+        attribute.data.foreach_get('color', colors.ravel())
+        out[:] = colors[:, :3]
+        out -= 0.5
+        out *= 2
+    else:
+        attribute.data.foreach_get('vector', out.ravel())
+    return out
+
+
+def calc_vertex_normals(cos, loop_vertex_indices, polygon_loop_starts, polygon_loop_totals, out, vertex_indices):
+    """面の角度で重み付けした頂点法線を計算し、vertex_indices の頂点だけ out に書き込む"""
+    loop_count = len(loop_vertex_indices)
+    loop_polygons = np.repeat(np.arange(len(polygon_loop_starts)), polygon_loop_totals)
+    loop_indices = np.arange(loop_count)
+    poly_ends = polygon_loop_starts + polygon_loop_totals
+    next_loops = loop_indices + 1
+    next_loops[poly_ends - 1] = polygon_loop_starts
+    prev_loops = loop_indices - 1
+    prev_loops[polygon_loop_starts] = poly_ends - 1
+
+    loop_cos = cos[loop_vertex_indices].astype(np.float64)
+    next_cos = loop_cos[next_loops]
+    prev_cos = loop_cos[prev_loops]
+
+    # 面の法線 (Newell 法)
+    poly_normals = np.zeros((len(polygon_loop_starts), 3), dtype=np.float64)
+    np.add.at(poly_normals, loop_polygons, np.cross(loop_cos, next_cos))
+    lengths = np.linalg.norm(poly_normals, axis=1)
+    np.divide(poly_normals, lengths[:, np.newaxis], out=poly_normals, where=lengths[:, np.newaxis] > 0)
+
+    # 角の角度
+    edge1 = next_cos - loop_cos
+    edge2 = prev_cos - loop_cos
+    edge1 /= np.maximum(np.linalg.norm(edge1, axis=1), 1e-30)[:, np.newaxis]
+    edge2 /= np.maximum(np.linalg.norm(edge2, axis=1), 1e-30)[:, np.newaxis]
+    angles = np.arccos(np.clip(np.einsum('ij,ij->i', edge1, edge2), -1.0, 1.0))
+
+    vert_count = len(cos)
+    normals = np.empty((vert_count, 3), dtype=np.float64)
+    weighted = poly_normals[loop_polygons] * angles[:, np.newaxis]
+    for axis in range(3):
+        normals[:, axis] = np.bincount(loop_vertex_indices, weights=weighted[:, axis], minlength=vert_count)
+    lengths = np.linalg.norm(normals, axis=1)
+    np.divide(normals, lengths[:, np.newaxis], out=normals, where=lengths[:, np.newaxis] > 0)
+    out[vertex_indices] = normals[vertex_indices]
+    return out
+
+
+def link_loop_order(loop_vertex_indices, loop_edge_indices, polygon_loop_starts, polygon_loop_totals) -> np.ndarray:
+    """ループを bm.from_mesh() 直後の BMVert.link_loops と同じ順番に並べるインデックスを返す
+
+    link_loops は頂点の周りの辺を作られた順に1周し、辺ごとにその頂点から出ていくループを
+    最後に追加された面のもの、残りを追加された順、の順番で返す。
+    1周の始まりは面のある最初の辺の最後のループだが、それが反対側の頂点のものなら、その次のループから始まる。
+    """
+    loop_count = len(loop_vertex_indices)
+    if not loop_count:
+        return np.empty(0, dtype=np.intp)
+    next_loops = np.arange(1, loop_count + 1)
+    next_loops[polygon_loop_starts + polygon_loop_totals - 1] = polygon_loop_starts
+    vertex_count = loop_vertex_indices.max() + 1
+    edge_count = loop_edge_indices.max() + 1
+
+    # 辺ごとのループの並び (radial) での順位
+    by_edge = np.argsort(loop_edge_indices, kind='stable')
+    sorted_edges = loop_edge_indices[by_edge]
+    edge_loop_totals = np.bincount(loop_edge_indices, minlength=edge_count)
+    ranks = np.arange(loop_count) - (np.cumsum(edge_loop_totals) - edge_loop_totals)[sorted_edges]
+    radial_ranks = np.empty(loop_count, dtype=np.int64)
+    radial_ranks[by_edge] = np.where(ranks == edge_loop_totals[sorted_edges] - 1, 0, ranks + 1)
+    edge_last_loops = np.full(edge_count, -1, dtype=np.int64)
+    np.maximum.at(edge_last_loops, loop_edge_indices, np.arange(loop_count))
+
+    # 頂点ごとの1周の始まりのループ
+    first_edges = np.full(vertex_count, edge_count, dtype=np.int64)
+    np.minimum.at(first_edges, loop_vertex_indices, loop_edge_indices)
+    np.minimum.at(first_edges, loop_vertex_indices[next_loops], loop_edge_indices)
+    first_loops = np.zeros(vertex_count, dtype=np.int64)
+    used_verts = np.flatnonzero(first_edges < edge_count)
+    first_loops[used_verts] = edge_last_loops[first_edges[used_verts]]
+    is_other_side = loop_vertex_indices[first_loops[used_verts]] != used_verts
+    first_loops[used_verts[is_other_side]] = next_loops[first_loops[used_verts[is_other_side]]]
+    first_edges = loop_edge_indices[first_loops]
+
+    # 始まりの辺より前の辺は1周の最後に、始まりの辺では始まりのループより前のループが最後になる
+    loop_first_loops = first_loops[loop_vertex_indices]
+    edge_keys = loop_edge_indices + np.where(loop_edge_indices < first_edges[loop_vertex_indices], edge_count, 0)
+    is_first_edge = loop_edge_indices == first_edges[loop_vertex_indices]
+    radial_ranks[is_first_edge] = (radial_ranks - radial_ranks[loop_first_loops])[is_first_edge] % edge_loop_totals[loop_edge_indices[is_first_edge]]
+    return np.lexsort((radial_ranks, edge_keys, loop_vertex_indices))
+
+
+def split_sharp_edges(loop_vertex_indices, loop_edge_indices, polygon_loop_starts, polygon_loop_totals, edge_vertices, edge_is_sharp, vertex_count):
+    """シャープな辺で頂点を分割した場合の頂点の対応を返す (bmesh.ops.split_edges と同じ分け方・同じ順番)
+
+    頂点の周りのループを、シャープでない辺でつながっているまとまりごとに別の頂点にする。
+    面の無い辺もそれぞれ別のまとまりになる。
+    bmesh と同じく、元の頂点のインデックスはそのままで、新しい頂点は末尾に追加される。
+    頂点はシャープな辺の順に、まとまりは頂点の周りの辺が作られた順に処理され、最後のまとまりが元の頂点を使う。
+    戻り値は (分割後の頂点ごとの元の頂点インデックス, ループごとの分割後の頂点インデックス, ループごとの分割後の辺インデックス)
+    分割後の辺も bmesh と同じく、元の辺のインデックスはそのままで、新しい辺は末尾に追加される。
+    3つ以上の面がある辺では、bmesh と分け方や順番が異なることがある。
+    """
+    loop_count = len(loop_vertex_indices)
+    edge_count = len(edge_vertices)
+    loop_indices = np.arange(loop_count)
+    prev_loops = loop_indices - 1
+    prev_loops[polygon_loop_starts] = polygon_loop_starts + polygon_loop_totals - 1
+    next_loops = loop_indices + 1
+    next_loops[polygon_loop_starts + polygon_loop_totals - 1] = polygon_loop_starts
+    loop_polygons = np.repeat(np.arange(len(polygon_loop_starts)), polygon_loop_totals)
+
+    # シャープな辺は面ごとに別の辺になる (BM_edge_separate と同じく、後から作った面のループから順に新しい辺へ移る)
+    # まとまりを求めるために、ここではすべてのシャープな辺を仮の番号で分けておく
+    loop_copies = loop_edge_indices.astype(np.int64)
+    sharp_loops = np.flatnonzero(edge_is_sharp[loop_edge_indices])
+    sharp_loops = sharp_loops[np.lexsort((loop_polygons[sharp_loops], loop_edge_indices[sharp_loops]))]
+    sharp_edges = loop_edge_indices[sharp_loops]
+    sharp_starts = np.flatnonzero(np.r_[True, sharp_edges[1:] != sharp_edges[:-1]]) if len(sharp_loops) else np.empty(0, dtype=np.intp)
+    sharp_totals = np.diff(np.r_[sharp_starts, len(sharp_loops)])
+    ranks = np.arange(len(sharp_loops)) - np.repeat(sharp_starts, sharp_totals)
+    totals = np.repeat(sharp_totals, sharp_totals)
+    is_moved = (ranks != totals - 2) & (totals > 1)
+    moved_loops = sharp_loops[is_moved]
+    moved_order = np.lexsort((np.where(ranks == totals - 1, 0, ranks + 1)[is_moved], sharp_edges[is_moved]))
+    loop_copies[moved_loops[moved_order]] = edge_count + np.arange(len(moved_loops))
+    copy_edges = np.concatenate((np.arange(edge_count), sharp_edges[is_moved][moved_order]))
+    prev_copies = loop_copies[prev_loops]
+
+    # ループの角の両側の辺を (辺, どちらの端か) の番号にする
+    next_keys = loop_copies * 2 + (edge_vertices[copy_edges[loop_copies], 1] == loop_vertex_indices)
+    prev_keys = prev_copies * 2 + (edge_vertices[copy_edges[prev_copies], 1] == loop_vertex_indices)
+
+    # シャープな辺に接する頂点のループだけを分ける
+    is_split_vert = np.zeros(vertex_count, dtype=bool)
+    is_split_vert[edge_vertices[edge_is_sharp].ravel()] = True
+    target_loops = np.flatnonzero(is_split_vert[loop_vertex_indices])
+    node_loops = np.concatenate((target_loops, target_loops))
+    node_keys = np.concatenate((next_keys[target_loops], prev_keys[target_loops]))
+
+    # 同じ辺の端を共有するループに最小のラベルを伝える
+    labels = np.full(loop_count, -1, dtype=np.int64)
+    labels[target_loops] = target_loops
+    key_labels = np.empty(len(copy_edges) * 2, dtype=np.int64)
+    while True:
+        key_labels.fill(loop_count)
+        np.minimum.at(key_labels, node_keys, labels[node_loops])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, node_loops, key_labels[node_keys])
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    fan_keys = np.empty(len(target_loops), dtype=[('vert', np.int64), ('label', np.int64)])
+    fan_keys['vert'] = loop_vertex_indices[target_loops]
+    fan_keys['label'] = labels[target_loops]
+    fans, loop_fans = np.unique(fan_keys, return_inverse=True)
+    loop_fans = loop_fans.ravel()
+
+    # 面の無い辺はそれぞれ1つのまとまりになる
+    is_loose_edge = np.ones(edge_count, dtype=bool)
+    is_loose_edge[loop_edge_indices] = False
+    loose_edges = np.repeat(np.flatnonzero(is_loose_edge), 2)
+    loose_ends = edge_vertices[is_loose_edge].ravel()
+    is_target = is_split_vert[loose_ends]
+    fan_verts = np.concatenate((fans['vert'], loose_ends[is_target]))
+
+    # 頂点はシャープな辺に最初に出てくる順に分割する
+    sharp_ends = edge_vertices[edge_is_sharp].ravel()
+    _, first_indices = np.unique(sharp_ends, return_index=True)
+    vert_orders = np.zeros(vertex_count, dtype=np.int64)
+    vert_orders[sharp_ends[np.sort(first_indices)]] = np.arange(len(first_indices))
+
+    # 実際に面ごとに分かれるのは、端の頂点のどちらかで両側の面が別のまとまりになる辺だけ
+    # 新しい辺は、先に分かれる端の頂点の周りの辺の順に作られる
+    edge_orders = np.full(edge_count, vertex_count, dtype=np.int64)
+    for end in range(2):
+        end_verts = edge_vertices[sharp_edges, end]
+        corner_labels = labels[np.where(loop_vertex_indices[sharp_loops] == end_verts, sharp_loops, next_loops[sharp_loops])]
+        min_labels = np.full(edge_count, loop_count, dtype=np.int64)
+        np.minimum.at(min_labels, sharp_edges, corner_labels)
+        max_labels = np.full(edge_count, -1, dtype=np.int64)
+        np.maximum.at(max_labels, sharp_edges, corner_labels)
+        is_separated = (min_labels != max_labels) & (max_labels >= 0)
+        edge_orders[is_separated] = np.minimum(edge_orders, vert_orders[edge_vertices[:, end]])[is_separated]
+    is_moved &= edge_orders[sharp_edges] < vertex_count
+    moved_loops = sharp_loops[is_moved]
+    moved_order = np.lexsort((np.where(ranks == totals - 1, 0, ranks + 1)[is_moved], sharp_edges[is_moved], edge_orders[sharp_edges[is_moved]]))
+    loop_copies = loop_edge_indices.astype(np.int64)
+    loop_copies[moved_loops[moved_order]] = edge_count + np.arange(len(moved_loops))
+    prev_copies = loop_copies[prev_loops]
+
+    # まとまりごとに、含まれる辺のうち最初に作られたもの (頂点の周りの辺の順番)
+    fan_first_edges = np.full(len(fans), edge_count + len(moved_loops), dtype=np.int64)
+    np.minimum.at(fan_first_edges, loop_fans, np.minimum(loop_copies, prev_copies)[target_loops])
+    fan_first_edges = np.concatenate((fan_first_edges, loose_edges[is_target]))
+
+    # 頂点ごとの最後のまとまりは元の頂点のまま、それ以外は末尾に追加する
+    fan_order = np.lexsort((fan_first_edges, vert_orders[fan_verts]))
+    sorted_verts = fan_verts[fan_order]
+    is_last = np.ones(len(sorted_verts), dtype=bool)
+    is_last[:-1] = sorted_verts[1:] != sorted_verts[:-1]
+    new_fans = fan_order[~is_last]
+    fan_split_verts = fan_verts.copy()
+    fan_split_verts[new_fans] = vertex_count + np.arange(len(new_fans))
+
+    loop_verts = loop_vertex_indices.astype(np.int64)
+    loop_verts[target_loops] = fan_split_verts[loop_fans]
+    return np.concatenate((np.arange(vertex_count), fan_verts[new_fans])), loop_verts, loop_copies
+
+
+class MeshData(abc.ABC):
+    """modelファイルに書き出すメッシュの配列をまとめたクラス
+
+    頂点・ループ・面ごとの配列と、シェイプキーの座標と法線を読み込むメソッドを持つ。
+    シェイプキーの読み込み方はサブクラスで実装する。
+    """
+    def __init__(self):
+        self.vertex_cos = None                 # 頂点の座標 (頂点数, 3)
+        self.vertex_normals = None             # 頂点の法線 (頂点数, 3)
+        self.weight_counts = None              # 頂点ごとの頂点グループの割り当て数
+        self.weight_groups = None              # 割り当てごとの頂点グループのインデックス
+        self.weight_values = None              # 割り当てごとのウェイト
+        self.loop_vertex_indices = None        # ループごとの頂点インデックス
+        self.loop_uvs = None                   # ループごとのUV (ループ数, 2)
+        self.loop_normals = None               # ループごとの法線 (カスタム法線がある場合のみ)
+        self.loop_edge_indices = None          # ループごとの辺インデックス (link_loops の順番とシャープな辺の分割に使う)
+        self.edge_vertices = None              # 辺ごとの頂点インデックス (辺の数, 2) (シャープな辺を分割した後は None)
+        self.edge_is_sharp = None              # 辺ごとのシャープかどうか (シャープな辺を分割した後は None)
+        self.polygon_loop_starts = None        # 面ごとの最初のループ
+        self.polygon_loop_totals = None        # 面ごとのループ数
+        self.polygon_material_indices = None   # 面ごとの材質インデックス
+        self.triangle_loops = None             # 三角形ごとのループ (三角形数, 3)
+        self.triangle_polygon_indices = None   # 三角形ごとの元の面
+        self.has_custom_normals = False
+        self.vertex_group_names = []
+        self.materials = []
+        self.shape_key_names = []              # 基本のシェイプキーを除く
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.vertex_cos)
+
+    @property
+    def loop_count(self) -> int:
+        return len(self.loop_vertex_indices)
+
+    def link_loop_order(self) -> np.ndarray | None:
+        """ループを BMVert.link_loops の順番に並べるインデックス、辺を読み込んでいなければ None"""
+        if self.loop_edge_indices is None:
+            return None
+        return link_loop_order(self.loop_vertex_indices, self.loop_edge_indices, self.polygon_loop_starts, self.polygon_loop_totals)
+
+    def read_mesh(self, me: bpy.types.Mesh, uv_layer_name: str | None = None, use_loop_normals: bool | None = None, use_edges: bool = False):
+        """me の頂点・ループ・面の配列を読み込む"""
+        vert_count = len(me.vertices)
+        self.vertex_cos = np.empty((vert_count, 3), dtype=np.float32)
+        me.vertices.foreach_get('co', self.vertex_cos.ravel())
+        self.vertex_normals = np.empty((vert_count, 3), dtype=np.float32)
+        me.vertices.foreach_get('normal', self.vertex_normals.ravel())
+        self.weight_counts, self.weight_groups, self.weight_values = read_vertex_groups(me)
+
+        loop_count = len(me.loops)
+        self.loop_vertex_indices = np.empty(loop_count, dtype=np.int32)
+        me.loops.foreach_get('vertex_index', self.loop_vertex_indices)
+        uv_layer = me.uv_layers.active if uv_layer_name is None else me.uv_layers.get(uv_layer_name)
+        self.loop_uvs = np.zeros((loop_count, 2), dtype=np.float32)
+        if uv_layer:
+            uv_layer.data.foreach_get('uv', self.loop_uvs.ravel())
+        self.has_custom_normals = me.has_custom_normals
+        if use_loop_normals is None:
+            use_loop_normals = self.has_custom_normals
+        self.loop_normals = read_loop_normals(me) if use_loop_normals else None
+
+        if use_edges:
+            self.loop_edge_indices = np.empty(loop_count, dtype=np.int32)
+            me.loops.foreach_get('edge_index', self.loop_edge_indices)
+            self.edge_vertices = np.empty((len(me.edges), 2), dtype=np.int32)
+            me.edges.foreach_get('vertices', self.edge_vertices.ravel())
+            self.edge_is_sharp = np.empty(len(me.edges), dtype=bool)
+            me.edges.foreach_get('use_edge_sharp', self.edge_is_sharp)
+
+        poly_count = len(me.polygons)
+        self.polygon_loop_starts = np.empty(poly_count, dtype=np.int32)
+        me.polygons.foreach_get('loop_start', self.polygon_loop_starts)
+        self.polygon_loop_totals = np.empty(poly_count, dtype=np.int32)
+        me.polygons.foreach_get('loop_total', self.polygon_loop_totals)
+        self.polygon_material_indices = np.empty(poly_count, dtype=np.int32)
+        me.polygons.foreach_get('material_index', self.polygon_material_indices)
+
+        me.calc_loop_triangles()
+        tri_count = len(me.loop_triangles)
+        self.triangle_loops = np.empty((tri_count, 3), dtype=np.int32)
+        me.loop_triangles.foreach_get('loops', self.triangle_loops.ravel())
+        self.triangle_polygon_indices = np.empty(tri_count, dtype=np.int32)
+        me.loop_triangles.foreach_get('polygon_index', self.triangle_polygon_indices)
+
+    @abc.abstractmethod
+    def shape_key_cos(self, index: int, out: np.ndarray) -> np.ndarray:
+        """shape_key_names[index] のシェイプキーの頂点座標を out に読み込む"""
+
+    @abc.abstractmethod
+    def shape_key_vertex_normals(self, index: int, out: np.ndarray) -> np.ndarray:
+        """shape_key_names[index] のシェイプキーの頂点法線を out に読み込む"""
+
+    @abc.abstractmethod
+    def shape_key_loop_normals(self, index: int, out: np.ndarray) -> np.ndarray:
+        """shape_key_names[index] のシェイプキーのループごとの法線を out に読み込む"""
+
+    @abc.abstractmethod
+    def delta_normals(self, name: str, out: np.ndarray) -> np.ndarray | None:
+        """属性 name に保存されたループごとの法線の差分を out に読み込む、無ければ None"""
+
+    def free(self):
+        """読み込みのために変更した状態を元に戻す"""
+        pass
+
+
+class ObjectMeshData(MeshData):
+    """1つのメッシュオブジェクトをそのまま読み込む"""
+    def __init__(self, ob: bpy.types.Object):
+        super().__init__()
+        me = ob.data
+        self.mesh = me
+        self.read_mesh(me, use_edges=True)
+        self.vertex_group_names = [vg.name for vg in ob.vertex_groups]
+        self.materials = [slot.material for slot in ob.material_slots]
+        self.key_blocks = me.shape_keys.key_blocks[1:] if me.shape_keys else []
+        self.shape_key_names = [shape_key.name for shape_key in self.key_blocks]
+
+    def shape_key_cos(self, index, out):
+        self.key_blocks[index].data.foreach_get('co', out.ravel())
+        return out
+
+    def shape_key_vertex_normals(self, index, out):
+        np.copyto(out.ravel(), self.key_blocks[index].normals_vertex_get())
+        return out
+
+    def shape_key_loop_normals(self, index, out):
+        np.copyto(out.ravel(), self.key_blocks[index].normals_split_get())
+        return out
+
+    def delta_normals(self, name, out):
+        return read_delta_normals(self.mesh, name, out)
+
+
+class PartMeshData(MeshData):
+    """EvaluatedMeshData が結合する前の1つのオブジェクト分の配列 (シェイプキーは EvaluatedMeshData が読み込む)"""
+    def __init__(self):
+        super().__init__()
+        self.delta_normal_arrays = {}  # 属性名 → ループごとの法線の差分
+
+    def shape_key_cos(self, index, out):
+        raise NotImplementedError()
+
+    def shape_key_vertex_normals(self, index, out):
+        raise NotImplementedError()
+
+    def shape_key_loop_normals(self, index, out):
+        raise NotImplementedError()
+
+    def delta_normals(self, name, out):
+        delta_normals = self.delta_normal_arrays.get(name)
+        if delta_normals is None:
+            return None
+        out[:] = delta_normals
+        return out
+
+
+class EvaluatedMeshData(MeshData):
+    """複数のメッシュオブジェクトのモディファイア適用後の状態を読み込み、メモリ上で結合する
+
+    ・オブジェクトは main_ob のローカル座標に変換してから matrix を掛ける (join と同じ)
+    ・頂点グループは名前で、材質はマテリアルでまとめる (join と同じ)
+    ・モディファイアのあるオブジェクトのシェイプキーは、そのキーだけを表示した状態で1つずつ評価する
+    ・split_sharp が有効な場合は、シャープな辺で頂点を分割した状態にする
+    ・頂点グループをミラーするミラーモディファイアがあれば、反対側の頂点グループを読み込む間だけ追加する
+
+    読み込み中は元のオブジェクトを一時的に変更する。
+    追加した頂点グループは __init__ の中で、失敗した場合も含めて削除する。
+    シェイプキーの表示 (show_only_shape_key, active_shape_key_index) はシェイプキーを読むたびに変更したままにするので、
+    使い終わったら free() で元に戻すこと (read_shape_key が失敗した場合はその場で元に戻す)。
+    """
+    def __init__(self, context, objects, main_ob: bpy.types.Object, apply_modifiers=True, matrix=None, split_sharp=False):
+        super().__init__()
+        self.depsgraph = context.evaluated_depsgraph_get()
+        self.apply_modifiers = apply_modifiers
+        self.objects = [main_ob] + [ob for ob in objects if ob != main_ob and ob.type == 'MESH']
+        main_inverse = main_ob.matrix_world.inverted()
+        self.matrices = []
+        for ob in self.objects:
+            # 結合先のオブジェクト自身はそのまま
+            mat = mathutils.Matrix.Identity(4) if ob == main_ob else compat.mul(main_inverse, ob.matrix_world)
+            if matrix is not None:
+                mat = compat.mul(matrix, mat)
+            self.matrices.append(mat)
+        self.uv_layer_name = main_ob.data.uv_layers.active.name
+        self.__pinned_states = {}   # オブジェクトのインデックス → (show_only_shape_key, active_shape_key_index)
+        self.__shape_key_cache = (None, None)
+
+        # シェイプキーは全オブジェクトの名前をまとめる
+        for ob in self.objects:
+            if ob.data.shape_keys:
+                for shape_key in ob.data.shape_keys.key_blocks[1:]:
+                    if shape_key.name not in self.shape_key_names:
+                        self.shape_key_names.append(shape_key.name)
+
+        self.has_custom_normals = any(ob.data.has_custom_normals for ob in self.objects)
+        added_vertex_groups = []
+        try:
+            self.add_mirrored_vertex_groups(added_vertex_groups)
+            self.parts = [self.read_object(index) for index in range(len(self.objects))]
+            self.join_parts(split_sharp)
+        finally:
+            try:
+                # 一時的に追加した頂点グループを削除する (ウェイトは読み込み済み)
+                for ob, names in added_vertex_groups:
+                    if not names:
+                        continue
+                    active_index = ob.vertex_groups.active_index
+                    for name in names:
+                        ob.vertex_groups.remove(ob.vertex_groups[name])
+                    ob.vertex_groups.active_index = min(active_index, len(ob.vertex_groups) - 1)
+            finally:
+                # シェイプキーの表示はその都度変更するので、ここで一度元に戻す
+                self.free()
+                if any(names for ob, names in added_vertex_groups):
+                    self.depsgraph.update()
+
+    def add_mirrored_vertex_groups(self, added_vertex_groups: list):
+        """頂点グループをミラーするミラーモディファイアのために、反対側の頂点グループを追加する
+
+        モディファイアを適用する場合 (forced_modifier_apply) と同じく、無い頂点グループはミラーされないため。
+        途中で失敗しても削除できるように、追加するたびに added_vertex_groups の (オブジェクト, 追加した頂点グループ名のリスト) に記録する。
+        """
+        replace_list = ((r'\.L$', ".R"), (r'\.R$', ".L"), (r'\.l$', ".r"), (r'\.r$', ".l"), (r'_L$', "_R"), (r'_R$', "_L"), (r'_l$', "_r"), (r'_r$', "_l"))
+        for ob in self.objects:
+            if not self.is_evaluated(ob):
+                continue
+            if not any(mod.show_viewport and mod.type == 'MIRROR' and mod.use_mirror_vertex_groups for mod in ob.modifiers):
+                continue
+            names = []
+            added_vertex_groups.append((ob, names))
+            for vg in ob.vertex_groups[:]:
+                for before, after in replace_list:
+                    mirrored_name = re.sub(before, after, vg.name)
+                    if mirrored_name not in ob.vertex_groups:
+                        ob.vertex_groups.new(name=mirrored_name)
+                        names.append(mirrored_name)
+            if names:
+                ob.update_tag()
+        if any(names for ob, names in added_vertex_groups):
+            self.depsgraph.update()
+
+    def is_evaluated(self, ob: bpy.types.Object) -> bool:
+        """ob をモディファイア適用後の状態で読み込むか"""
+        return self.apply_modifiers and any(mod.show_viewport for mod in ob.modifiers)
+
+    def evaluate(self, index: int, key_index: int, read):
+        """index 番目のオブジェクトの key_index 番目のシェイプキーだけを表示した状態のメッシュを read(me) に渡す"""
+        ob = self.objects[index]
+        if not self.is_evaluated(ob):
+            return read(ob.data)
+        if ob.data.shape_keys:
+            if index not in self.__pinned_states:
+                self.__pinned_states[index] = (ob.show_only_shape_key, ob.active_shape_key_index)
+            if not ob.show_only_shape_key or ob.active_shape_key_index != key_index:
+                ob.show_only_shape_key = True
+                ob.active_shape_key_index = key_index
+                self.depsgraph.update()
+        ob_eval = ob.evaluated_get(self.depsgraph)
+        me = ob_eval.to_mesh(preserve_all_data_layers=True, depsgraph=self.depsgraph)
+        try:
+            return read(me)
+        finally:
+            ob_eval.to_mesh_clear()
+
+    def read_object(self, index: int) -> PartMeshData:
+        """index 番目のオブジェクトを読み込み、結合先の座標に変換する"""
+        ob = self.objects[index]
+        part = PartMeshData()
+
+        def read(me):
+            part.read_mesh(me, self.uv_layer_name, use_loop_normals=self.has_custom_normals, use_edges=True)
+            # 法線の差分はループごとの色なので座標変換しない (join でも変換されない)
+            for name in self.shape_key_names:
+                attribute_name = f'{name}_delta_normals'
+                delta_normals = np.empty((len(me.loops), 3), dtype=np.float64)
+                if read_delta_normals(me, attribute_name, delta_normals) is not None:
+                    part.delta_normal_arrays[attribute_name] = delta_normals
+
+        self.evaluate(index, 0, read)
+        part.vertex_group_names = [vg.name for vg in ob.vertex_groups]
+        part.materials = [slot.material for slot in ob.material_slots]
+        part.vertex_cos, part.vertex_normals, part.loop_normals = self.transform(index, part.vertex_cos, part.vertex_normals, part.loop_normals)
+        return part
+
+    def transform(self, index: int, cos, vertex_normals, loop_normals):
+        """index 番目のオブジェクトの座標と法線を結合先の座標に変換する"""
+        mat = self.matrices[index]
+        if mat == mathutils.Matrix.Identity(4):
+            return cos, vertex_normals, loop_normals
+        rot = np.array(mat.to_3x3(), dtype=np.float64)
+        loc = np.array(mat.translation, dtype=np.float64)
+        normal_mat = np.array(mat.to_3x3().inverted_safe().transposed(), dtype=np.float64)
+
+        def transform_normals(normals):
+            if normals is None:
+                return None
+            normals = normals @ normal_mat.T
+            lengths = np.linalg.norm(normals, axis=1)
+            np.divide(normals, lengths[:, np.newaxis], out=normals, where=lengths[:, np.newaxis] > 0)
+            return normals.astype(np.float32)
+
+        cos = (cos @ rot.T + loc).astype(np.float32)
+        return cos, transform_normals(vertex_normals), transform_normals(loop_normals)
+
+    def join_parts(self, split_sharp: bool):
+        """読み込んだオブジェクトを1つのメッシュの配列にまとめる"""
+        parts = self.parts
+        vert_offsets = np.cumsum([0] + [len(part.vertex_cos) for part in parts])
+        loop_offsets = np.cumsum([0] + [len(part.loop_vertex_indices) for part in parts])
+        poly_offsets = np.cumsum([0] + [len(part.polygon_loop_starts) for part in parts])
+        edge_offsets = np.cumsum([0] + [len(part.edge_vertices) for part in parts])
+
+        # 頂点グループは名前で、材質はマテリアルでまとめる
+        weight_groups = []
+        material_indices = []
+        for part in parts:
+            group_map = []
+            for name in part.vertex_group_names:
+                if name not in self.vertex_group_names:
+                    self.vertex_group_names.append(name)
+                group_map.append(self.vertex_group_names.index(name))
+            group_map = np.array(group_map + [-1], dtype=np.int64)
+            weight_groups.append(group_map[np.minimum(part.weight_groups, len(part.vertex_group_names))])
+
+            material_map = []
+            for mat in part.materials:
+                if mat not in self.materials:
+                    self.materials.append(mat)
+                material_map.append(self.materials.index(mat))
+            # スロットの無い材質インデックスの面は出力しない
+            material_map = np.array(material_map + [-1], dtype=np.int32)
+            material_indices.append(material_map[np.minimum(part.polygon_material_indices, len(part.materials))])
+        self.weight_groups = np.concatenate(weight_groups)
+        # 存在しない頂点グループは名前の数以上のインデックスにしておく
+        self.weight_groups[self.weight_groups < 0] = len(self.vertex_group_names)
+        self.polygon_material_indices = np.concatenate(material_indices)
+
+        self.vertex_cos = np.concatenate([part.vertex_cos for part in parts])
+        self.vertex_normals = np.concatenate([part.vertex_normals for part in parts])
+        self.weight_counts = np.concatenate([part.weight_counts for part in parts])
+        self.weight_values = np.concatenate([part.weight_values for part in parts])
+        self.loop_vertex_indices = np.concatenate([part.loop_vertex_indices + offset for part, offset in zip(parts, vert_offsets)])
+        self.loop_uvs = np.concatenate([part.loop_uvs for part in parts])
+        if self.has_custom_normals:
+            self.loop_normals = np.concatenate([part.loop_normals for part in parts])
+        self.polygon_loop_starts = np.concatenate([part.polygon_loop_starts + offset for part, offset in zip(parts, loop_offsets)])
+        self.polygon_loop_totals = np.concatenate([part.polygon_loop_totals for part in parts])
+        self.triangle_loops = np.concatenate([part.triangle_loops + offset for part, offset in zip(parts, loop_offsets)])
+        self.triangle_polygon_indices = np.concatenate([part.triangle_polygon_indices + offset for part, offset in zip(parts, poly_offsets)])
+        self.loop_edge_indices = np.concatenate([part.loop_edge_indices + offset for part, offset in zip(parts, edge_offsets)])
+        self.edge_vertices = np.concatenate([part.edge_vertices + offset for part, offset in zip(parts, vert_offsets)])
+        self.edge_is_sharp = np.concatenate([part.edge_is_sharp for part in parts])
+
+        # 分割後の頂点ごとの結合後の頂点インデックス
+        self.vertex_sources = None
+        self.split_vertex_indices = None
+        if split_sharp and self.edge_is_sharp.any():
+            vert_sources, loop_verts, loop_edges = split_sharp_edges(
+                self.loop_vertex_indices, self.loop_edge_indices, self.polygon_loop_starts, self.polygon_loop_totals,
+                self.edge_vertices, self.edge_is_sharp, len(self.vertex_cos),
+            )
+            # 頂点が分かれなくてもシャープな辺は面ごとに分かれる
+            # 分割後の辺の頂点は求めていないので、辺ごとの配列は使えなくする
+            self.loop_edge_indices = loop_edges.astype(np.int32)
+            self.edge_vertices = None
+            self.edge_is_sharp = None
+            if len(vert_sources) != len(self.vertex_cos):
+                self.vertex_sources = vert_sources
+                self.split_vertex_indices = np.flatnonzero(np.bincount(vert_sources, minlength=len(self.vertex_cos))[vert_sources] > 1)
+                self.loop_vertex_indices = loop_verts.astype(np.int32)
+                self.vertex_cos = self.vertex_cos[vert_sources]
+                self.vertex_normals = self.recalc_normals(self.vertex_cos, self.vertex_normals[vert_sources])
+
+                # 頂点グループの割り当ても頂点と一緒に複製する
+                weight_starts = np.cumsum(self.weight_counts) - self.weight_counts
+                counts = self.weight_counts[vert_sources]
+                members = np.repeat(weight_starts[vert_sources] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+                self.weight_counts = counts
+                self.weight_groups = self.weight_groups[members]
+                self.weight_values = self.weight_values[members]
+
+    def recalc_normals(self, cos, normals):
+        """分割した頂点の法線を分割後の面から計算し直す"""
+        return calc_vertex_normals(
+            cos, self.loop_vertex_indices, self.polygon_loop_starts, self.polygon_loop_totals,
+            normals, self.split_vertex_indices,
+        ).astype(np.float32, copy=False)
+
+    def read_shape_key(self, index: int):
+        """shape_key_names[index] のシェイプキーの (頂点座標, 頂点法線, ループごとの法線) を返す"""
+        cached_index, cached = self.__shape_key_cache
+        if cached_index == index:
+            return cached
+        name = self.shape_key_names[index]
+
+        try:
+            cos, vert_normals, loop_normals = self.read_shape_key_parts(name)
+        except BaseException:
+            # 失敗した場合は、変更したシェイプキーの表示をその場で元に戻す
+            self.free()
+            raise
+
+        cos = np.concatenate(cos)
+        vert_normals = np.concatenate(vert_normals)
+        loop_normals = np.concatenate(loop_normals) if self.has_custom_normals else None
+        if self.vertex_sources is not None:
+            cos = cos[self.vertex_sources]
+            vert_normals = self.recalc_normals(cos, vert_normals[self.vertex_sources])
+        self.__shape_key_cache = (index, (cos, vert_normals, loop_normals))
+        return cos, vert_normals, loop_normals
+
+    def read_shape_key_parts(self, name: str):
+        """オブジェクトごとのシェイプキー name の (頂点座標, 頂点法線, ループごとの法線) のリストを返す"""
+        cos, vert_normals, loop_normals = [], [], []
+        for part_index, (ob, part) in enumerate(zip(self.objects, self.parts)):
+            key_blocks = ob.data.shape_keys.key_blocks if ob.data.shape_keys else None
+            if key_blocks is None or name not in key_blocks:
+                # シェイプキーの無いオブジェクトは基本の形のまま
+                cos.append(part.vertex_cos)
+                vert_normals.append(part.vertex_normals)
+                loop_normals.append(part.loop_normals)
+                continue
+
+            def read(me):
+                if len(me.vertices) != len(part.vertex_cos):
+                    raise common.CM3D2ExportError(f_tip_("The vertex count of shape key \"{}\" on \"{}\" does not match its basis", name, ob.name))
+                if self.is_evaluated(ob):
+                    sk_cos = np.empty((len(me.vertices), 3), dtype=np.float32)
+                    me.vertices.foreach_get('co', sk_cos.ravel())
+                    sk_normals = np.empty((len(me.vertices), 3), dtype=np.float32)
+                    me.vertices.foreach_get('normal', sk_normals.ravel())
+                    sk_loop_normals = read_loop_normals(me) if self.has_custom_normals else None
+                else:
+                    shape_key = key_blocks[name]
+                    sk_cos = np.empty((len(me.vertices), 3), dtype=np.float32)
+                    shape_key.data.foreach_get('co', sk_cos.ravel())
+                    sk_normals = np.array(shape_key.normals_vertex_get(), dtype=np.float32).reshape((-1, 3))
+                    sk_loop_normals = None
+                    if self.has_custom_normals:
+                        sk_loop_normals = np.array(shape_key.normals_split_get(), dtype=np.float32).reshape((-1, 3))
+                return sk_cos, sk_normals, sk_loop_normals
+
+            sk_cos, sk_normals, sk_loop_normals = self.transform(part_index, *self.evaluate(part_index, key_blocks.find(name), read))
+            cos.append(sk_cos)
+            vert_normals.append(sk_normals)
+            loop_normals.append(sk_loop_normals)
+
+        return cos, vert_normals, loop_normals
+
+    def shape_key_cos(self, index, out):
+        out[:] = self.read_shape_key(index)[0]
+        return out
+
+    def shape_key_vertex_normals(self, index, out):
+        out[:] = self.read_shape_key(index)[1]
+        return out
+
+    def shape_key_loop_normals(self, index, out):
+        out[:] = self.read_shape_key(index)[2]
+        return out
+
+    def delta_normals(self, name, out):
+        if not any(name in part.delta_normal_arrays for part in self.parts):
+            return None
+        offset = 0
+        for part in self.parts:
+            count = len(part.loop_vertex_indices)
+            if name in part.delta_normal_arrays:
+                out[offset:offset + count] = part.delta_normal_arrays[name]
+            else:
+                out[offset:offset + count] = 0
+            offset += count
+        return out
+
+    def free(self):
+        self.__shape_key_cache = (None, None)
+        if not self.__pinned_states:
+            return
+        for index, (show_only_shape_key, active_shape_key_index) in self.__pinned_states.items():
+            ob = self.objects[index]
+            ob.show_only_shape_key = show_only_shape_key
+            ob.active_shape_key_index = active_shape_key_index
+        self.__pinned_states = {}
+        self.depsgraph.update()
+
+
+class SnapshotMeshData(MeshData):
+    """他の MeshData のシェイプキーまで配列に読み込んだ複製、別スレッドから bpy に触れずに使える"""
+    def __init__(self, source: MeshData, delta_normal_names=(), use_normals=True):
+        super().__init__()
+        self.__dict__.update((key, value) for key, value in vars(source).items() if key in vars(self))
+        self.vertex_group_names = list(source.vertex_group_names)
+        self.materials = list(source.materials)
+        self.shape_key_names = list(source.shape_key_names)
+
+        vert_shape = (source.vertex_count, 3)
+        loop_shape = (source.loop_count, 3)
+        self.key_cos = [source.shape_key_cos(index, np.empty(vert_shape, dtype=float)) for index in range(len(self.shape_key_names))]
+        self.key_vertex_normals = []
+        self.key_loop_normals = []
+        if use_normals and source.has_custom_normals:
+            self.key_loop_normals = [source.shape_key_loop_normals(index, np.empty(loop_shape, dtype=float)) for index in range(len(self.shape_key_names))]
+        elif use_normals:
+            self.key_vertex_normals = [source.shape_key_vertex_normals(index, np.empty(vert_shape, dtype=float)) for index in range(len(self.shape_key_names))]
+        self.key_delta_normals = {name: source.delta_normals(name, np.empty(loop_shape, dtype=float)) for name in delta_normal_names}
+
+    def shape_key_cos(self, index, out):
+        out[:] = self.key_cos[index]
+        return out
+
+    def shape_key_vertex_normals(self, index, out):
+        out[:] = self.key_vertex_normals[index]
+        return out
+
+    def shape_key_loop_normals(self, index, out):
+        out[:] = self.key_loop_normals[index]
+        return out
+
+    def delta_normals(self, name, out):
+        delta_normals = self.key_delta_normals.get(name)
+        if delta_normals is None:
+            return None
+        out[:] = delta_normals
+        return out
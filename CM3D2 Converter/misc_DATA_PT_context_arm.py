@@ -10,6 +10,7 @@ import mathutils
 import os
 from . import common
 from . import compat
+from . import bone_data_property
 from .translations.pgettext_functions import *
 
 
@@ -24,10 +25,8 @@ def menu_func(self, context):
     is_boxed = False
 
     bone_data_count = 0
-    if 'BoneData:0' in arm and 'LocalBoneData:0' in arm:
-        for key in arm.keys():
-            if re.search(r'^(Local)?BoneData:\d+$', key):
-                bone_data_count += 1
+    if bone_data_property.has_bone_data(arm):
+        bone_data_count = bone_data_property.count_bone_data(arm)
     enabled_clipboard = False
     clipboard = context.window_manager.clipboard
     if 'BoneData:' in clipboard and 'LocalBoneData:' in clipboard:
@@ -51,6 +50,8 @@ def menu_func(self, context):
         row.operator('object.copy_armature_bone_data_property', icon='COPYDOWN', text="コピー")
         row.operator('object.paste_armature_bone_data_property', icon='PASTEDOWN', text="貼付け")
         row.operator('object.remove_armature_bone_data_property', icon='X', text="")
+        if common.preferences().is_compact_bone_data and bone_data_property.is_legacy(arm):
+            col.operator('object.convert_armature_bone_data_property', icon='FILE_REFRESH')
 
     flag = False
     for bone in arm.bones:
@@ -197,33 +198,19 @@ class CNV_OT_copy_armature_bone_data_property(bpy.types.Operator):
         if ob:
             if ob.type == 'ARMATURE':
                 arm = ob.data
-                if 'BoneData:0' in arm and 'LocalBoneData:0' in arm:
+                if bone_data_property.has_bone_data(arm):
                     return True
         return False
 
     def execute(self, context):
         output_text = ""
         ob = context.active_object.data
-        pass_count = 0
         if 'BaseBone' in ob:
             output_text += "BaseBone:" + ob['BaseBone'] + "\n"
-        for i in range(99999):
-            name = "BoneData:" + str(i)
-            if name in ob:
-                output_text += "BoneData:" + ob[name] + "\n"
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
-        pass_count = 0
-        for i in range(99999):
-            name = "LocalBoneData:" + str(i)
-            if name in ob:
-                output_text += "LocalBoneData:" + ob[name] + "\n"
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
+        for line in bone_data_property.read_bone_data_lines(ob, ob.get('ModelVersion', 2001)):
+            output_text += "BoneData:" + line + "\n"
+        for line in bone_data_property.read_local_bone_data_lines(ob):
+            output_text += "LocalBoneData:" + line + "\n"
         context.window_manager.clipboard = output_text
         self.report(type={'INFO'}, message="ボーン情報をクリップボードにコピーしました")
         return {'FINISHED'}
@@ -248,43 +235,21 @@ class CNV_OT_paste_armature_bone_data_property(bpy.types.Operator):
 
     def execute(self, context):
         ob = context.active_object.data
-        pass_count = 0
-        for i in range(99999):
-            name = "BoneData:" + str(i)
-            if name in ob:
-                del ob[name]
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
-        pass_count = 0
-        for i in range(99999):
-            name = "LocalBoneData:" + str(i)
-            if name in ob:
-                del ob[name]
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
-        bone_data_count = 0
-        local_bone_data_count = 0
+        bone_data_lines = []
+        local_bone_data_lines = []
         for line in context.window_manager.clipboard.split("\n"):
             if line.startswith('BaseBone:'):
                 ob['BaseBone'] = line[9:]  # len('BaseData:') == 9
                 continue
 
             if line.startswith('BoneData:'):
-                if line.count(',') >= 4:
-                    name = "BoneData:" + str(bone_data_count)
-                    ob[name] = line[9:]  # len('BoneData:') == 9
-                    bone_data_count += 1
+                bone_data_lines.append(line[9:])  # len('BoneData:') == 9
                 continue
 
             if line.startswith('LocalBoneData:'):
-                if line.count(',') == 1:
-                    name = "LocalBoneData:" + str(local_bone_data_count)
-                    ob[name] = line[14:]  # len('LocalBoneData:') == 14
-                    local_bone_data_count += 1
+                local_bone_data_lines.append(line[14:])  # len('LocalBoneData:') == 14
+        compact = common.preferences().is_compact_bone_data
+        bone_data_property.write_bone_data_lines(ob, bone_data_lines, local_bone_data_lines, compact=compact)
 
         self.report(type={'INFO'}, message="ボーン情報をクリップボードから貼付けました")
         return {'FINISHED'}
@@ -303,7 +268,7 @@ class CNV_OT_remove_armature_bone_data_property(bpy.types.Operator):
         if ob:
             if ob.type == 'ARMATURE':
                 arm = ob.data
-                if 'BoneData:0' in arm and 'LocalBoneData:0' in arm:
+                if bone_data_property.has_bone_data(arm):
                     return True
         return False
 
@@ -315,30 +280,37 @@ class CNV_OT_remove_armature_bone_data_property(bpy.types.Operator):
 
     def execute(self, context):
         ob = context.active_object.data
-        pass_count = 0
         if 'BaseBone' in ob:
             del ob['BaseBone']
-        for i in range(99999):
-            name = "BoneData:" + str(i)
-            if name in ob:
-                del ob[name]
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
-        pass_count = 0
-        for i in range(99999):
-            name = "LocalBoneData:" + str(i)
-            if name in ob:
-                del ob[name]
-            else:
-                pass_count += 1
-            if 10 < pass_count:
-                break
+        bone_data_property.remove_bone_data(ob)
         self.report(type={'INFO'}, message="ボーン情報を削除しました")
         return {'FINISHED'}
 
 
+@compat.BlRegister()
+class CNV_OT_convert_armature_bone_data_property(bpy.types.Operator):
+    bl_idname = 'object.convert_armature_bone_data_property'
+    bl_label = "Convert to Compact Bone Data"
+    bl_description = "Convert the BoneData / LocalBoneData custom properties stored as one string per bone into compact arrays"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.active_object
+        if ob:
+            if ob.type == 'ARMATURE':
+                arm = ob.data
+                if bone_data_property.is_legacy(arm):
+                    return True
+        return False
+
+    def execute(self, context):
+        arm = context.active_object.data
+        bone_data_property.migrate_bone_data(arm)
+        self.report(type={'INFO'}, message="Converted the bone data to compact arrays")
+        return {'FINISHED'}
+
+
 
 
 
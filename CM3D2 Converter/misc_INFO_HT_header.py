@@ -1,8 +1,8 @@
 # 画面右上 (「情報」エリア → ヘッダー)
 import bpy
-import bmesh
 from . import common
 from . import compat
+from . import model_export
 from .translations.pgettext_functions import *
 
 
@@ -28,20 +28,9 @@ class CNV_OT_vertices_count_checker(bpy.types.Operator):
         if not me.uv_layers.active:
             self.report(type={'ERROR'}, message="UVが存在しないので測定できません。")
             return {'FINISHED'}
-        bm = bmesh.new()
-        bm.from_mesh(me)
+        _, split_uvs, _ = model_export.split_vertices_by_uv(me)
 
-        alreadys = {}
-        uv_lay = bm.loops.layers.uv.active
-
-        for face in bm.faces:
-            for loop in face.loops:
-                info = (loop.vert.index, loop[uv_lay].uv.x, loop[uv_lay].uv.y)
-                if info not in alreadys:
-                    alreadys[info] = None
-        bm.free()
-
-        inner_count = len(alreadys)
+        inner_count = len(split_uvs)
         real_count = len(me.vertices)
         if inner_count <= 65535:
             self.report(type={'INFO'}, message=f_tip_("○ 出力可能な頂点数です、あと約{}頂点ほど余裕があります (頂点数:{}(+{}) UV分割で増加:+{}％)", 65535 - inner_count, real_count, inner_count - real_count, int(inner_count / real_count * 100)))
@@ -9,6 +9,7 @@ import abc
 from . import common
 from . import compat
 from . import model_export
+from . import bone_data_property
 from .translations.pgettext_functions import *
 
 
@@ -842,9 +843,9 @@ class CNV_PT_vgroups_selector(bpy.types.Panel):
         print(f_("len(matched) = {length}", length=len(matched_vgroups)))
         armature = target_ob.find_armature() or source_ob.find_armature()
         armature = armature and armature.data
-        bone_data_ob = (target_ob.get("LocalBoneData:0") and target_ob) or (source_ob.get("LocalBoneData:0") and source_ob) or False
+        bone_data_ob = (bone_data_property.has_local_bone_data(target_ob) and target_ob) or (bone_data_property.has_local_bone_data(source_ob) and source_ob) or False
         if bone_data_ob:
-            local_bone_data = model_export.CNV_OT_export_cm3d2_model.local_bone_data_parser(model_export.CNV_OT_export_cm3d2_model.indexed_data_generator(bone_data_ob, prefix="LocalBoneData:"))
+            local_bone_data = bone_data_property.read_local_bone_data(bone_data_ob)
             local_bone_names = [ bone['name'] for bone in local_bone_data ]
         for target_vg, source_vg in matched_vgroups:
             vg_name = target_vg.name
@@ -1078,9 +1079,9 @@ class CNV_UL_vgroups_selector(bpy.types.UIList):
 
         if not self.local_bone_names:
             target_ob, source_ob = common.get_target_and_source_ob(context)
-            bone_data_ob = (target_ob.get("LocalBoneData:0") and target_ob) or (source_ob.get("LocalBoneData:0") and source_ob) or None
+            bone_data_ob = (bone_data_property.has_local_bone_data(target_ob) and target_ob) or (bone_data_property.has_local_bone_data(source_ob) and source_ob) or None
             if bone_data_ob:
-                local_bone_data = model_export.CNV_OT_export_cm3d2_model.local_bone_data_parser(model_export.CNV_OT_export_cm3d2_model.indexed_data_generator(bone_data_ob, prefix="LocalBoneData:"))
+                local_bone_data = bone_data_property.read_local_bone_data(bone_data_ob)
                 self.local_bone_names = [ bone['name'] for bone in local_bone_data ]
         
         if not self.cached_values:
@@ -1191,7 +1192,7 @@ class CNV_OT_weighted_shape_key_transfer(shape_key_transfer_op, bpy.types.Operat
         print(f_("len(matched) = {length}", length=len(self.matched_vgroups)))
         armature_ob = target_ob.find_armature() or source_ob.find_armature()
         self.armature = armature_ob and armature_ob.data
-        self.bone_data_ob = (target_ob.get("LocalBoneData:0") and target_ob) or (source_ob.get("LocalBoneData:0") and source_ob) or None
+        self.bone_data_ob = (bone_data_property.has_local_bone_data(target_ob) and target_ob) or (bone_data_property.has_local_bone_data(source_ob) and source_ob) or None
         
         for index, vgs in enumerate(self.matched_vgroups):
             target_vg, source_vg = vgs
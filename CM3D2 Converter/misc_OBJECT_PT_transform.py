@@ -5,6 +5,7 @@ import mathutils
 import numpy as np
 from . import common
 from . import compat
+from . import bone_data_property
 from .translations.pgettext_functions import *
 from .model_export import CNV_OT_export_cm3d2_model
 
@@ -124,13 +125,13 @@ class CNV_OT_align_to_cm3d2_base_bone(bpy.types.Operator):
         # ボーン情報元のデフォルトオプションを取得
         if "BoneData" in context.blend_data.texts:
             self.bone_info_mode = 'TEXT'
-        if "BoneData:0" in ob:
+        if bone_data_property.has_bone_data(ob):
             self.bone_info_mode = 'OBJECT_PROPERTY'
         arm_ob = ob.find_armature()
         if (not arm_ob) and (ob.parent and ob.parent.type == 'ARMATURE'):
             arm_ob = ob.parent
         if arm_ob:
-            if "BoneData:0" in arm_ob.data:
+            if bone_data_property.has_bone_data(arm_ob.data):
                 self.bone_info_mode = 'ARMATURE_PROPERTY'
 
         self.scale = common.preferences().scale
@@ -157,12 +158,18 @@ class CNV_OT_align_to_cm3d2_base_bone(bpy.types.Operator):
         col.label(text="Bone Data Source", icon='BONE_DATA')
         _prop_enum_row(col, self, 'bone_info_mode', 'ARMATURE'         , enabled=bool(arm_ob                                ))
         _prop_enum_row(col, self, 'bone_info_mode', 'TEXT'             , enabled=bool("BoneData" in context.blend_data.texts))
-        _prop_enum_row(col, self, 'bone_info_mode', 'OBJECT_PROPERTY'  , enabled=bool("BoneData:0" in ob                    ))
-        _prop_enum_row(col, self, 'bone_info_mode', 'ARMATURE_PROPERTY', enabled=bool(arm_ob and "BoneData:0" in arm_ob.data))
+        _prop_enum_row(col, self, 'bone_info_mode', 'OBJECT_PROPERTY'  , enabled=bone_data_property.has_bone_data(ob))
+        _prop_enum_row(col, self, 'bone_info_mode', 'ARMATURE_PROPERTY', enabled=bool(arm_ob and bone_data_property.has_bone_data(arm_ob.data)))
 
     @staticmethod
     def from_bone_data(ob: bpy.types.Object, bone_data, local_bone_data, base_bone_name, scale=5):
-        
+        mat = CNV_OT_align_to_cm3d2_base_bone.bone_data_basis(bone_data, local_bone_data, base_bone_name, scale)
+        if mat is not None:
+            ob.matrix_basis = mat
+
+    @staticmethod
+    def bone_data_basis(bone_data, local_bone_data, base_bone_name, scale=5) -> mathutils.Matrix | None:
+        """BoneData から基点ボーンに合わせたオブジェクトの matrix_basis を返す、基点ボーンが無ければ None"""
         base_bone_offset = mathutils.Matrix.Identity(4)
         for bone in local_bone_data:
             if bone['name'] == base_bone_name:
@@ -220,17 +227,55 @@ class CNV_OT_align_to_cm3d2_base_bone(bpy.types.Operator):
 
                 mat = compat.convert_cm_to_bl_space(mat)
                 mat = compat.convert_cm_to_bl_local_space(mat)
-                ob.matrix_basis = mat
-                break
+                return mat
+        return None
 
 
     @staticmethod
     def from_armature(ob: bpy.types.Object, arm: bpy.types.Armature, base_bone_name):
+        ob.matrix_basis = CNV_OT_align_to_cm3d2_base_bone.armature_basis(arm, base_bone_name)
+
+    @staticmethod
+    def armature_basis(arm: bpy.types.Armature, base_bone_name) -> mathutils.Matrix:
+        """アーマチュアの基点ボーンに合わせたオブジェクトの matrix_basis を返す"""
         base_bone = arm.bones.get(base_bone_name)
         mat = base_bone.matrix_local.copy()
         mat = compat.convert_bl_to_cm_bone_rotation(mat)
         mat = compat.convert_cm_to_bl_local_space(mat)
-        ob.matrix_basis = mat
+        return mat
+
+    @classmethod
+    def find_basis(cls, context, ob: bpy.types.Object, bone_info_mode, scale) -> mathutils.Matrix | None:
+        """基点ボーンに合わせた ob の matrix_basis を返す (ob は変更しない)、BaseBone が見つからなければ None"""
+        arm_ob = ob.find_armature()
+        if (not arm_ob) and (ob.parent and ob.parent.type == 'ARMATURE'):
+            arm_ob = ob.parent
+
+        base_bone_name = None
+        bone_data = None
+        if bone_info_mode == 'ARMATURE':
+            if not 'BaseBone' in arm_ob.data:
+                return None
+            base_bone_name = arm_ob.data['BaseBone']
+        if bone_info_mode == 'TEXT':
+            bone_data_text = context.blend_data.texts["BoneData"]
+            if not 'BaseBone' in bone_data_text:
+                return None
+            base_bone_name = bone_data_text['BaseBone']
+            bone_data = CNV_OT_export_cm3d2_model.bone_data_parser(l.body for l in bone_data_text.lines)
+            local_bone_data = CNV_OT_export_cm3d2_model.local_bone_data_parser(l.body for l in bone_data_text.lines)
+        elif bone_info_mode in ['OBJECT_PROPERTY', 'ARMATURE_PROPERTY']:
+            target = ob if bone_info_mode == 'OBJECT_PROPERTY' else arm_ob.data
+            if not 'BaseBone' in target:
+                return None
+            base_bone_name = target['BaseBone']
+            bone_data = bone_data_property.read_bone_data(target)
+            local_bone_data = bone_data_property.read_local_bone_data(target)
+
+        if bone_data:
+            mat = cls.bone_data_basis(bone_data, local_bone_data, base_bone_name, scale)
+            return mat if mat is not None else ob.matrix_basis.copy()
+        return cls.armature_basis(arm_ob.data, base_bone_name)
 
 
     def bone_data_report_cancel(self):
@@ -250,38 +295,12 @@ class CNV_OT_align_to_cm3d2_base_bone(bpy.types.Operator):
 
     def execute(self, context):
         ob: bpy.types.Object = context.object
-        arm_ob = ob.find_armature()
-        if (not arm_ob) and (ob.parent and ob.parent.type == 'ARMATURE'):
-            arm_ob = ob.parent
-        
-        base_bone_name = None
-        bone_data = None
-        if self.bone_info_mode == 'ARMATURE':
-            #bone_data = CNV_OT_export_cm3d2_model.armature_bone_data_parser(context, arm_ob)
-            if not 'BaseBone' in arm_ob.data:
-                return self.bone_data_report_cancel()
-            base_bone_name = arm_ob.data['BaseBone']
-        if self.bone_info_mode == 'TEXT':
-            bone_data_text = context.blend_data.texts["BoneData"]
-            if not 'BaseBone' in bone_data_text:
-                return self.bone_data_report_cancel()
-            base_bone_name = bone_data_text['BaseBone']
-            bone_data = CNV_OT_export_cm3d2_model.bone_data_parser(l.body for l in bone_data_text.lines)
-            local_bone_data = CNV_OT_export_cm3d2_model.local_bone_data_parser(l.body for l in bone_data_text.lines)
-        elif self.bone_info_mode in ['OBJECT_PROPERTY', 'ARMATURE_PROPERTY']:
-            target = ob if self.bone_info_mode == 'OBJECT_PROPERTY' else arm_ob.data
-            if not 'BaseBone' in target:
-                return self.bone_data_report_cancel()
-            base_bone_name = target['BaseBone']
-            bone_data = CNV_OT_export_cm3d2_model.bone_data_parser(CNV_OT_export_cm3d2_model.indexed_data_generator(target, prefix="BoneData:"))
-            local_bone_data = CNV_OT_export_cm3d2_model.local_bone_data_parser(CNV_OT_export_cm3d2_model.indexed_data_generator(target, prefix="LocalBoneData:"))
-        
+        new_basis = self.find_basis(context, ob, self.bone_info_mode, self.scale)
+        if new_basis is None:
+            return self.bone_data_report_cancel()
+
         old_basis = ob.matrix_basis.copy()
-        if bone_data:
-            self.from_bone_data(ob, bone_data, local_bone_data, base_bone_name, self.scale)
-        else:
-            self.from_armature(ob, arm_ob.data, base_bone_name)
-        new_basis = ob.matrix_basis.copy()
+        ob.matrix_basis = new_basis
 
         if self.is_preserve_mesh and new_basis != old_basis:
             # This process can be lossy, so only perform if necessary
@@ -0,0 +1,273 @@
+"""読み込んだmodelファイルのデータをディスクにキャッシュする (bpy は使わない)
+
+キャッシュはファイル内容1つにつき1つのフォルダで、meta.json と配列ごとの .npy ファイルからなる。
+.npy は np.load(mmap_mode='r') でコピーせずに読み込める。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from . import cm3d2_data
+
+
+CACHE_FORMAT_VERSION = 2
+META_FILENAME = 'meta.json'
+PATHS_DIRNAME = 'paths'
+
+
+def file_digest(filepath) -> str:
+    """ファイル内容のハッシュ値を返す"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def material_to_json(mate: cm3d2_data.Material) -> dict:
+    return {
+        'version'    : mate.version,
+        'name1'      : mate.name1,
+        'name2'      : mate.name2,
+        'shader1'    : mate.shader1,
+        'shader2'    : mate.shader2,
+        'tex_list'   : mate.tex_list,
+        'col_list'   : mate.col_list,
+        'f_list'     : mate.f_list,
+        'range_list' : mate.range_list,
+        'custom_list': mate.custom_list,
+    }
+
+
+def material_from_json(data: dict) -> cm3d2_data.Material:
+    mate = cm3d2_data.Material()
+    mate.version = data['version']
+    mate.name1 = data['name1']
+    mate.name2 = data['name2']
+    mate.shader1 = data['shader1']
+    mate.shader2 = data['shader2']
+    # JSON ではタプルがリストになるので、Material.read() と同じ形に戻す
+    mate.tex_list = [
+        item[:3] + [tuple(item[3]), tuple(item[4])] if len(item) > 4 else item
+        for item in data['tex_list']
+    ]
+    mate.col_list = [[name, tuple(col)] for name, col in data['col_list']]
+    mate.f_list = data['f_list']
+    mate.range_list = data['range_list']
+    mate.custom_list = {
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in data['custom_list'].items()
+    }
+    return mate
+
+
+class ModelCache():
+    """modelファイルの読み込み結果 (model_import.ModelData) をディスクに保存するキャッシュ
+
+    キャッシュはファイル内容のハッシュ値をキーにするので、コピーや移動したファイルでも使える。
+    ハッシュ値の計算を省くため、パスごとにサイズ・更新日時とハッシュ値を paths フォルダに記録しておく。
+    合計サイズが max_size バイトを超えた場合は、最も長く使われていないものから削除する。
+    """
+    def __init__(self, directory, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def path_record_path(self, filepath) -> str:
+        key = os.path.normcase(os.path.abspath(filepath)).encode('utf-8')
+        return os.path.join(self.directory, PATHS_DIRNAME, hashlib.sha1(key).hexdigest() + '.json')
+
+    def content_key(self, filepath) -> str:
+        """ファイル内容のハッシュ値を返す
+
+        記録したサイズ・更新日時と変わっていなければ記録したハッシュ値を使い、
+        変わっていれば計算し直して記録を更新する。
+        """
+        stat = os.stat(filepath)
+        record_path = self.path_record_path(filepath)
+        try:
+            with open(record_path, 'r', encoding='utf-8') as file:
+                record = json.load(file)
+            if record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+                return record['digest']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = file_digest(filepath)
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': digest}
+        try:
+            os.makedirs(os.path.dirname(record_path), exist_ok=True)
+            temp_path = f'{record_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(record, file)
+            os.replace(temp_path, record_path)
+        except OSError:
+            # 記録できなくても次回また計算するだけ
+            pass
+        return digest
+
+    def load(self, filepath, model_data_type):
+        """キャッシュが有効であれば model_data_type のインスタンスを作って返す、無ければ None"""
+        try:
+            digest = self.content_key(filepath)
+            entry_path = self.entry_path(digest)
+            with open(os.path.join(entry_path, META_FILENAME), 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            if meta['format'] != CACHE_FORMAT_VERSION or meta['digest'] != digest:
+                return None
+            model = self.__read_entry(entry_path, meta, model_data_type(filepath))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # 最近使ったものとして更新日時を更新する (LRU)
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return model
+
+    def store(self, filepath, model):
+        """読み込み結果をキャッシュに保存する"""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = self.content_key(filepath)
+        entry_path = self.entry_path(digest)
+        meta = {
+            'format': CACHE_FORMAT_VERSION,
+            'digest': digest,
+        }
+        temp_path = tempfile.mkdtemp(prefix=digest + '.', dir=self.directory)
+        try:
+            self.__write_entry(temp_path, meta, model)
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            os.replace(temp_path, entry_path)
+        except:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+    def evict(self):
+        """合計サイズが max_size に収まるまで、古いキャッシュから削除する"""
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name == PATHS_DIRNAME:
+                continue
+            size = sum(file.stat().st_size for file in os.scandir(entry.path) if file.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total_size += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            # 使用中などで削除できなかった場合は、まだ容量を使っている
+            if not os.path.exists(path):
+                total_size -= size
+
+    def clear(self):
+        """全てのキャッシュを削除する"""
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def __write_entry(entry_path, meta, model):
+        def save(name, array):
+            np.save(os.path.join(entry_path, name + '.npy'), np.ascontiguousarray(array), allow_pickle=False)
+
+        bone_data = model.bone_data
+        meta['version'] = model.version
+        meta['name'] = model.name
+        meta['base_bone_name'] = model.base_bone_name
+        meta['bone_names'] = [data['name'] for data in bone_data]
+        meta['local_bone_names'] = [data['name'] for data in model.local_bone_data]
+        meta['extra_uv_uses'] = [bool(used) for used in model.extra_uv_uses]
+        meta['face_counts'] = [len(faces) for faces in model.face_data]
+        meta['materials'] = [material_to_json(mate) for mate in model.material_data]
+        meta['morphs'] = [{'name': item['name'], 'uvs': 'uvs' in item} for item in model.misc_data]
+
+        save('bone_scl', np.array([data['scl'] for data in bone_data], dtype=np.uint8))
+        save('bone_parent_index', np.array([data['parent_index'] for data in bone_data], dtype=np.int32))
+        save('bone_co', np.array([data['co'][:] for data in bone_data], dtype=np.float32).reshape((-1, 3)))
+        save('bone_rot', np.array([data['rot'][:] for data in bone_data], dtype=np.float32).reshape((-1, 4)))
+        save('bone_has_scale', np.array(['scale' in data for data in bone_data], dtype=bool))
+        save('bone_scale', np.array([data.get('scale', (1, 1, 1)) for data in bone_data], dtype=np.float32).reshape((-1, 3)))
+        save('local_bone_matrix', np.array([[row[:] for row in data['matrix']] for data in model.local_bone_data], dtype=np.float32).reshape((-1, 4, 4)))
+        save('vertex', model.vertex_data)
+        save('weight', model.weight_data)
+        if model.face_data:
+            save('face', np.concatenate(model.face_data))
+        else:
+            save('face', np.empty((0, 3), dtype='<u2'))
+        for i, item in enumerate(model.misc_data):
+            save(f'morph_{i}', item['data'])
+
+        with open(os.path.join(entry_path, META_FILENAME), 'w', encoding='utf-8') as file:
+            json.dump(meta, file, ensure_ascii=False)
+
+    @staticmethod
+    def __read_entry(entry_path, meta, model):
+        def load(name):
+            return np.load(os.path.join(entry_path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+
+        bone_names = meta['bone_names']
+        bone_scl = load('bone_scl').tolist()
+        bone_parent_index = load('bone_parent_index').tolist()
+        bone_co = load('bone_co').tolist()
+        bone_rot = load('bone_rot').tolist()
+        bone_has_scale = load('bone_has_scale').tolist()
+        bone_scale = load('bone_scale')
+        bone_data = []
+        for i, name in enumerate(bone_names):
+            parent_index = bone_parent_index[i]
+            data = {
+                'name'        : name,
+                'scl'         : bone_scl[i],
+                'parent_index': parent_index,
+                'parent_name' : bone_names[parent_index] if parent_index != -1 else None,
+                'co'          : tuple(bone_co[i]),
+                'rot'         : tuple(bone_rot[i]),
+            }
+            if bone_has_scale[i]:
+                data['scale'] = bone_scale[i].tolist()
+            bone_data.append(data)
+
+        local_bone_matrix = load('local_bone_matrix').tolist()
+        local_bone_data = [
+            {'name': name, 'matrix': matrix}
+            for name, matrix in zip(meta['local_bone_names'], local_bone_matrix)
+        ]
+
+        faces = load('face')
+        face_bounds = np.cumsum(meta['face_counts'])[:-1]
+
+        misc_data = []
+        for i, morph in enumerate(meta['morphs']):
+            item = {'type': 'morph', 'name': morph['name']}
+            if morph['uvs']:
+                item['uvs'] = []
+            item['data'] = load(f'morph_{i}')
+            misc_data.append(item)
+
+        model.version = meta['version']
+        model.name = meta['name']
+        model.base_bone_name = meta['base_bone_name']
+        model.bone_data = bone_data
+        model.local_bone_data = local_bone_data
+        model.extra_uv_uses = meta['extra_uv_uses']
+        model.vertex_data = load('vertex')
+        model.weight_data = load('weight')
+        model.face_data = np.split(faces, face_bounds) if meta['face_counts'] else []
+        model.material_data = [material_from_json(data) for data in meta['materials']]
+        model.misc_data = misc_data
+        return model
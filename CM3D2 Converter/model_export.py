@@ -1,17 +1,562 @@
-import struct
+import concurrent.futures
+import inspect
+import io
+import os
 import time
 import math
 import bpy
-import bmesh
 import mathutils
 import numpy as np
-from operator import itemgetter
+from . import codec
 from . import common
 from . import compat
 from . import cm3d2_data
+from . import bone_data_property
+from . import profiling
+from . import export_cache
+from . import fileutil
+from .mesh_data import ObjectMeshData, EvaluatedMeshData, SnapshotMeshData, link_loop_order
 from .translations.pgettext_functions import *
 
 
+def split_vertices_by_uv(me: bpy.types.Mesh):
+    """modelファイルの頂点はUVを1つしか持てないので、アクティブなUVの切れ目で頂点を分割する
+
+    戻り値は (元の頂点ごとの分割後の頂点数, 分割後の頂点のUV (分割後の頂点数, 2), ループごとの分割後の頂点インデックス)
+    分割後の頂点は元の頂点の順に並び、同じ頂点の中では BMVert.link_loops で最初に出てくる順に並ぶ。
+    """
+    loop_count = len(me.loops)
+    loop_verts = np.empty(loop_count, dtype=np.int32)
+    me.loops.foreach_get('vertex_index', loop_verts)
+    loop_edges = np.empty(loop_count, dtype=np.int32)
+    me.loops.foreach_get('edge_index', loop_edges)
+    loop_uvs = np.empty((loop_count, 2), dtype=np.float32)
+    me.uv_layers.active.data.foreach_get('uv', loop_uvs.ravel())
+    poly_count = len(me.polygons)
+    poly_starts = np.empty(poly_count, dtype=np.int32)
+    me.polygons.foreach_get('loop_start', poly_starts)
+    poly_totals = np.empty(poly_count, dtype=np.int32)
+    me.polygons.foreach_get('loop_total', poly_totals)
+    loop_order = link_loop_order(loop_verts, loop_edges, poly_starts, poly_totals)
+    return split_loops_by_uv(loop_verts, loop_uvs, len(me.vertices), loop_order)
+
+
+def split_loops_by_uv(loop_verts: np.ndarray, loop_uvs: np.ndarray, vertex_count: int, loop_order: np.ndarray | None = None):
+    """split_vertices_by_uv() と同じ分割をループごとの頂点インデックスとUVの配列から行う
+
+    同じ頂点の中では、loop_order (mesh_data.link_loop_order() など) の順で最初に出てくる順に並べる。
+    loop_order が無ければループの順で最初に出てくる順に並べる。
+    """
+    loop_count = len(loop_verts)
+    if loop_order is None:
+        loop_order = np.argsort(loop_verts, kind='stable')
+    else:
+        loop_order = loop_order[np.argsort(loop_verts[loop_order], kind='stable')]
+    # (頂点, U, V) の組ごとに1つの頂点にする
+    keys = np.empty(loop_count, dtype=[('vert', np.int32), ('u', np.float32), ('v', np.float32)])
+    keys['vert'] = loop_verts[loop_order]
+    keys['u'] = loop_uvs[loop_order, 0]
+    keys['v'] = loop_uvs[loop_order, 1]
+    split_keys, first_indices, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # np.unique はUVの値の順に並べるので、最初に出てくる順に戻す
+    split_order = np.argsort(first_indices, kind='stable')
+    split_keys = split_keys[split_order]
+    split_indices = np.empty(len(split_keys), dtype=np.intp)
+    split_indices[split_order] = np.arange(len(split_keys))
+    loop_split_indices = np.empty(loop_count, dtype=np.intp)
+    loop_split_indices[loop_order] = split_indices[inverse.ravel()]
+    split_counts = np.bincount(split_keys['vert'], minlength=vertex_count)
+    split_uvs = np.stack((split_keys['u'], split_keys['v']), axis=-1)
+    return split_counts, split_uvs, loop_split_indices
+
+
+class ModelWriter():
+    """読み込み済みのデータから modelファイルを書き出すクラス
+
+    bpy に触れないので、オペレーターで読み込みを終えた後なら別スレッドで書き出せる。
+    """
+    # 頂点情報の1頂点分 (struct '<3f3f2f' と同じ)
+    vertex_dtype = np.dtype([('co', '<f4', (3,)), ('normal', '<f4', (3,)), ('uv', '<f4', (2,))])
+    # ウェイト情報の1頂点分 (struct '<4H4f' と同じ)
+    vertex_weight_dtype = np.dtype([('bone_index', '<u2', (4,)), ('weight', '<f4', (4,))])
+    # モーフの1頂点分 (struct '<H3f3f' と同じ)
+    morph_vertex_dtype = np.dtype([('index', '<u2'), ('co', '<f4', (3,)), ('normal', '<f4', (3,))])
+
+    def __init__(self, operator, mesh_data, bone_data, local_bone_data, vertices, materials, version_num):
+        """operator のプロパティの値を複製して保持する"""
+        self.filepath = operator.filepath
+        self.file_options = common.temporary_file_options(self.filepath, operator.is_backup)
+        self.version_num = version_num
+        self.model_name = operator.model_name
+        self.base_bone_name = operator.base_bone_name
+        self.scale = operator.scale
+        self.export_tangent = operator.export_tangent
+        self.is_convert_tris = operator.is_convert_tris
+        self.quad_split_method = operator.quad_split_method
+        self.is_split_sharp = operator.is_split_sharp
+        self.export_shapekey_normals = operator.export_shapekey_normals
+        self.use_shapekey_colors = operator.use_shapekey_colors
+        self.shapekey_normals_blend = operator.shapekey_normals_blend
+        self.shapekey_threshold = operator.shapekey_threshold
+        self.skip_shapekey = common.preferences().skip_shapekey
+
+        self.mesh_data = mesh_data
+        self.bone_data = bone_data
+        self.local_bone_data = local_bone_data
+        self.vertices = vertices              # ウェイト情報 (vertex_weight_dtype の配列)
+        self.materials = materials            # cm3d2_data.Material のリスト
+
+        self.profiler = profiling.StageProfiler(enabled=False)
+        self.section_cache = None  # 差分エクスポート中のみ設定される
+        self.progress = None       # 進捗を受け取る関数、無ければ None
+
+    def progress_update(self, value):
+        if self.progress:
+            self.progress(value)
+
+    def snapshot(self):
+        """シェイプキーまで配列に読み込み、bpy に触れずに write() できるようにする"""
+        delta_normal_names = ()
+        if self.export_shapekey_normals and self.use_shapekey_colors:
+            delta_normal_names = [f'{name}_delta_normals' for name in self.mesh_data.shape_key_names]
+        self.mesh_data = SnapshotMeshData(self.mesh_data, delta_normal_names, use_normals=self.export_shapekey_normals)
+        self.progress = None
+        return self
+
+    def write_file(self, is_incremental=False):
+        """filepath に書き出す、is_incremental なら前回と変わらない部分のバイト列を使い回す"""
+        if is_incremental:
+            self.section_cache = export_cache.get_section_cache(self.filepath)
+            self.section_cache.begin()
+        writer = fileutil.TemporaryFileWriter(self.filepath, 'wb', **self.file_options)
+        try:
+            with writer:
+                self.write(writer)
+        finally:
+            if self.section_cache:
+                self.section_cache.end()
+
+    def write(self, writer):
+        """モデルデータをファイルオブジェクトに書き込む"""
+        mesh_data = self.mesh_data
+        bone_data = self.bone_data
+        local_bone_data = self.local_bone_data
+
+        # ファイル先頭
+        self.profiler.stage('header')
+        binary = codec.BinaryWriter(writer)
+        binary.write_str('CM3D2_MESH')
+        binary.write_int32(self.version_num)
+
+        binary.write_str(self.model_name)
+        binary.write_str(self.base_bone_name)
+
+        # ボーン情報書き出し
+        self.profiler.stage('bones')
+        def write_bones(writer):
+            binary = codec.BinaryWriter(writer)
+            binary.write_int32(len(bone_data))
+            for bone in bone_data:
+                binary.write_str(bone['name'])
+                binary.write_int8(bone['scl'])
+            for bone in bone_data:
+                binary.write_int32(bone['parent_index'])
+            for bone in bone_data:
+                binary.pack(codec.VEC3, bone['co'][0], bone['co'][1], bone['co'][2])
+                binary.pack(codec.VEC4, bone['rot'][1], bone['rot'][2], bone['rot'][3], bone['rot'][0])
+                if self.version_num >= 2001:
+                    use_scale = ('scale' in bone)
+                    binary.write_int8(use_scale)
+                    if use_scale:
+                        bone_scale = bone['scale']
+                        binary.pack(codec.VEC3, bone_scale[0], bone_scale[1], bone_scale[2])
+        self.write_section(writer, 'bones', (self.version_num, bone_data), write_bones)
+        self.progress_update(4)
+
+        # 正しい頂点数などを取得
+        self.profiler.stage('vertices')
+        split_counts, split_uvs, loop_split_indices = split_loops_by_uv(mesh_data.loop_vertex_indices, mesh_data.loop_uvs, mesh_data.vertex_count, mesh_data.link_loop_order())
+        vert_count = len(split_uvs)
+        if 65535 < vert_count:
+            # 別スレッドから呼ばれることがあるので、翻訳は例外を受け取った側で行う (export_error_message)
+            raise common.CM3D2ExportError("頂点数がまだ多いです (現在{}頂点)。あと{}頂点以上減らしてください、中止します", vert_count, vert_count - 65535)
+        self.progress_update(5)
+
+        binary.pack(codec.INT32x2, vert_count, len(mesh_data.materials))
+
+        # ローカルボーン情報を書き出し
+        def write_local_bones(writer):
+            binary = codec.BinaryWriter(writer)
+            binary.write_int32(len(local_bone_data))
+            for bone in local_bone_data:
+                binary.write_str(bone['name'])
+            for bone in local_bone_data:
+                for f in bone['matrix']:
+                    binary.write_float(f)
+        self.write_section(writer, 'local bones', local_bone_data, write_local_bones)
+        self.progress_update(5.7)
+
+        # カスタム法線情報を取得
+        if mesh_data.has_custom_normals:
+            custom_normals = [mathutils.Vector() for i in range(mesh_data.vertex_count)]
+            for vert_index, normal in zip(mesh_data.loop_vertex_indices.tolist(), mesh_data.loop_normals.tolist()):
+                custom_normals[vert_index] += mathutils.Vector(normal)
+            for no in custom_normals:
+                no.normalize()
+        else:
+            custom_normals = None
+
+        # 頂点情報を書き出し
+        vert_cos = mesh_data.vertex_cos * np.float32(self.scale)
+        if custom_normals is not None:
+            vert_normals = np.array(custom_normals, dtype=np.float32).reshape((-1, 3))
+        else:
+            vert_normals = mesh_data.vertex_normals
+        split_vert_indices = np.repeat(np.arange(mesh_data.vertex_count), split_counts)
+        cm_vertices = np.empty(vert_count, dtype=self.vertex_dtype)
+        cm_vertices['co'] = self.convert_bl_to_cm_space(vert_cos)[split_vert_indices]
+        cm_vertices['normal'] = self.convert_bl_to_cm_space(vert_normals)[split_vert_indices]
+        cm_vertices['uv'] = split_uvs
+        writer.write(cm_vertices.tobytes())
+        self.progress_update(6)
+
+        # 面は接空間と面情報の両方で使うので、必要になった時に一度だけ作る
+        triangle_key = (
+            mesh_data.triangle_loops, mesh_data.triangle_polygon_indices, mesh_data.polygon_loop_starts,
+            mesh_data.polygon_loop_totals, mesh_data.polygon_material_indices, mesh_data.loop_vertex_indices,
+            mesh_data.vertex_cos, loop_split_indices, len(mesh_data.materials), self.is_convert_tris, self.quad_split_method,
+        )
+        cm_tris = None
+        def get_cm_tris():
+            nonlocal cm_tris
+            if cm_tris is None:
+                cm_tris = self.parse_triangles(mesh_data, loop_split_indices)
+            return cm_tris
+
+        # 接空間情報を書き出し
+        self.profiler.stage('tangents')
+        def write_tangents(writer):
+            if self.export_tangent:
+                tangents = self.calc_tangents(get_cm_tris(), cm_vertices['co'], cm_vertices['normal'], cm_vertices['uv'])
+                writer.write(codec.INT32.pack(len(tangents)))
+                writer.write(tangents.astype('<f4').tobytes())
+            else:
+                writer.write(codec.INT32.pack(0))
+        self.write_section(writer, 'tangents', (self.export_tangent, cm_vertices, triangle_key), write_tangents)
+
+        # ウェイト情報を書き出し
+        self.profiler.stage('weights')
+        # 頂点はUVの数だけ分割されているので、同じ数だけ繰り返す
+        writer.write(np.repeat(self.vertices, split_counts).tobytes())
+        split_counts = split_counts.tolist()
+        self.progress_update(7)
+
+        # 面情報を書き出し
+        self.profiler.stage('faces')
+        def write_faces(writer):
+            for tri in get_cm_tris():
+                writer.write(codec.INT32.pack(len(tri)))
+                writer.write(np.array(tri, dtype='<u2').tobytes())
+        self.write_section(writer, 'faces', triangle_key, write_faces)
+        self.progress_update(8)
+
+        # マテリアルを書き出し
+        self.profiler.stage('materials')
+        binary.write_int32(len(self.materials))
+        for mat_data in self.materials:
+            mat_data.write(writer, write_header=False)
+
+        self.progress_update(9)
+
+        # モーフを書き出し
+        self.profiler.stage('morphs')
+        if mesh_data.shape_key_names:
+            try:
+                self.write_shapekeys(mesh_data, writer, split_counts, custom_normals)
+            finally:
+                print("FINISHED SHAPE KEYS WRITE")
+                pass
+        binary.write_str('end')
+
+    def write_section(self, writer, name: str, key_data, write):
+        """write(writer) で書き出す部分を書き出す
+
+        差分エクスポート中は key_data のハッシュ値が前回と同じなら write を呼ばずに前回のバイト列を書き出す。
+        """
+        if self.section_cache is None:
+            write(writer)
+            return
+        key = export_cache.fingerprint(key_data)
+        data = self.section_cache.get(name, key)
+        if data is None:
+            buffer = io.BytesIO()
+            write(buffer)
+            data = buffer.getvalue()
+            self.section_cache.put(name, key, data)
+        writer.write(data)
+
+    @staticmethod
+    def convert_bl_to_cm_space(vectors: np.ndarray) -> np.ndarray:
+        """(N, 3) の配列を compat.convert_bl_to_cm_space() と同じく符号と軸の入れ替えだけで変換する (-0.0 も同じになる)"""
+        converted = np.empty_like(vectors)
+        np.negative(vectors[:, 0], out=converted[:, 0])
+        converted[:, 1] = vectors[:, 2]
+        np.negative(vectors[:, 1], out=converted[:, 2])
+        return converted
+
+    def write_shapekeys(self, mesh_data, writer, split_counts, custom_normals=None):
+        # モーフを書き出し
+        vert_count = mesh_data.vertex_count
+        loop_count = mesh_data.loop_count
+
+        loops_vert_index = mesh_data.loop_vertex_indices
+
+        if self.use_shapekey_colors:
+            static_loop_delta_normals = np.empty((loop_count, 3), dtype=float)
+            loops_per_vertex = np.bincount(loops_vert_index, minlength=vert_count).astype(float)
+            loops_per_vertex_reciprocal = np.reciprocal(loops_per_vertex, out=loops_per_vertex).reshape((vert_count, 1))
+        def get_sk_delta_normals_from_attribute(loop_delta_normals, out):
+            vert_delta_normals = out
+            vert_delta_normals.fill(0)
+
+            # for loop in me.loops: vert_delta_normals[loop.vertex_index] += loop_delta_normals[loop.index]
+            np.add.at(vert_delta_normals, loops_vert_index, loop_delta_normals) # XXX Slower but handles edge cases better
+            #vert_delta_normals[loops_vert_index] += loop_delta_normals # XXX Only first loop's value will be kept
+            
+            # for delta_normal in vert_delta_normals: delta_normal /= loops_per_vertex[vert.index]
+            vert_delta_normals *= loops_per_vertex_reciprocal
+
+            return out #.tolist()
+
+        if mesh_data.has_custom_normals:
+            basis_custom_normals = np.array(custom_normals, dtype=float)
+            static_loop_normals = np.empty((loop_count, 3), dtype=float)
+            static_vert_lengths = np.empty((vert_count, 1), dtype=float)
+        def get_sk_delta_normals_from_custom_normals(shape_key_index, out):
+            vert_custom_normals = out
+            vert_custom_normals.fill(0)
+            
+            loop_custom_normals = mesh_data.shape_key_loop_normals(shape_key_index, out=static_loop_normals)
+            
+            # for loop in me.loops: vert_delta_normals[loop.vertex_index] += loop_delta_normals[loop.index]
+            if not self.is_split_sharp:  
+                # XXX Slower
+                np.add.at(vert_custom_normals, loops_vert_index, loop_custom_normals)
+                vert_len_sq = get_lengths_squared(vert_custom_normals, out=static_vert_lengths)
+                vert_len = np.sqrt(vert_len_sq, out=vert_len_sq)
+                np.reciprocal(vert_len, out=vert_len)
+                vert_custom_normals *= vert_len #.reshape((*vert_len.shape, 1))
+            else:
+                # loop normals should be the same per-vertex unless there is a sharp edge 
+                # or a flat shaded face, but all sharp edges were split, so this method is fine
+                # (and Flat shaded faces just won't be supported)
+                vert_custom_normals[loops_vert_index] += loop_custom_normals # Only first loop's value will be kept
+
+            vert_custom_normals -= basis_custom_normals
+            return out
+        
+        if not mesh_data.has_custom_normals:
+            basis_normals = mesh_data.vertex_normals.astype(float)
+        def get_sk_delta_normals_from_normals(shape_key_index, out):
+            vert_normals = mesh_data.shape_key_vertex_normals(shape_key_index, out=out)
+            vert_delta_normals = np.subtract(vert_normals, basis_normals, out=out)
+            return out
+
+        basis_co = mesh_data.vertex_cos.astype(float)
+        def get_sk_delta_coordinates(shape_key_index, out):
+            delta_coordinates = mesh_data.shape_key_cos(shape_key_index, out=out)
+            delta_coordinates -= basis_co
+            return out
+
+        static_array_sq = np.empty((vert_count, 3), dtype=float)
+        def get_lengths_squared(vectors, out):
+            np.power(vectors, 2, out=static_array_sq)
+            np.sum(static_array_sq, axis=1, out=out.ravel())
+            return out
+
+        def write_morph(writer, morph, name):
+            binary = codec.BinaryWriter(writer)
+            binary.write_str('morph')
+            binary.write_str(name)
+            binary.write_int32(len(morph))
+            binary.write(morph.tobytes())
+        
+        # accessing attributes via "self.x" in the loop is slower, so store some here
+        self__export_shapekey_normals = self.export_shapekey_normals
+        self__use_shapekey_colors = self.use_shapekey_colors
+        self__shapekey_normals_blend = self.shapekey_normals_blend
+        self__scale = self.scale
+        
+        co_diff_threshold = self.shapekey_threshold / 5
+        co_diff_threshold_squared = co_diff_threshold * co_diff_threshold
+        no_diff_threshold = self.shapekey_threshold * 10
+        no_diff_threshold_squared = no_diff_threshold * no_diff_threshold
+        
+        # shared arrays
+        delta_coordinates  = np.empty((vert_count, 3), dtype=float)
+        vert_delta_normals = np.empty((vert_count, 3), dtype=float)
+
+        delta_co_lensq = np.empty((vert_count), dtype=float)
+        delta_no_lensq = np.empty((vert_count), dtype=float)
+
+        if not self.export_shapekey_normals:
+            vert_delta_normals.fill(0)
+            delta_no_lensq.fill(0)
+
+        # 分割後の頂点ごとの元の頂点インデックス
+        split_vert_indices = np.repeat(np.arange(vert_count), split_counts)
+
+        # 差分エクスポートでは、モーフごとの差分の配列とこれらの値が前回と同じなら前回のバイト列を使う
+        if self.section_cache is not None:
+            morph_options = export_cache.fingerprint((np.asarray(split_counts), co_diff_threshold, no_diff_threshold, self.skip_shapekey))
+
+        # HEAVY LOOP
+        for shape_key_index, shape_key_name in enumerate(mesh_data.shape_key_names):
+            if self__export_shapekey_normals and self__use_shapekey_colors:
+                loop_delta_normals = mesh_data.delta_normals(f'{shape_key_name}_delta_normals', out=static_loop_delta_normals)
+
+            if self__export_shapekey_normals:
+                if self__use_shapekey_colors and not loop_delta_normals is None:
+                    sk_delta_normals = get_sk_delta_normals_from_attribute(loop_delta_normals, out=vert_delta_normals)
+                elif mesh_data.has_custom_normals:
+                    sk_delta_normals = get_sk_delta_normals_from_custom_normals(shape_key_index, out=vert_delta_normals)
+                    sk_delta_normals *= self__shapekey_normals_blend
+                else:
+                    sk_delta_normals = get_sk_delta_normals_from_normals(shape_key_index, out=vert_delta_normals)
+                    sk_delta_normals *= self__shapekey_normals_blend
+                
+                sk_no_lensq = get_lengths_squared(sk_delta_normals, out=delta_no_lensq)
+            else:
+                sk_delta_normals = vert_delta_normals
+                sk_no_lensq = delta_no_lensq
+
+            sk_co_diffs = get_sk_delta_coordinates(shape_key_index, out=delta_coordinates)
+            sk_co_diffs *= self__scale # scale before getting lengths
+            sk_co_lensq = get_lengths_squared(sk_co_diffs, out=delta_co_lensq)
+
+            def write_shapekey(writer):
+                # ignore vertices whose change is too small (greatly lowers file size)
+                is_changed = (sk_co_lensq >= co_diff_threshold_squared) | (sk_no_lensq >= no_diff_threshold_squared)
+                is_split_changed = np.repeat(is_changed, split_counts)
+                morph_vert_indices = split_vert_indices[is_split_changed]
+                morph = np.empty(len(morph_vert_indices), dtype=self.morph_vertex_dtype)
+                morph['index'] = np.flatnonzero(is_split_changed)
+                morph['co'] = self.convert_bl_to_cm_space(sk_co_diffs[morph_vert_indices])
+                morph['normal'] = self.convert_bl_to_cm_space(sk_delta_normals[morph_vert_indices])
+
+                if self.skip_shapekey and not len(morph):
+                    return
+                write_morph(writer, morph, shape_key_name)
+
+            if self.section_cache is None:
+                write_shapekey(writer)
+            else:
+                morph_key = (morph_options, shape_key_name, sk_co_diffs, sk_delta_normals)
+                self.write_section(writer, 'morph:' + shape_key_name, morph_key, write_shapekey)
+
+    def parse_triangles(self, mesh_data, loop_split_indices):
+        """材質ごとに三角形の分割後の頂点インデックスを平らな配列のリストで返す (面の向きはCM3D2に合わせて反転する)"""
+        tri_loops = mesh_data.triangle_loops.copy()
+        tri_polys = mesh_data.triangle_polygon_indices
+        loop_starts = mesh_data.polygon_loop_starts
+        loop_totals = mesh_data.polygon_loop_totals
+        poly_materials = mesh_data.polygon_material_indices
+
+        tri_loop_totals = loop_totals[tri_polys]
+        if not self.is_convert_tris:
+            # 三角形以外の面は出力しない
+            is_tri = tri_loop_totals == 3
+            tri_loops, tri_polys = tri_loops[is_tri], tri_polys[is_tri]
+        elif self.quad_split_method == 'SHORTEST_DIAGONAL':
+            # 四角面は1面につき2つの三角形が続けて並んでいるので、まとめて置き換える
+            is_quad_tri = tri_loop_totals == 4
+            quad_polys = tri_polys[is_quad_tri][::2]
+            quad_loops = loop_starts[quad_polys, np.newaxis] + np.arange(4, dtype=np.int32)
+            quad_cos = mesh_data.vertex_cos[mesh_data.loop_vertex_indices[quad_loops]]
+            diagonal02 = np.einsum('ij,ij->i', quad_cos[:, 0] - quad_cos[:, 2], quad_cos[:, 0] - quad_cos[:, 2])
+            diagonal13 = np.einsum('ij,ij->i', quad_cos[:, 1] - quad_cos[:, 3], quad_cos[:, 1] - quad_cos[:, 3])
+            corners = np.where(
+                (diagonal02 < diagonal13)[:, np.newaxis, np.newaxis],
+                np.array(((0, 1, 2), (0, 2, 3))),
+                np.array(((0, 1, 3), (1, 2, 3))),
+            )
+            tri_loops[is_quad_tri] = quad_loops[np.arange(len(quad_loops))[:, np.newaxis, np.newaxis], corners].reshape((-1, 3))
+
+        # 材質ごとにまとめる (材質内では面の順のまま)
+        tri_materials = poly_materials[tri_polys]
+        order = np.argsort(tri_materials, kind='stable')
+        tri_materials = tri_materials[order]
+        tri_indices = loop_split_indices[tri_loops[order]][:, ::-1]
+
+        material_count = len(mesh_data.materials)
+        bounds = np.searchsorted(tri_materials, np.arange(material_count + 1))
+        return [tri_indices[bounds[i]:bounds[i + 1]].ravel() for i in range(material_count)]
+
+    def calc_tangents(self, cm_tris, cm_verts, cm_norms, cm_uvs):
+        """頂点ごとの接空間 (x, y, z, 従法線の向き) を (頂点数, 4) の配列で返す
+
+        cm_tris は材質ごとの三角形の頂点インデックスのリスト、cm_verts, cm_norms, cm_uvs は頂点ごとの配列。
+        以前の mathutils.Vector を使った実装と同じバイト列になるように、
+        Vector に保存される値は float32 に丸め、三角形の順に float32 で足し合わせる。
+        """
+        def dot(a, b):
+            # Vector.dot() と同じく、float32 の積を double で z, y, x の順に足す
+            products = (a * b).astype(np.float64)
+            return (products[:, 2] + products[:, 1]) + products[:, 0]
+
+        count = len(cm_verts)
+        verts = np.asarray(cm_verts, dtype=np.float32)
+        norms = np.asarray(cm_norms, dtype=np.float32)
+        uvs = np.asarray(cm_uvs, dtype=np.float32)
+        tris = [np.asarray(tri, dtype=np.intp) for tri in cm_tris]
+        tris = np.concatenate(tris).reshape((-1, 3)) if tris else np.empty((0, 3), dtype=np.intp)
+
+        a1 = (verts[tris[:, 1]] - verts[tris[:, 0]]).astype(np.float64)
+        a2 = (verts[tris[:, 2]] - verts[tris[:, 0]]).astype(np.float64)
+        s1 = (uvs[tris[:, 1]] - uvs[tris[:, 0]]).astype(np.float64)
+        s2 = (uvs[tris[:, 2]] - uvs[tris[:, 0]]).astype(np.float64)
+        r_inverse = s1[:, 0] * s2[:, 1] - s2[:, 0] * s1[:, 1]
+
+        # UVが潰れている三角形は無視する
+        is_valid = r_inverse != 0
+        tris, a1, a2, s1, s2 = tris[is_valid], a1[is_valid], a2[is_valid], s1[is_valid], s2[is_valid]
+        r = (1.0 / r_inverse[is_valid])[:, np.newaxis]
+        sdir = ((s2[:, 1, np.newaxis] * a1 - s1[:, 1, np.newaxis] * a2) * r).astype(np.float32)
+        tdir = ((s1[:, 0, np.newaxis] * a2 - s2[:, 0, np.newaxis] * a1) * r).astype(np.float32)
+
+        # 三角形の各頂点に足し合わせる (np.add.at は順番通りに足す)
+        tri_verts = tris.ravel()
+        tan1 = np.zeros((count, 3), dtype=np.float32)
+        tan2 = np.zeros((count, 3), dtype=np.float32)
+        np.add.at(tan1, tri_verts, np.repeat(sdir, 3, axis=0))
+        np.add.at(tan2, tri_verts, np.repeat(tdir, 3, axis=0))
+
+        # グラム・シュミットの直交化 (Vector.normalized() と同じ丸め方)
+        t = tan1 - norms * dot(norms, tan1).astype(np.float32)[:, np.newaxis]
+        squares = t.astype(np.float64) ** 2
+        length_squared = (squares[:, 2] + squares[:, 1]) + squares[:, 0]
+        is_normalizable = length_squared > 1.0e-35
+        lengths = np.sqrt(length_squared, where=is_normalizable, out=np.ones(count)).astype(np.float32)
+        t *= (np.float32(1.0) / lengths)[:, np.newaxis]
+        t[~is_normalizable] = 0.0
+
+        handedness = dot(np.cross(norms, tan1), tan2)
+
+        tangents = np.empty((count, 4), dtype=np.float32)
+        tangents[:, 0] = -t[:, 0]
+        tangents[:, 1] = t[:, 1]
+        tangents[:, 2] = t[:, 2]
+        tangents[:, 3] = np.where(handedness < 0, 1.0, -1.0)
+        return tangents
+
+
+def export_error_message(e: common.CM3D2ExportError) -> str:
+    """CM3D2ExportError のメッセージを返す、書式の引数があれば翻訳してから埋め込む"""
+    if len(e.args) > 1:
+        return f_tip_(e.message, *e.args[1:])
+    return str(e)
+
+
 # メインオペレーター
 @compat.BlRegister()
 class CNV_OT_export_cm3d2_model(bpy.types.Operator):
@@ -57,7 +602,14 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
 
     is_align_to_base_bone = bpy.props.BoolProperty(name="Align to Base Bone", default=True, description="Align the object to it's base bone")
     is_convert_tris = bpy.props.BoolProperty(name="四角面を三角面に", default=True, description="四角ポリゴンを三角ポリゴンに変換してから出力します、元のメッシュには影響ありません")
+    items = [
+        ('SHORTEST_DIAGONAL', "Shortest Diagonal", "Split quads along their shorter diagonal", 'NONE', 1),
+        ('BLENDER'          , "Blender", "Use Blender's own triangulation for quads as well", 'NONE', 2),
+    ]
+    quad_split_method = bpy.props.EnumProperty(items=items, name="Quad Split", default='SHORTEST_DIAGONAL', description="How quads are split into triangles. Other polygons always use Blender's triangulation")
     is_split_sharp = bpy.props.BoolProperty(name="Split Sharp Edges", default=True, description="Split all edges marked as sharp.")
+    is_incremental = bpy.props.BoolProperty(name="Incremental Export", default=False, description="Reuse the sections that did not change since the last export to the same file in this session, instead of generating them again")
+    use_evaluated_mesh = bpy.props.BoolProperty(name="Export Evaluated Mesh", default=False, description="Read the meshes with their modifiers applied directly instead of copying, applying and joining the objects. Nothing is added to the blend file")
     is_normalize_weight = bpy.props.BoolProperty(name="ウェイトの合計を1.0に", default=True, description="4つのウェイトの合計値が1.0になるように正規化します")
     is_convert_bone_weight_names = bpy.props.BoolProperty(name="頂点グループ名をCM3D2用に変換", default=True, description="全ての頂点グループ名をCM3D2で使える名前にしてからエクスポートします")
     is_clean_vertex_groups = bpy.props.BoolProperty(name="クリーンな頂点グループ", default=True, description="重みがゼロの場合、頂点グループから頂点を削除します")
@@ -71,6 +623,8 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
     export_shapekey_normals = bpy.props.BoolProperty(name="Export Shape Key Normals", default=True, description="Export custom normals for each shape key on export.")
     shapekey_normals_blend = bpy.props.FloatProperty(name="Shape Key Normals Blend", default=0.6, min=0, max=1, precision=3, description="Adjust the influence of shape keys on custom normals")
     use_shapekey_colors = bpy.props.BoolProperty(name="Use Shape Key Colors", default=True, description="Use the shape key normals stored in the vertex colors instead of calculating the normals on export. (Recommend disabling if geometry was customized)")
+
+    profiler = profiling.StageProfiler(enabled=False)  # エクスポート中のみ設定される
     
 
     @classmethod
@@ -93,16 +647,9 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             return self.report_cancel("アクティブオブジェクトがありません")
         if ob.type != 'MESH':
             return self.report_cancel("メッシュオブジェクトを選択した状態で実行してください")
-        if not len(ob.material_slots):
-            return self.report_cancel("マテリアルがありません")
-        for slot in ob.material_slots:
-            if not slot.material:
-                return self.report_cancel("空のマテリアルスロットを削除してください")
-            try:
-                slot.material['shader1']
-                slot.material['shader2']
-            except:
-                return self.report_cancel("マテリアルに「shader1」と「shader2」という名前のカスタムプロパティを用意してください")
+        res = self.check_materials([slot.material for slot in ob.material_slots])
+        if res:
+            return res
         me = ob.data
         if not me.uv_layers.active:
             return self.report_cancel("UVがありません")
@@ -110,6 +657,20 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             return self.report_cancel("エクスポート可能な頂点数を大幅に超えています、最低でも65535未満には削減してください")
         return None
 
+    def check_materials(self, materials):
+        """出力するマテリアルのチェック"""
+        if not len(materials):
+            return self.report_cancel("マテリアルがありません")
+        for mat in materials:
+            if not mat:
+                return self.report_cancel("空のマテリアルスロットを削除してください")
+            try:
+                mat['shader1']
+                mat['shader2']
+            except:
+                return self.report_cancel("マテリアルに「shader1」と「shader2」という名前のカスタムプロパティを用意してください")
+        return None
+
     def invoke(self, context, event):
         res = self.precheck(context)
         if res:
@@ -122,28 +683,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         self.base_bone_name = ob_names[1] if 2 <= len(ob_names) else 'Auto'
 
         # ボーン情報元のデフォルトオプションを取得
-        arm_ob = ob.parent
-        for mod in ob.modifiers:
-            if mod.type == 'ARMATURE' and mod.object:
-                arm_ob = mod.object
-        if arm_ob and not arm_ob.type == 'ARMATURE':
-            arm_ob = None
-
-        info_mode_was_armature = (self.bone_info_mode == 'ARMATURE')
-        if "BoneData" in context.blend_data.texts:
-            if "LocalBoneData" in context.blend_data.texts:
-                self.bone_info_mode = 'TEXT'
-        if "BoneData:0" in ob:
-            ver = ob.get("ModelVersion")
-            if ver and ver >= 1000:
-                self.version = str(ver)
-            if "LocalBoneData:0" in ob:
-                self.bone_info_mode = 'OBJECT_PROPERTY'
-        if arm_ob:
-            if info_mode_was_armature:
-                self.bone_info_mode = 'ARMATURE'
-            else:
-                self.bone_info_mode = 'ARMATURE_PROPERTY'
+        self.bone_info_mode, self.version = self.detect_bone_info_mode(context, ob, self.bone_info_mode, self.version)
 
         # エクスポート時のデフォルトパスを取得
         #if not self.filepath[-6:] == '.model':
@@ -159,6 +699,32 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
+    @staticmethod
+    def detect_bone_info_mode(context, ob, bone_info_mode='OBJECT_PROPERTY', version='AUTO'):
+        """ob に合ったボーン情報元とファイルバージョンを (bone_info_mode, version) で返す"""
+        arm_ob = ob.parent
+        for mod in ob.modifiers:
+            if mod.type == 'ARMATURE' and mod.object:
+                arm_ob = mod.object
+        if arm_ob and not arm_ob.type == 'ARMATURE':
+            arm_ob = None
+
+        info_mode_was_armature = (bone_info_mode == 'ARMATURE')
+        if "BoneData" in context.blend_data.texts:
+            if "LocalBoneData" in context.blend_data.texts:
+                bone_info_mode = 'TEXT'
+        if bone_data_property.has_bone_data(ob):
+            ver = ob.get("ModelVersion")
+            if ver and ver >= 1000:
+                version = str(ver)
+            bone_info_mode = 'OBJECT_PROPERTY'
+        if arm_ob:
+            if info_mode_was_armature:
+                bone_info_mode = 'ARMATURE'
+            else:
+                bone_info_mode = 'ARMATURE_PROPERTY'
+        return bone_info_mode, version
+
     # 'is_batch' がオンなら非表示
     def draw(self, context):
         self.layout.prop(self, 'scale')
@@ -167,6 +733,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         if not common.preferences().backup_ext:
             row.enabled = False
         self.layout.prop(self, 'is_arrange_name', icon='FILE_TICK')
+        self.layout.prop(self, 'is_incremental', icon=compat.icon('FILE_REFRESH'))
         box = self.layout.box()
         box.prop(self, 'version', icon='LINENUMBERS_ON')
         box.prop(self, 'model_name', icon='SORTALPHA')
@@ -190,7 +757,11 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         box.label(text="メッシュオプション")
         box.prop(self , 'is_align_to_base_bone', icon=compat.icon('OBJECT_ORIGIN'  ))
         box.prop(self , 'is_convert_tris'      , icon=compat.icon('MESH_DATA'      ))
+        row = box.row()
+        row.prop(self , 'quad_split_method'    , icon=compat.icon('MOD_TRIANGULATE'))
+        row.enabled = self.is_convert_tris
         box.prop(self , 'is_split_sharp'       , icon=compat.icon('MOD_EDGESPLIT'  ))
+        box.prop(self , 'use_evaluated_mesh'   , icon=compat.icon('MODIFIER_DATA'  ))
         box.prop(self , 'export_tangent'       , icon=compat.icon('CURVE_BEZCIRCLE'))
         sub_box = box.box()
         sub_box.prop(self , 'shapekey_threshold'     , icon=compat.icon('SHAPEKEY_DATA'      ), slider=True)
@@ -225,6 +796,8 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
     def execute(self, context):
         start_time = time.time()
         prefs = common.preferences()
+        self.profiler = profiling.create_profiler(prefs, os.path.basename(self.filepath))
+        self.profiler.stage('prepare')
 
         selected_objs = context.selected_objects
         source_objs = []
@@ -241,7 +814,16 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             if context.active_object.mode != 'OBJECT':
                 bpy.ops.object.mode_set(mode='OBJECT')
 
-            if self.is_batch:
+            mesh_objs = None
+            if self.use_evaluated_mesh:
+                # 複製・モディファイア適用・join をせずに、評価後のメッシュを直接読み込む
+                if self.is_batch:
+                    mesh_objs = [ob_source]
+                else:
+                    mesh_objs = [selected for selected in selected_objs if selected.type == 'MESH']
+                    if len(mesh_objs) > 1:
+                        self.report(type={'INFO'}, message=f_tip_("{}個のオブジェクトをマージしました", len(mesh_objs)))
+            elif self.is_batch:
                 # アクティブオブジェクトを１つコピーするだけでjoinしない
                 source_objs.append(ob_source)
                 compat.set_select(ob_source, False)
@@ -273,7 +855,10 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
                     bpy.ops.object.join()
                     self.report(type={'INFO'}, message=f_tip_("{}個のオブジェクトをマージしました", selected_count))
 
-            ret = self.export(context, ob_main)
+            if mesh_objs is None:
+                ret = self.export(context, ob_main)
+            else:
+                ret = self.export(context, ob_source, mesh_objs)
             if 'FINISHED' not in ret:
                 return ret
 
@@ -283,6 +868,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             return ret
         finally:
             # 作業データの破棄（コピーデータを削除、選択状態の復元、アクティブオブジェクト、モードの復元）
+            self.profiler.stage('cleanup')
             if ob_main:
                 common.remove_data(ob_main)
                 # me_copied = ob_main.data
@@ -298,8 +884,74 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             if prev_mode:
                 bpy.ops.object.mode_set(mode=prev_mode)
 
-    def export(self, context, ob):
-        """モデルファイルを出力"""
+            self.profiler.output(prefs.profile_log_path)
+            self.profiler = profiling.StageProfiler(enabled=False)
+
+    def export(self, context, ob, mesh_objects=None):
+        """モデルファイルを出力
+
+        mesh_objects を指定した場合は、ob を複製せずに mesh_objects の評価後のメッシュを結合して出力する
+        """
+        model_writer = self.build_writer(context, ob, mesh_objects)
+        if not isinstance(model_writer, ModelWriter):
+            return model_writer
+
+        model_writer.profiler = self.profiler
+        model_writer.progress = context.window_manager.progress_update
+        try:
+            model_writer.write_file(is_incremental=self.is_incremental)
+        except OSError:
+            self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
+            return {'CANCELLED'}
+        except common.CM3D2ExportError as e:
+            self.report(type={'ERROR'}, message=export_error_message(e))
+            return {'CANCELLED'}
+        finally:
+            model_writer.mesh_data.free()
+        if self.is_incremental:
+            section_cache = model_writer.section_cache
+            self.report(type={'INFO'}, message=f_tip_("Reused {} of {} sections from the previous export", section_cache.reused_count, section_cache.section_count))
+
+        return {'FINISHED'}
+
+    def build_batch_writer(self, context, ob):
+        """ob だけを読み込み、bpy に触れずに別スレッドで書き出せる ModelWriter を返す (一括エクスポート用)
+
+        失敗した場合は report してキャンセルオブジェクトを返す。
+        """
+        ob_main = None
+        try:
+            if self.use_evaluated_mesh:
+                model_writer = self.build_writer(context, ob, [ob])
+            else:
+                # アクティブオブジェクトを１つコピーするだけでjoinしない
+                compat.set_select(ob, False)
+                ob_main = self.copy_and_activate_ob(context, ob)
+                if common.preferences().is_apply_modifiers and bpy.ops.object.forced_modifier_apply.poll(context):
+                    bpy.ops.object.forced_modifier_apply(is_applies=[True for i in range(32)])
+                model_writer = self.build_writer(context, ob_main)
+            if not isinstance(model_writer, ModelWriter):
+                return model_writer
+
+            mesh_data = model_writer.mesh_data
+            try:
+                return model_writer.snapshot()
+            except common.CM3D2ExportError as e:
+                return self.report_cancel(export_error_message(e))
+            finally:
+                mesh_data.free()
+        finally:
+            if ob_main:
+                common.remove_data(ob_main)
+            compat.set_select(ob, True)
+            compat.set_active(context, ob)
+
+    def build_writer(self, context, ob, mesh_objects=None):
+        """ob (mesh_objects を指定した場合はその評価後のメッシュ) を読み込み、書き出す前の ModelWriter を返す
+
+        失敗した場合は report してキャンセルオブジェクトを返す。
+        成功した場合、ModelWriter.mesh_data の free() は呼び出し側で行う。
+        """
         prefs = common.preferences()
 
         if not self.is_batch:
@@ -314,7 +966,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             return res
         me = ob.data
 
-        if ob.active_shape_key_index != 0:
+        if mesh_objects is None and ob.active_shape_key_index != 0:
             ob.active_shape_key_index = 0
             me.update()
 
@@ -335,9 +987,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             if "LocalBoneData" not in context.blend_data.texts:
                 return self.report_cancel("テキスト「LocalBoneData」が見つかりません、中止します")
         elif self.bone_info_mode == 'OBJECT_PROPERTY':
-            if "BoneData:0" not in ob:
-                return self.report_cancel("オブジェクトのカスタムプロパティにボーン情報がありません")
-            if "LocalBoneData:0" not in ob:
+            if not bone_data_property.has_bone_data(ob):
                 return self.report_cancel("オブジェクトのカスタムプロパティにボーン情報がありません")
         elif self.bone_info_mode == 'ARMATURE_PROPERTY':
             arm_ob = ob.parent
@@ -349,17 +999,11 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
                 except StopIteration:
                     return self.report_cancel("アーマチュアが見つかりません、親にするかモディファイアにして下さい")
                 arm_ob = arm_ob.object
-            if "BoneData:0" not in arm_ob.data:
-                return self.report_cancel("アーマチュアのカスタムプロパティにボーン情報がありません")
-            if "LocalBoneData:0" not in arm_ob.data:
+            if not bone_data_property.has_bone_data(arm_ob.data):
                 return self.report_cancel("アーマチュアのカスタムプロパティにボーン情報がありません")
         else:
             return self.report_cancel("ボーン情報元のモードがおかしいです")
 
-        if self.mate_info_mode == 'TEXT':
-            for index, slot in enumerate(ob.material_slots):
-                if "Material:" + str(index) not in context.blend_data.texts:
-                    return self.report_cancel("マテリアル情報元のテキストが足りません")
         context.window_manager.progress_update(1)
 
         # model名とか
@@ -370,6 +1014,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             self.base_bone_name = ob_names[1] if 2 <= len(ob_names) else 'Auto'
 
         # BoneData情報読み込み
+        self.profiler.stage('bone data')
         base_bone_candidate = None
         bone_data = []
         if self.bone_info_mode == 'ARMATURE':
@@ -384,7 +1029,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             target = ob if self.bone_info_mode == 'OBJECT_PROPERTY' else arm_ob.data
             if 'BaseBone' in target:
                 base_bone_candidate = target['BaseBone']
-            bone_data = self.bone_data_parser(self.indexed_data_generator(target, prefix="BoneData:"))
+            bone_data = bone_data_property.read_bone_data(target)
         if len(bone_data) <= 0:
             return self.report_cancel("テキスト「BoneData」に有効なデータがありません")
 
@@ -396,14 +1041,31 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         bone_name_indices = {bone['name']: index for index, bone in enumerate(bone_data)}
         context.window_manager.progress_update(2)
 
-        if self.is_align_to_base_bone:
-            bpy.ops.object.align_to_cm3d2_base_bone(scale=1.0/self.scale, is_preserve_mesh=True, bone_info_mode=self.bone_info_mode)
-            me.update()
+        self.profiler.stage('mesh')
+        if mesh_objects is None:
+            if self.is_align_to_base_bone:
+                bpy.ops.object.align_to_cm3d2_base_bone(scale=1.0/self.scale, is_preserve_mesh=True, bone_info_mode=self.bone_info_mode)
+                me.update()
 
-        if self.is_split_sharp:
-            bpy.ops.object.mode_set(mode='EDIT')
-            bpy.ops.mesh.split_sharp()
-            bpy.ops.object.mode_set(mode='OBJECT')
+            if self.is_split_sharp:
+                bpy.ops.object.mode_set(mode='EDIT')
+                bpy.ops.mesh.split_sharp()
+                bpy.ops.object.mode_set(mode='OBJECT')
+
+            mesh_data = ObjectMeshData(ob)
+        else:
+            align_matrix = self.calc_align_matrix(context, ob) if self.is_align_to_base_bone else None
+            mesh_data = EvaluatedMeshData(context, mesh_objects, ob, apply_modifiers=prefs.is_apply_modifiers, matrix=align_matrix, split_sharp=self.is_split_sharp)
+            res = self.check_materials(mesh_data.materials)
+            if res:
+                return res
+            if 65535 < mesh_data.vertex_count:
+                return self.report_cancel("エクスポート可能な頂点数を大幅に超えています、最低でも65535未満には削減してください")
+
+        if self.mate_info_mode == 'TEXT':
+            for index, mat in enumerate(mesh_data.materials):
+                if "Material:" + str(index) not in context.blend_data.texts:
+                    return self.report_cancel("マテリアル情報元のテキストが足りません")
 
         # LocalBoneData情報読み込み
         local_bone_data = []
@@ -414,7 +1076,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
             local_bone_data = self.local_bone_data_parser(l.body for l in local_bone_data_text.lines)
         elif self.bone_info_mode in ['OBJECT_PROPERTY', 'ARMATURE_PROPERTY']:
             target = ob if self.bone_info_mode == 'OBJECT_PROPERTY' else arm_ob.data
-            local_bone_data = self.local_bone_data_parser(self.indexed_data_generator(target, prefix="LocalBoneData:"))
+            local_bone_data = bone_data_property.read_local_bone_data(target)
         if len(local_bone_data) <= 0:
             return self.report_cancel("テキスト「LocalBoneData」に有効なデータがありません")
         local_bone_name_indices = {bone['name']: index for index, bone in enumerate(local_bone_data)}
@@ -423,69 +1085,44 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         used_local_bone = {index: False for index, bone in enumerate(local_bone_data)}
         
         # ウェイト情報読み込み
-        vertices = []
+        self.profiler.stage('vertex groups')
+        vertex_bone_indices, vertex_weights, vertex_group_counts, used_indices = self.gather_vertex_weights(mesh_data, local_bone_name_indices)
+        if (vertex_group_counts == 0).any():
+            if not self.is_batch and mesh_objects is None:
+                self.select_no_weight_vertices(context, local_bone_name_indices)
+            return self.report_cancel("ウェイトが割り当てられていない頂点が見つかりました、中止します")
+        is_in_too_many = int(np.count_nonzero(vertex_group_counts > 4))
+
+        # Python の sum() と同じ順序で足し合わせる
+        total = vertex_weights[:, 0] + vertex_weights[:, 1] + vertex_weights[:, 2] + vertex_weights[:, 3]
         is_over_one = 0
         is_under_one = 0
-        is_in_too_many = 0
-        for i, vert in enumerate(me.vertices):
-            vgs: list[list[float]] = []
-            for vg in vert.groups:
-                if len(ob.vertex_groups) <= vg.group: # Apparently a vertex can be assigned to a non-existent group.
-                    continue
-                name = common.encode_bone_name(ob.vertex_groups[vg.group].name, self.is_convert_bone_weight_names)
-                index = local_bone_name_indices.get(name, -1)
-                if index >= 0 and (vg.weight > 0.0 or not self.is_clean_vertex_groups):
-                    vgs.append([index, vg.weight])
-                    # luvoid : track used bones
-                    used_local_bone[index] = True
-                    boneindex = bone_name_indices.get(name, -1)
-                    while boneindex >= 0:
-                        parent = bone_data[boneindex]
-                        localindex = local_bone_name_indices.get(parent['name'], -1)
-                        # could check for `localindex == -1` here, 
-                        # but its prescence may be useful in determing if the local bones resolve back to some root
-                        used_local_bone[localindex] = True
-                        boneindex = parent['parent_index']
-            if len(vgs) == 0:
-                if not self.is_batch:
-                    self.select_no_weight_vertices(context, local_bone_name_indices)
-                return self.report_cancel("ウェイトが割り当てられていない頂点が見つかりました、中止します")
-            if len(vgs) > 4:
-                is_in_too_many += 1
-            vgs = sorted(vgs, key=itemgetter(1), reverse=True)[0:4]
-            total = sum(vg[1] for vg in vgs)
-            if self.is_normalize_weight:
-                if True:
-                    # This fixed threshold is tuned to leave body001.model unchanged
-                    if abs(total - 1) > 1e-6:
-                        for vg in vgs:
-                            vg[1] /= total
-                else: 
-                    # Alternative Technique
-                    # Floating-point-errors can accumulate over repeated imports/exports here
-                    # so perform the normalization in a copy
-                    vgs_temp = vgs.copy()
-                    for i, vg in enumerate(vgs_temp):
-                        vg_temp = vg.copy()
-                        vg_temp[1] /= total
-                        vgs_temp[i] = vg_temp
-                    total_temp = sum(vg_temp[1] for vg_temp in vgs_temp)
-                    # Only apply the normalization if it brings the sum closer to 1
-                    if abs(total_temp - 1) < abs(total - 1):
-                        vgs = vgs_temp
-            else:
-                if 1.01 < total:
-                    is_over_one += 1
-                elif total < 0.99:
-                    is_under_one += 1
-            if len(vgs) < 4:
-                vgs += [(0, 0.0)] * (4 - len(vgs))
-            vertices.append({
-                'index': vert.index,
-                'face_indexs': list(map(itemgetter(0), vgs)),
-                'weights': list(map(itemgetter(1), vgs)),
-            })
-        
+        if self.is_normalize_weight:
+            # This fixed threshold is tuned to leave body001.model unchanged
+            is_unnormalized = np.abs(total - 1) > 1e-6
+            vertex_weights[is_unnormalized] /= total[is_unnormalized, np.newaxis]
+        else:
+            is_over_one = int(np.count_nonzero(1.01 < total))
+            is_under_one = int(np.count_nonzero(total < 0.99))
+
+        vertices = np.empty(len(vertex_weights), dtype=ModelWriter.vertex_weight_dtype)
+        vertices['bone_index'] = vertex_bone_indices
+        vertices['weight'] = vertex_weights
+
+        # luvoid : track used bones
+        # 使用されたボーンとその全ての祖先をまとめて辿る
+        visited_bones = set()
+        for index in used_indices.tolist():
+            used_local_bone[index] = True
+            boneindex = bone_name_indices.get(local_bone_data[index]['name'], -1)
+            while boneindex >= 0 and boneindex not in visited_bones:
+                visited_bones.add(boneindex)
+                parent = bone_data[boneindex]
+                localindex = local_bone_name_indices.get(parent['name'], -1)
+                if localindex >= 0:
+                    used_local_bone[localindex] = True
+                boneindex = parent['parent_index']
+
         if 1 <= is_over_one:
             self.report(type={'WARNING'}, message=f_tip_("ウェイトの合計が1.0を超えている頂点が見つかりました。正規化してください。超過している頂点の数:{}", is_over_one))
         if 1 <= is_under_one:
@@ -507,7 +1144,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
                 pass
             else:
                 print(f_tip_("Unexpected: used_local_bone[{key}] == {value} when len(used_local_bone) == {length}", key=index, value=is_used, length=len(used_local_bone)))
-                self.report(type={'WARNING'}, message=f_tip_("Could not find whether bone with index {index} was used. See console for more info.", index=i))
+                self.report(type={'WARNING'}, message=f_tip_("Could not find whether bone with index {index} was used. See console for more info.", index=index))
         if is_deleted > 0:
             self.report(type={'WARNING'}, message=f_tip_("頂点が割り当てられていない{num}つのローカルボーンが見つかりました。 詳細については、ログを参照してください。", num=is_deleted))
             self.report(type={'INFO'}, message=deleted_names)
@@ -516,348 +1153,35 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
         
 
         try:
-            writer = common.open_temporary(self.filepath, 'wb', is_backup=self.is_backup)
-        except:
-            self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
-            return {'CANCELLED'}
-
-        model_datas = {
-            'bone_data': bone_data,
-            'local_bone_data': local_bone_data,
-            'vertices': vertices,
-        }
-        try:
-            with writer:
-                self.write_model(context, ob, writer, **model_datas)
-        except common.CM3D2ExportError as e:
-            self.report(type={'ERROR'}, message=str(e))
-            return {'CANCELLED'}
-
-        return {'FINISHED'}
-
-    def write_model(self, context, ob: bpy.types.Object, writer, bone_data=[], local_bone_data=[], vertices=[]):
-        """モデルデータをファイルオブジェクトに書き込む"""
-        me = ob.data
-        prefs = common.preferences()
-
-        # ファイル先頭
-        common.write_str(writer, 'CM3D2_MESH')
-        if self.version == 'AUTO':
-            self.version_num = max(ob.get("ModelVersion", 1000), 1000)
-        else:
-            self.version_num = int(self.version)
-        writer.write(struct.pack('<i', self.version_num))
-
-        common.write_str(writer, self.model_name)
-        common.write_str(writer, self.base_bone_name)
-
-        # ボーン情報書き出し
-        writer.write(struct.pack('<i', len(bone_data)))
-        for bone in bone_data:
-            common.write_str(writer, bone['name'])
-            writer.write(struct.pack('<b', bone['scl']))
-        context.window_manager.progress_update(3.3)
-        for bone in bone_data:
-            writer.write(struct.pack('<i', bone['parent_index']))
-        context.window_manager.progress_update(3.7)
-        for bone in bone_data:
-            writer.write(struct.pack('<3f', bone['co'][0], bone['co'][1], bone['co'][2]))
-            writer.write(struct.pack('<4f', bone['rot'][1], bone['rot'][2], bone['rot'][3], bone['rot'][0]))
-            if self.version_num >= 2001:
-                use_scale = ('scale' in bone)
-                writer.write(struct.pack('<b', use_scale))
-                if use_scale:
-                    bone_scale = bone['scale']
-                    writer.write(struct.pack('<3f', bone_scale[0], bone_scale[1], bone_scale[2]))
-        context.window_manager.progress_update(4)
-
-        # 正しい頂点数などを取得
-        bm = bmesh.new()
-        bm.from_mesh(me)
-        uv_lay = bm.loops.layers.uv.active
-        vert_uvs = []
-        vert_uvs_append = vert_uvs.append
-        vert_iuv = {}
-        vert_indices = {}
-        vert_count = 0
-        for vert in bm.verts:
-            vert_uv = []
-            vert_uvs_append(vert_uv)
-            for loop in vert.link_loops:
-                uv = loop[uv_lay].uv
-                if uv not in vert_uv:
-                    vert_uv.append(uv)
-                    vert_iuv[hash((vert.index, uv.x, uv.y))] = vert_count
-                    vert_indices[vert.index] = vert_count
-                    vert_count += 1
-        if 65535 < vert_count:
-            raise common.CM3D2ExportError(f_tip_("頂点数がまだ多いです (現在{}頂点)。あと{}頂点以上減らしてください、中止します", vert_count, vert_count - 65535))
-        context.window_manager.progress_update(5)
-
-        writer.write(struct.pack('<2i', vert_count, len(ob.material_slots)))
-
-        # ローカルボーン情報を書き出し
-        writer.write(struct.pack('<i', len(local_bone_data)))
-        for bone in local_bone_data:
-            common.write_str(writer, bone['name'])
-        context.window_manager.progress_update(5.3)
-        for bone in local_bone_data:
-            for f in bone['matrix']:
-                writer.write(struct.pack('<f', f))
-        context.window_manager.progress_update(5.7)
-
-        # カスタム法線情報を取得
-        if me.has_custom_normals:
-            custom_normals = [mathutils.Vector() for i in range(len(me.vertices))]
-            me.calc_normals_split()
-            for loop in me.loops:
-                custom_normals[loop.vertex_index] += loop.normal
-            for no in custom_normals:
-                no.normalize()
-        else:
-            custom_normals = None
-
-        cm_verts = []
-        cm_norms = []
-        cm_uvs = []
-        # 頂点情報を書き出し
-        for i, vert in enumerate(bm.verts):
-            co = compat.convert_bl_to_cm_space( vert.co * self.scale )
-            if me.has_custom_normals:
-                no = custom_normals[vert.index]
+            # マテリアル情報読み込み
+            materials = []
+            for slot_index, material in enumerate(mesh_data.materials):
+                if self.mate_info_mode == 'MATERIAL':
+                    materials.append(cm3d2_data.MaterialHandler.parse_mate(material, self.is_arrange_name))
+                elif self.mate_info_mode == 'TEXT':
+                    text = context.blend_data.texts["Material:" + str(slot_index)].as_string()
+                    materials.append(cm3d2_data.MaterialHandler.parse_text(material, self.is_arrange_name))
+
+            if self.version == 'AUTO':
+                version_num = max(ob.get("ModelVersion", 1000), 1000)
             else:
-                no = vert.normal.copy()
-            no = compat.convert_bl_to_cm_space( no )
-            for uv in vert_uvs[i]:
-                cm_verts.append(co)
-                cm_norms.append(no)
-                cm_uvs.append(uv)
-                writer.write(struct.pack('<3f', co.x, co.y, co.z))
-                writer.write(struct.pack('<3f', no.x, no.y, no.z))
-                writer.write(struct.pack('<2f', uv.x, uv.y))
-        context.window_manager.progress_update(6)
-
-        cm_tris = self.parse_triangles(bm, ob, uv_lay, vert_iuv, vert_indices)
-
-        # 接空間情報を書き出し
-        if self.export_tangent:
-            tangents = self.calc_tangents(cm_tris, cm_verts, cm_norms, cm_uvs)
-            writer.write(struct.pack('<i', len(tangents)))
-            for t in tangents:
-                writer.write(struct.pack('<4f', *t))
-        else:
-            writer.write(struct.pack('<i', 0))
-
-        # ウェイト情報を書き出し
-        for vert in vertices:
-            for uv in vert_uvs[vert['index']]:
-                writer.write(struct.pack('<4H', *vert['face_indexs']))
-                writer.write(struct.pack('<4f', *vert['weights']))
-        context.window_manager.progress_update(7)
-
-        # 面情報を書き出し
-        for tri in cm_tris:
-            writer.write(struct.pack('<i', len(tri)))
-            for vert_index in tri:
-                writer.write(struct.pack('<H', vert_index))
-        context.window_manager.progress_update(8)
-
-        # マテリアルを書き出し
-        writer.write(struct.pack('<i', len(ob.material_slots)))
-        for slot_index, slot in enumerate(ob.material_slots):
-            if self.mate_info_mode == 'MATERIAL':
-                mat_data = cm3d2_data.MaterialHandler.parse_mate(slot.material, self.is_arrange_name)
-                mat_data.write(writer, write_header=False)
-
-            elif self.mate_info_mode == 'TEXT':
-                text = context.blend_data.texts["Material:" + str(slot_index)].as_string()
-                mat_data = cm3d2_data.MaterialHandler.parse_text(slot.material, self.is_arrange_name)
-                mat_data.write(writer, write_header=False)
-
-        context.window_manager.progress_update(9)
-
-        # モーフを書き出し
-        if me.shape_keys and len(me.shape_keys.key_blocks) >= 2:
-            try:
-                self.write_shapekeys(context, ob, writer, vert_uvs, custom_normals)
-            finally:
-                print("FINISHED SHAPE KEYS WRITE")
-                pass
-        common.write_str(writer, 'end')
-
-    def write_shapekeys(self, context, ob, writer, vert_uvs, custom_normals=None):
-        # モーフを書き出し
-        me = ob.data
-        prefs = common.preferences()
-        
-        is_use_attributes = (not compat.IS_LEGACY and bpy.app.version >= (2,92))
-
-        loops_vert_index = np.empty((len(me.loops)), dtype=int)
-        me.loops.foreach_get('vertex_index', loops_vert_index.ravel())
-
-        def find_normals_attribute(name) -> (bpy.types.Attribute, bool):
-            if is_use_attributes:
-                normals_color = me.attributes[name] if name in me.attributes.keys() else None
-                attribute_is_color = (not normals_color is None) and normals_color.data_type in {'BYTE_COLOR', 'FLOAT_COLOR'}
-            else:
-                normals_color = me.vertex_colors[name] if name in me.vertex_colors.keys() else None
-                attribute_is_color = True
-            return normals_color, attribute_is_color
-
-        if self.use_shapekey_colors:
-            static_attribute_colors = np.empty((len(me.loops), 4), dtype=float)
-            color_offset = np.array([[0.5,0.5,0.5]])
-            loops_per_vertex = np.zeros((len(me.vertices)))
-            for loop in me.loops:
-                loops_per_vertex[loop.vertex_index] += 1
-            loops_per_vertex_reciprocal = np.reciprocal(loops_per_vertex, out=loops_per_vertex).reshape((len(me.vertices), 1))
-        def get_sk_delta_normals_from_attribute(attribute, is_color, out):
-            if is_color:
-                attribute.data.foreach_get('color', static_attribute_colors.ravel())
-                loop_delta_normals = static_attribute_colors[:,:3]
-                loop_delta_normals -= color_offset
-                loop_delta_normals *= 2
-            else:
-                loop_delta_normals = static_attribute_colors[:,:3]
-                attribute.data.foreach_get('vector', loop_delta_normals.ravel())
-            
-            vert_delta_normals = out
-            vert_delta_normals.fill(0)
-
-            # for loop in me.loops: vert_delta_normals[loop.vertex_index] += loop_delta_normals[loop.index]
-            np.add.at(vert_delta_normals, loops_vert_index, loop_delta_normals) # XXX Slower but handles edge cases better
-            #vert_delta_normals[loops_vert_index] += loop_delta_normals # XXX Only first loop's value will be kept
-            
-            # for delta_normal in vert_delta_normals: delta_normal /= loops_per_vertex[vert.index]
-            vert_delta_normals *= loops_per_vertex_reciprocal
-
-            return out #.tolist()
-
-        if me.has_custom_normals:
-            basis_custom_normals = np.array(custom_normals, dtype=float)
-            static_loop_normals = np.empty((len(me.loops), 3), dtype=float)
-            static_vert_lengths = np.empty((len(me.vertices), 1), dtype=float)
-        def get_sk_delta_normals_from_custom_normals(shape_key, out):
-            vert_custom_normals = out
-            vert_custom_normals.fill(0)
-            
-            loop_custom_normals = static_loop_normals
-            np.copyto(loop_custom_normals.ravel(), shape_key.normals_split_get())
-            
-            # for loop in me.loops: vert_delta_normals[loop.vertex_index] += loop_delta_normals[loop.index]
-            if not self.is_split_sharp:  
-                # XXX Slower
-                np.add.at(vert_custom_normals, loops_vert_index, loop_custom_normals)
-                vert_len_sq = get_lengths_squared(vert_custom_normals, out=static_vert_lengths)
-                vert_len = np.sqrt(vert_len_sq, out=vert_len_sq)
-                np.reciprocal(vert_len, out=vert_len)
-                vert_custom_normals *= vert_len #.reshape((*vert_len.shape, 1))
-            else:
-                # loop normals should be the same per-vertex unless there is a sharp edge 
-                # or a flat shaded face, but all sharp edges were split, so this method is fine
-                # (and Flat shaded faces just won't be supported)
-                vert_custom_normals[loops_vert_index] += loop_custom_normals # Only first loop's value will be kept
-
-            vert_custom_normals -= basis_custom_normals
-            return out
-        
-        if not me.has_custom_normals:
-            basis_normals = np.empty((len(me.vertices), 3), dtype=float)
-            me.vertices.foreach_get('normal', basis_normals.ravel())
-        def get_sk_delta_normals_from_normals(shape_key, out):
-            vert_normals = out
-            np.copyto(vert_normals.ravel(), shape_key.normals_vertex_get())
-            vert_delta_normals = np.subtract(vert_normals, basis_normals, out=out)
-            return out
-
-        basis_co = np.empty((len(me.vertices), 3), dtype=float)
-        me.vertices.foreach_get('co', basis_co.ravel())
-        def get_sk_delta_coordinates(shape_key, out):
-            delta_coordinates = out
-            shape_key.data.foreach_get('co', delta_coordinates.ravel())
-            delta_coordinates -= basis_co
-            return out
-
-        static_array_sq = np.empty((len(me.vertices), 3), dtype=float)
-        def get_lengths_squared(vectors, out):
-            np.power(vectors, 2, out=static_array_sq)
-            np.sum(static_array_sq, axis=1, out=out.ravel())
-            return out
-
-        def write_morph(morph, name):
-            common.write_str(writer, 'morph')
-            common.write_str(writer, name)
-            writer.write(struct.pack('<i', len(morph)))
-            for v_index, vec, normal in morph:
-                vec    = compat.convert_bl_to_cm_space(vec   )
-                normal = compat.convert_bl_to_cm_space(normal)
-                writer.write(struct.pack('<H', v_index))
-                writer.write(struct.pack('<3f', *vec[:3]))
-                writer.write(struct.pack('<3f', *normal[:3]))
-        
-        # accessing operator properties via "self.x" is SLOW, so store some here
-        self__export_shapekey_normals = self.export_shapekey_normals
-        self__use_shapekey_colors = self.use_shapekey_colors
-        self__shapekey_normals_blend = self.shapekey_normals_blend
-        self__scale = self.scale
-        
-        co_diff_threshold = self.shapekey_threshold / 5
-        co_diff_threshold_squared = co_diff_threshold * co_diff_threshold
-        no_diff_threshold = self.shapekey_threshold * 10
-        no_diff_threshold_squared = no_diff_threshold * no_diff_threshold
-        
-        # shared arrays
-        delta_coordinates  = np.empty((len(me.vertices), 3), dtype=float)
-        vert_delta_normals = np.empty((len(me.vertices), 3), dtype=float)
-        loop_delta_normals = np.empty((len(me.loops   ), 3), dtype=float)
-
-        delta_co_lensq = np.empty((len(me.vertices)), dtype=float)
-        delta_no_lensq = np.empty((len(me.vertices)), dtype=float)
-
-        if not self.export_shapekey_normals:
-            vert_delta_normals.fill(0)
-            delta_no_lensq.fill(0)
-
-        # HEAVY LOOP
-        for shape_key in me.shape_keys.key_blocks[1:]:
-            morph = []
-
-            if self__export_shapekey_normals and self__use_shapekey_colors:
-                normals_color, attrubute_is_color = find_normals_attribute(f'{shape_key.name}_delta_normals')
-
-            if self__export_shapekey_normals:
-                if self__use_shapekey_colors and not normals_color is None:
-                    sk_delta_normals = get_sk_delta_normals_from_attribute(normals_color, attrubute_is_color, out=vert_delta_normals)
-                elif me.has_custom_normals:
-                    sk_delta_normals = get_sk_delta_normals_from_custom_normals(shape_key, out=vert_delta_normals)
-                    sk_delta_normals *= self__shapekey_normals_blend
-                else:
-                    sk_delta_normals = get_sk_delta_normals_from_normals(shape_key, out=vert_delta_normals)
-                    sk_delta_normals *= self__shapekey_normals_blend
-                
-                sk_no_lensq = get_lengths_squared(sk_delta_normals, out=delta_no_lensq)
-            else:
-                sk_delta_normals = vert_delta_normals
-                sk_no_lensq = delta_no_lensq
-
-            sk_co_diffs = get_sk_delta_coordinates(shape_key, out=delta_coordinates)
-            sk_co_diffs *= self__scale # scale before getting lengths
-            sk_co_lensq = get_lengths_squared(sk_co_diffs, out=delta_co_lensq)
-
-            # SUPER HEAVY LOOP
-            outvert_index = 0
-            for i in range(len(me.vertices)):
-                if sk_co_lensq[i] >= co_diff_threshold_squared or sk_no_lensq[i] >= no_diff_threshold_squared:
-                    morph += [ (outvert_index+j, sk_co_diffs[i], sk_delta_normals[i]) for j in range(len(vert_uvs[i])) ]
-                else:
-                    # ignore because change is too small (greatly lowers file size)
-                    pass
-                outvert_index += len(vert_uvs[i])
-
-            if prefs.skip_shapekey and not len(morph):
-                continue
-            else:
-                write_morph(morph, shape_key.name)
+                version_num = int(self.version)
+        except common.CM3D2ExportError as e:
+            mesh_data.free()
+            return self.report_cancel(export_error_message(e))
+        return ModelWriter(self, mesh_data, bone_data, local_bone_data, vertices, materials, version_num)
+
+    def calc_align_matrix(self, context, ob):
+        """基点ボーンに合わせるためのメッシュの変換を返す (align_to_cm3d2_base_bone の is_preserve_mesh と同じ)、不要なら None"""
+        # misc_OBJECT_PT_transform はこのモジュールを読み込んでいるので、ここで読み込む
+        from .misc_OBJECT_PT_transform import CNV_OT_align_to_cm3d2_base_bone
+        new_basis = CNV_OT_align_to_cm3d2_base_bone.find_basis(context, ob, self.bone_info_mode, 1.0/self.scale)
+        old_basis = ob.matrix_basis
+        if new_basis is None or new_basis == old_basis:
+            return None
+        # transform_apply(location=True, rotation=True, scale=False) と同じく拡縮は含めない
+        loc, rot, scale = compat.mul(new_basis.inverted(), old_basis).decompose()
+        return compat.mul(mathutils.Matrix.Translation(loc), rot.to_matrix().to_4x4())
 
     def write_tangents(self, writer, me):
         if len(me.uv_layers) < 1:
@@ -865,124 +1189,48 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
 
         num_loops = len(me.loops)
 
-    def parse_triangles(self, bm, ob, uv_lay, vert_iuv, vert_indices):
-        def vert_index_from_loops(loops):
-            """vert_index generator"""
-            for loop in loops:
-                uv = loop[uv_lay].uv
-                v_index = loop.vert.index
-                vert_index = vert_iuv.get(hash((v_index, uv.x, uv.y)))
-                if vert_index is None:
-                    vert_index = vert_indices.get(v_index, 0)
-                yield vert_index
-
-        triangles = []
-        for mate_index, slot in enumerate(ob.material_slots):
-            tris_faces = []
-            for face in bm.faces:
-                if face.material_index != mate_index:
-                    continue
-                if len(face.verts) == 3:
-                    tris_faces.extend(vert_index_from_loops(reversed(face.loops)))
-                elif len(face.verts) == 4 and self.is_convert_tris:
-                    v1 = face.loops[0].vert.co - face.loops[2].vert.co
-                    v2 = face.loops[1].vert.co - face.loops[3].vert.co
-                    if v1.length < v2.length:
-                        f1 = [0, 1, 2]
-                        f2 = [0, 2, 3]
-                    else:
-                        f1 = [0, 1, 3]
-                        f2 = [1, 2, 3]
-                    faces, faces2 = [], []
-                    for i, vert_index in enumerate(vert_index_from_loops(reversed(face.loops))):
-                        if i in f1:
-                            faces.append(vert_index)
-                        if i in f2:
-                            faces2.append(vert_index)
-                    tris_faces.extend(faces)
-                    tris_faces.extend(faces2)
-                elif 5 <= len(face.verts) and self.is_convert_tris:
-                    face_count = len(face.verts) - 2
-
-                    tris = []
-                    seek_min, seek_max = 0, len(face.verts) - 1
-                    for i in range(face_count):
-                        if not i % 2:
-                            tris.append([seek_min, seek_min + 1, seek_max])
-                            seek_min += 1
-                        else:
-                            tris.append([seek_min, seek_max - 1, seek_max])
-                            seek_max -= 1
-
-                    tris_indexs = [[] for _ in range(len(tris))]
-                    for i, vert_index in enumerate(vert_index_from_loops(reversed(face.loops))):
-                        for tris_index, points in enumerate(tris):
-                            if i in points:
-                                tris_indexs[tris_index].append(vert_index)
-
-                    tris_faces.extend(p for ps in tris_indexs for p in ps)
-
-            triangles.append(tris_faces)
-        return triangles
-
-    def calc_tangents(self, cm_tris, cm_verts, cm_norms, cm_uvs):
-        count = len(cm_verts)
-        tan1 = [None] * count
-        tan2 = [None] * count
-        for i in range(0, count):
-            tan1[i] = mathutils.Vector((0, 0, 0))
-            tan2[i] = mathutils.Vector((0, 0, 0))
-
-        for tris in cm_tris:
-            tri_len = len(tris)
-            tri_idx = 0
-            while tri_idx < tri_len:
-                i1, i2, i3 = tris[tri_idx], tris[tri_idx + 1], tris[tri_idx + 2]
-                v1, v2, v3 = cm_verts[i1], cm_verts[i2], cm_verts[i3]
-                w1, w2, w3 = cm_uvs[i1], cm_uvs[i2], cm_uvs[i3]
-
-                a1 = v2 - v1
-                a2 = v3 - v1
-                s1 = w2 - w1
-                s2 = w3 - w1
-                
-                r_inverse = (s1.x * s2.y - s2.x * s1.y)
-
-                if r_inverse != 0:
-                    # print("i1 = {i1}   i2 = {i2}   i3 = {i3}".format(i1=i1, i2=i2, i3=i3))
-                    # print("v1 = {v1}   v2 = {v2}   v3 = {v3}".format(v1=v1, v2=v2, v3=v3))
-                    # print("w1 = {w1}   w2 = {w2}   w3 = {w3}".format(w1=w1, w2=w2, w3=w3))
-
-                    # print("a1 = {a1}   a2 = {a2}".format(a1=a1, a2=a2))
-                    # print("s1 = {s1}   s2 = {s2}".format(s1=s1, s2=s2))
-                    
-                    # print("r_inverse = ({s1x} * {s2y} - {s2x} * {s1y}) = {r_inverse}".format(r_inverse=r_inverse, s1x=s1.x, s1y=s1.y, s2x=s2.x, s2y=s2.y))
-                                                
-                    r = 1.0 / r_inverse
-                    sdir = mathutils.Vector(((s2.y * a1.x - s1.y * a2.x) * r, (s2.y * a1.y - s1.y * a2.y) * r, (s2.y * a1.z - s1.y * a2.z) * r))
-                    tan1[i1] += sdir
-                    tan1[i2] += sdir
-                    tan1[i3] += sdir
-
-                    tdir = mathutils.Vector(((s1.x * a2.x - s2.x * a1.x) * r, (s1.x * a2.y - s2.x * a1.y) * r, (s1.x * a2.z - s2.x * a1.z) * r))
-                    tan2[i1] += tdir
-                    tan2[i2] += tdir
-                    tan2[i3] += tdir
-
-                tri_idx += 3
-
-        tangents = [None] * count
-        for i in range(0, count):
-            n = cm_norms[i]
-            ti = tan1[i]
-            t = (ti - n * n.dot(ti)).normalized()
-
-            c = n.cross(ti)
-            val = c.dot(tan2[i])
-            w = 1.0 if val < 0 else -1.0
-            tangents[i] = (-t.x, t.y, t.z, w)
-
-        return tangents
+    def gather_vertex_weights(self, mesh_data, local_bone_name_indices):
+        """頂点ごとにウェイトの大きい順に4つまでのローカルボーンのインデックスとウェイトを返す
+
+        戻り値は (ボーンのインデックス (頂点数, 4), ウェイト (頂点数, 4), 有効な頂点グループの数 (頂点数), 使用されたローカルボーンのインデックス)
+        4つに満たない分は (0, 0.0) で埋める。
+        """
+        vert_count = mesh_data.vertex_count
+
+        # 頂点グループのインデックス → ローカルボーンのインデックス
+        # 存在しない頂点グループに割り当てられている場合もあるので、末尾に -1 を加えておく
+        group_local_indices = np.array([
+            local_bone_name_indices.get(common.encode_bone_name(name, self.is_convert_bone_weight_names), -1)
+            for name in mesh_data.vertex_group_names
+        ] + [-1], dtype=np.int32)
+
+        # 頂点グループの割り当て (頂点, 頂点グループ, ウェイト) の平らな配列
+        member_verts = np.repeat(np.arange(vert_count), mesh_data.weight_counts)
+        member_locals = group_local_indices[np.minimum(mesh_data.weight_groups, len(mesh_data.vertex_group_names))]
+        member_weights = mesh_data.weight_values
+
+        is_valid = member_locals >= 0
+        if self.is_clean_vertex_groups:
+            is_valid &= member_weights > 0.0
+        member_verts = member_verts[is_valid]
+        member_locals = member_locals[is_valid]
+        member_weights = member_weights[is_valid]
+        valid_counts = np.bincount(member_verts, minlength=vert_count)
+
+        # 頂点ごとにウェイトの降順に並べる (同じウェイトは頂点グループの順のまま)
+        order = np.lexsort((-member_weights, member_verts))
+        member_verts = member_verts[order]
+        member_locals = member_locals[order]
+        member_weights = member_weights[order]
+        starts = np.cumsum(valid_counts) - valid_counts
+        ranks = np.arange(len(member_verts)) - np.repeat(starts, valid_counts)
+        is_top = ranks < 4
+
+        bone_indices = np.zeros((vert_count, 4), dtype=np.uint16)
+        weights = np.zeros((vert_count, 4), dtype=np.float64)
+        bone_indices[member_verts[is_top], ranks[is_top]] = member_locals[is_top]
+        weights[member_verts[is_top], ranks[is_top]] = member_weights[is_top]
+        return bone_indices, weights, valid_counts, np.unique(member_locals)
 
     def select_no_weight_vertices(self, context, local_bone_name_indices):
         """ウェイトが割り当てられていない頂点を選択する"""
@@ -1104,34 +1352,7 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
     @staticmethod
     def bone_data_parser(container):
         """BoneData テキストをパースして辞書を要素とするリストを返す"""
-        bone_data = []
-        bone_name_indices = {}
-        for line in container:
-            data = line.split(',')
-            if len(data) < 5:
-                continue
-
-            parent_name = data[2]
-            if parent_name.isdigit():
-                parent_index = int(parent_name)
-            else:
-                parent_index = bone_name_indices.get(parent_name, -1)
-
-            bone_datum = {
-                'name': data[0],
-                'scl': int(data[1]),
-                'parent_index': parent_index,
-                'co': list(map(float, data[3].split())),
-                'rot': list(map(float, data[4].split())),
-            }
-            # scale info (for version 2001 or later)
-            if len(data) >= 7:
-                if data[5] == '1':
-                    bone_scale = data[6]
-                    bone_datum['scale'] = list(map(float, bone_scale.split()))
-            bone_data.append(bone_datum)
-            bone_name_indices[data[0]] = len(bone_name_indices)
-        return bone_data
+        return bone_data_property.parse_bone_data(container)
 
     def armature_local_bone_data_parser(self, ob):
         """アーマチュアを解析してBoneDataを返す"""
@@ -1206,31 +1427,150 @@ class CNV_OT_export_cm3d2_model(bpy.types.Operator):
     @staticmethod
     def local_bone_data_parser(container):
         """LocalBoneData テキストをパースして辞書を要素とするリストを返す"""
-        local_bone_data = []
-        for line in container:
-            data = line.split(',')
-            if len(data) != 2:
-                continue
-            local_bone_data.append({
-                'name': data[0],
-                'matrix': list(map(float, data[1].split())),
-            })
-        return local_bone_data
+        return bone_data_property.parse_local_bone_data(container)
 
     @staticmethod
-    def indexed_data_generator(container, prefix='', max_index=9**9, max_pass=50):
+    def indexed_data_generator(container, prefix=''):
         """コンテナ内の数値インデックスをキーに持つ要素を昇順に返すジェネレーター"""
-        pass_count = 0
-        for i in range(max_index):
-            name = prefix + str(i)
-            if name not in container:
-                pass_count += 1
-                if max_pass < pass_count:
-                    return
-                continue
-            yield container[name]
+        return bone_data_property.indexed_data_generator(container, prefix)
+
+
+class ModelExporter():
+    """bpy.ops を介さずに CNV_OT_export_cm3d2_model のメソッドを呼ぶためのオブジェクト
+
+    オペレーターはインスタンスを作れないので、プロパティの既定値 (と properties で指定した値) を属性に持ち、
+    それ以外の属性はオペレーターのものを使う。report() されたメッセージは reports に溜める。
+    """
+    def __init__(self, **properties):
+        for prop in bpy.ops.export_mesh.export_cm3d2_model.get_rna_type().properties:
+            if prop.identifier != 'rna_type':
+                setattr(self, prop.identifier, prop.default)
+        for name, value in properties.items():
+            setattr(self, name, value)
+        self.profiler = profiling.StageProfiler(enabled=False)
+        self.reports = []  # (type, message) のリスト
+
+    def __getattr__(self, name):
+        attr = inspect.getattr_static(CNV_OT_export_cm3d2_model, name)
+        if hasattr(attr, '__get__'):
+            return attr.__get__(self, CNV_OT_export_cm3d2_model)
+        return attr
+
+    def report(self, type, message):
+        self.reports.append((type, message))
 
 
 # メニューを登録する関数
+@compat.BlRegister()
+class CNV_OT_batch_export_cm3d2_model(bpy.types.Operator):
+    bl_idname = 'export_mesh.batch_export_cm3d2_model'
+    bl_label = "CM3D2 Models, Batch (.model)"
+    bl_description = "Export each selected mesh object to its own model file. Meshes are read one by one, then the files are written in parallel"
+    bl_options = {'REGISTER'}
+
+    directory = bpy.props.StringProperty(subtype='DIR_PATH')
+    filter_glob = bpy.props.StringProperty(default="*.model", options={'HIDDEN'})
+
+    scale = bpy.props.FloatProperty(name="倍率", default=0.2, min=0.01, max=100, soft_min=0.01, soft_max=100, step=10, precision=2, description="エクスポート時のメッシュ等の拡大率です")
+    is_backup = bpy.props.BoolProperty(name="ファイルをバックアップ", default=True, description="ファイルに上書きする場合にバックアップファイルを複製します")
+    use_evaluated_mesh = bpy.props.BoolProperty(name="Export Evaluated Mesh", default=True, description="Read the meshes with their modifiers applied directly instead of copying, applying and joining the objects. Nothing is added to the blend file")
+    thread_count = bpy.props.IntProperty(name="Threads", default=0, min=0, max=64, description="Number of files written at the same time. 0 uses the number of processors")
+
+    @classmethod
+    def poll(cls, context):
+        return any(ob.type == 'MESH' for ob in context.selected_objects)
+
+    def invoke(self, context, event):
+        prefs = common.preferences()
+        self.directory = os.path.dirname(prefs.model_default_path or prefs.model_export_path)
+        self.is_backup = bool(prefs.backup_ext)
+        self.scale = 1.0 / prefs.scale
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def draw(self, context):
+        self.layout.prop(self, 'scale')
+        self.layout.prop(self, 'is_backup', icon='FILE_BACKUP')
+        self.layout.prop(self, 'use_evaluated_mesh', icon='MODIFIER')
+        self.layout.prop(self, 'thread_count')
+
+    def execute(self, context):
+        start_time = time.time()
+        if context.active_object and context.active_object.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        selected_objs = list(context.selected_objects)
+        active_ob = context.active_object
+        mesh_objs = [ob for ob in selected_objs if ob.type == 'MESH']
+
+        results = {}  # filepath: (読み込み秒数, Future または失敗理由)
+        thread_count = self.thread_count or os.cpu_count() or 1
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=thread_count)
+        try:
+            for ob in mesh_objs:
+                # 読み込みは bpy を使うのでメインスレッドで1つずつ行い、書き出しを別スレッドに渡す
+                model_name = common.remove_serial_number(ob.name).split('.')[0]
+                filepath = os.path.join(bpy.path.abspath(self.directory), model_name + ".model")
+                if filepath in results:
+                    results[filepath + ' (' + ob.name + ')'] = (0.0, f_tip_("Another object is exported to the same file"))
+                    continue
+
+                for selected in selected_objs:
+                    compat.set_select(selected, False)
+                compat.set_select(ob, True)
+                compat.set_active(context, ob)
+
+                bone_info_mode, version = CNV_OT_export_cm3d2_model.detect_bone_info_mode(context, ob)
+                exporter = ModelExporter(
+                    filepath=filepath, is_batch=True, scale=self.scale, is_backup=self.is_backup,
+                    use_evaluated_mesh=self.use_evaluated_mesh, bone_info_mode=bone_info_mode, version=version,
+                )
+                read_start_time = time.time()
+                model_writer = exporter.build_batch_writer(context, ob)
+                read_time = time.time() - read_start_time
+
+                errors = [message for type, message in exporter.reports if 'ERROR' in type]
+                for type, message in exporter.reports:
+                    if 'ERROR' not in type:
+                        self.report(type=type, message=message)
+                if not isinstance(model_writer, ModelWriter):
+                    results[filepath] = (read_time, errors[0] if errors else f_tip_("The export was cancelled"))
+                    continue
+                results[filepath] = (read_time, executor.submit(self.write_deferred, model_writer))
+        finally:
+            executor.shutdown(wait=True)
+            for selected in selected_objs:
+                compat.set_select(selected, True)
+            if active_ob:
+                compat.set_active(context, active_ob)
+
+        exported_count = 0
+        for filepath, (read_time, result) in results.items():
+            if isinstance(result, concurrent.futures.Future):
+                try:
+                    write_time = result.result()
+                except common.CM3D2ExportError as e:
+                    result = export_error_message(e)
+                except Exception as e:
+                    result = str(e)
+                else:
+                    exported_count += 1
+                    self.report(type={'INFO'}, message=f_tip_("{}: {:.2f} seconds (read {:.2f}, write {:.2f})", filepath, read_time + write_time, read_time, write_time))
+                    continue
+            self.report(type={'WARNING'}, message=f_tip_("{}: failed, {}", filepath, result))
+
+        diff_time = time.time() - start_time
+        self.report(type={'INFO'}, message=f_tip_("Exported {} of {} models in {:.2f} seconds", exported_count, len(results), diff_time))
+        return {'FINISHED'} if exported_count else {'CANCELLED'}
+
+    @staticmethod
+    def write_deferred(model_writer):
+        """別スレッドで model_writer を書き出し、かかった秒数を返す"""
+        start_time = time.time()
+        model_writer.write_file()
+        return time.time() - start_time
+
+
 def menu_func(self, context):
     self.layout.operator(CNV_OT_export_cm3d2_model.bl_idname, icon_value=common.kiss_icon())
+    self.layout.operator(CNV_OT_batch_export_cm3d2_model.bl_idname, icon_value=common.kiss_icon())
@@ -0,0 +1,215 @@
+"""modelファイルのレイアウトと、ヘッダー部分だけを読み込む scan_model() (bpy は使わない)
+
+エラーは翻訳せずに ModelFileError として投げる (メッセージは呼び出し側で翻訳する)。
+"""
+from __future__ import annotations
+
+import struct
+
+import numpy as np
+
+from . import codec
+from . import fileutil
+
+
+# 頂点ウェイト1頂点分のレイアウト (ボーンインデックス x4 + ウェイト x4)
+WEIGHT_DTYPE = np.dtype([('index', '<u2', (4,)), ('value', '<f4', (4,))])
+# 接空間情報1頂点分のレイアウト
+TANGENT_DTYPE = np.dtype(('<f4', (4,)))
+# ボーンの位置と回転 (x, y, z, rx, ry, rz, rw)
+BONE_TRANSFORM = struct.Struct('<7f')
+# CR Edit で追加されたUVの使用フラグ
+EXTRA_UV_USES = struct.Struct('<7?')
+
+
+def vertex_dtype(model_ver, extra_uv_uses=()) -> np.dtype:
+    """頂点ブロック1頂点分のレイアウトを model_ver と extra_uv_uses から組み立てる"""
+    fields = [
+        ('co'    , '<f4', (3,)),
+        ('normal', '<f4', (3,)),
+        ('uv'    , '<f4', (2,)),
+    ]
+    extra_uv_count = sum(1 for used in extra_uv_uses if used) if model_ver >= 2102 else 0
+    if extra_uv_count: # CR Edit
+        fields.append(('extra_uvs', '<f4', (extra_uv_count, 2)))
+    return np.dtype(fields)
+
+
+def morph_dtype(extra_uvs: bool = False) -> np.dtype:
+    """シェイプキーの頂点レコードの dtype を返す"""
+    fields = [
+        ('index' , '<u2'      ),
+        ('co'    , '<f4', (3,)),
+        ('normal', '<f4', (3,)),
+    ]
+    if extra_uvs:
+        fields.append(('color', '<f4', (4,)))
+    return np.dtype(fields)
+
+
+class ModelFileError(Exception):
+    """modelファイルの読み込みで起きたエラー
+
+    別スレッドでは翻訳しないように、メッセージは model_import.model_file_error_message() でメインスレッドから作る。
+    kind は 'open' (開けない), 'read' (読み込みに失敗), 'cache' (キャッシュへの保存に失敗) のいずれか。
+    'cache' の場合は読み込み自体は成功している。
+    """
+    def __init__(self, filepath, kind: str, error: Exception | None = None, position: int | None = None):
+        super().__init__(filepath, kind, error, position)
+        self.filepath = filepath
+        self.kind = kind
+        self.error = error
+        self.position = position
+
+    @classmethod
+    def from_read_error(cls, filepath, reader, e: Exception) -> "ModelFileError":
+        """読み込み中に投げられた例外から、読み込み位置を含むエラーを作る"""
+        pos = reader.tell()
+        if isinstance(e, UnicodeDecodeError):
+            pos -= len(e.object)
+        return cls(filepath, 'read', e, pos)
+
+
+class MaterialSummary():
+    """modelファイル内のマテリアルの概要データクラス"""
+    def __init__(self, name=None, shader=None):
+        self.name = name
+        self.shader = shader
+        self.texture_paths = []
+
+
+class ModelSummary():
+    """modelファイルの概要データクラス (頂点・ウェイト・面などの大きなデータは含まない)"""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.version = None
+        self.name = None
+        self.base_bone_name = None
+        self.bone_names = []
+        self.local_bone_names = []
+        self.vertex_count = 0
+        self.face_counts = []  # メッシュ (マテリアル) ごとの面数
+        self.materials = []  # MaterialSummary
+        self.morph_names = []
+
+    @property
+    def material_names(self) -> list[str]:
+        return [mate.name for mate in self.materials]
+
+    @property
+    def texture_paths(self) -> list[str]:
+        """マテリアルが参照するテクスチャのパス (重複なし、出現順)"""
+        paths = {}
+        for mate in self.materials:
+            for path in mate.texture_paths:
+                paths.setdefault(path, None)
+        return list(paths)
+
+
+def scan_material(reader, model_ver) -> MaterialSummary:
+    """modelファイル内のマテリアルを1つ読み、概要を返す (cm3d2_data.Material.read と同じ形式)"""
+    mate = MaterialSummary(reader.read_str())
+    mate.shader = reader.read_str()
+    reader.read_str() # shader2
+
+    if model_ver >= 2102 and reader.peek()[:1] in (b'\x00', b'\x01'): # CR Edit Mode
+        reader.skip(codec.FLOAT.size * reader.read_view(1)[0])
+
+    while True:
+        prop_type = reader.read_str()
+        if prop_type == 'tex':
+            reader.read_str() # prop_name
+            if reader.read_str() == 'tex2d':
+                reader.read_str() # tex_name
+                mate.texture_paths.append(reader.read_str())
+                reader.skip(codec.VEC2.size * 2) # offset, scale
+        elif prop_type == 'col':
+            reader.read_str()
+            reader.skip(codec.VEC4.size)
+        elif prop_type in ('f', 'range', 'keyword'):
+            reader.read_str()
+            reader.skip(codec.FLOAT.size)
+        elif prop_type == '_ALPHAPREMULTIPLY_ON':
+            reader.skip(codec.BOOL.size)
+        elif prop_type == 'end':
+            return mate
+        else:
+            raise ValueError(f"Materialプロパティに未知の設定値タイプ({prop_type})が見つかりました。")
+
+
+def scan_model(filepath) -> ModelSummary:
+    """modelファイルのヘッダー部分だけを読み込み、概要を返す
+
+    頂点・ウェイト・面・モーフのデータは個数から大きさを求めて読み飛ばすので、
+    頂点ごとのデータは一切確保しない。
+    失敗した場合は翻訳前のエラーを持つ ModelFileError を投げる。
+    """
+    try:
+        reader = fileutil.MemoryMappedReader(filepath)
+    except OSError as e:
+        raise ModelFileError(filepath, 'open', e)
+    with reader:
+        try:
+            return _scan_model(reader, ModelSummary(filepath))
+        except (UnicodeDecodeError, struct.error, ValueError) as e:
+            raise ModelFileError.from_read_error(filepath, reader, e)
+
+
+def _scan_model(reader, summary: ModelSummary) -> ModelSummary:
+    try:
+        ext = reader.read_str()
+    except UnicodeDecodeError:
+        ext = None
+    if ext != 'CM3D2_MESH':
+        raise ValueError("これはカスタムメイド3D2のモデルファイルではありません")
+    model_ver = summary.version = reader.read_i32()
+    summary.name = reader.read_str()
+    summary.base_bone_name = reader.read_str()
+
+    bone_count = reader.read_i32()
+    for i in range(bone_count):
+        summary.bone_names.append(reader.read_str())
+        reader.skip(1) # scl
+    reader.skip(4 * bone_count) # parent_index
+    if model_ver >= 2001:
+        for i in range(bone_count):
+            reader.skip(BONE_TRANSFORM.size)
+            if reader.read_view(1)[0]: # use_scale
+                reader.skip(codec.VEC3.size)
+    else:
+        reader.skip(BONE_TRANSFORM.size * bone_count)
+
+    vertex_count, mesh_count, local_bone_count = reader.unpack(codec.INT32x3)
+    summary.vertex_count = vertex_count
+    for i in range(local_bone_count):
+        summary.local_bone_names.append(reader.read_str())
+    reader.skip(4 * 16 * local_bone_count)
+
+    extra_uv_uses = ()
+    if model_ver >= 2102: # CR Edit Mode
+        extra_uv_uses = reader.unpack(EXTRA_UV_USES)
+    reader.skip(vertex_dtype(model_ver, extra_uv_uses).itemsize * vertex_count)
+    reader.skip(TANGENT_DTYPE.itemsize * reader.read_i32())
+    reader.skip(WEIGHT_DTYPE.itemsize * vertex_count)
+
+    for i in range(mesh_count):
+        face_count = int(reader.read_i32() / 3)
+        summary.face_counts.append(face_count)
+        reader.skip(2 * 3 * face_count)
+
+    material_count = reader.read_i32()
+    for i in range(material_count):
+        summary.materials.append(scan_material(reader, model_ver))
+
+    while reader.tell() < reader.size:
+        data_type = reader.read_str()
+        if data_type != 'morph':
+            break
+        summary.morph_names.append(reader.read_str())
+        morph_vert_count = reader.read_i32()
+        morph_extra_uvs = False
+        if model_ver >= 2102: # CR Edit Mode
+            morph_extra_uvs = reader.unpack(codec.BOOL)[0]
+        reader.skip(morph_dtype(morph_extra_uvs).itemsize * morph_vert_count)
+
+    return summary
@@ -1,20 +1,348 @@
+import concurrent.futures
 import os
 import math
 import struct
+import tempfile
 import time
 import traceback
 import bpy
 import bpy_extras
-import bmesh
 import mathutils
-from collections import Counter
+import numpy as np
+from . import codec
 from . import common
 from . import compat
 from . import cm3d2_data
+from . import bone_data_property
+from . import fileutil
+from . import model_cache
+from . import model_format
+from .model_format import WEIGHT_DTYPE, TANGENT_DTYPE, vertex_dtype, morph_dtype, ModelFileError, ModelSummary, scan_model
+from . import profiling
 from .translations.pgettext_functions import *
 from .misc_OBJECT_PT_transform import CNV_OT_align_to_cm3d2_base_bone
 
 
+def duplicate_vertex_mask(vertex_data: np.ndarray) -> np.ndarray:
+    """位置と法線のバイト列が他の頂点と完全に一致する頂点のマスクを返す"""
+    keys = np.ascontiguousarray(np.concatenate((vertex_data['co'], vertex_data['normal']), axis=1))
+    keys = keys.view(np.dtype((np.void, keys.itemsize * keys.shape[1]))).ravel()
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    return counts[inverse.ravel()] > 1
+
+
+class ModelData():
+    """modelファイルから読み込んだデータクラス (bpy を使わずに作成できる)"""
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.version = None
+        self.name = None
+        self.base_bone_name = None
+        self.bone_data = []  # 'co' は (x, y, z)、'rot' は (w, x, y, z) のタプル
+        self.local_bone_data = []  # 'matrix' は 4x4 のリスト
+        self.extra_uv_uses = [False] * 7
+        self.vertex_data = None  # vertex_dtype() の構造化配列
+        self.weight_data = None  # WEIGHT_DTYPE の構造化配列
+        self.face_data = []  # メッシュ (マテリアル) ごとの (面数, 3) の配列
+        self.material_data = []  # cm3d2_data.Material
+        self.misc_data = []
+
+
+def read_model(reader, progress_update=lambda value: None, profiler: profiling.StageProfiler | None = None, log=lambda msg, **kwargs: None) -> ModelData:
+    """modelファイルを読み込み、ModelData を返す (bpy は使わない)
+
+    読み込みに失敗した場合は UnicodeDecodeError, struct.error, common.CM3D2ImportError のいずれかを投げる。
+    デバッグ用のメッセージは翻訳前の文字列と書式の引数で log に渡す (翻訳と出力は呼び出し側で行う)。
+    """
+    profiler = profiler or profiling.StageProfiler(enabled=False)
+
+    # ヘッダー
+    profiler.stage('header')
+    ext = None
+    try: # luvoid : utf-8 decoding could possibly throw an error here
+        ext = reader.read_str()
+    except:
+        ext = False
+    if ext != 'CM3D2_MESH':
+        raise common.CM3D2ImportError("これはカスタムメイド3D2のモデルファイルではありません")
+    model_ver = reader.read_i32()
+    progress_update(0.1)
+
+    # 名前群を取得
+    model_name1 = reader.read_str()
+    model_name2 = reader.read_str()
+    progress_update(0.2)
+
+    # ボーン情報読み込み
+    profiler.stage('bones')
+    bone_data = []
+    bone_count = reader.read_i32()
+    for i in range(bone_count):
+        name = reader.read_str()
+        scl = reader.read_view(1)[0]
+        bone_data.append({'name': name, 'scl': scl})
+
+    for i, parent_index in enumerate(reader.read_array('<i4', bone_count).tolist()):
+        parent_name = None
+        if parent_index != -1:
+            parent_name = bone_data[parent_index]['name']
+        bone_data[i]['parent_index'] = parent_index
+        bone_data[i]['parent_name'] = parent_name
+
+    for i in range(bone_count):
+        x, y, z, rx, ry, rz, rw = reader.unpack(model_format.BONE_TRANSFORM)
+        bone_data[i]['co'] = (x, y, z)
+        bone_data[i]['rot'] = (rw, rx, ry, rz)
+        if model_ver >= 2001:
+            use_scale = reader.read_view(1)[0]
+            if use_scale:
+                log("{name} has scale data!", name=bone_data[i]['name'])
+                bone_data[i]['scale'] = list(reader.unpack(codec.VEC3))
+
+    progress_update(0.3)
+
+    log("Reading vertex, mesh, and local bone count at 0x{num:02X}", num=reader.tell())
+    vertex_count, mesh_count, local_bone_count = reader.unpack(codec.INT32x3)
+
+    # ローカルボーン情報読み込み
+    local_bone_data = []
+    for i in range(local_bone_count):
+        local_bone_data.append({'name': reader.read_str()})
+
+    local_bone_matrices = reader.read_array('<f4', local_bone_count * 16).reshape((local_bone_count, 4, 4))
+    for i, matrix in enumerate(local_bone_matrices.tolist()):
+        local_bone_data[i]['matrix'] = matrix
+    progress_update(0.4)
+
+    # 頂点情報読み込み
+    profiler.stage('vertices')
+    log("Reading vertex data at 0x{num:02X}", num=reader.tell())
+    extra_uv_uses = [False] * 7
+    if model_ver >= 2102: # CR Edit Mode
+        extra_uv_uses = reader.unpack(model_format.EXTRA_UV_USES)
+        log("extra_uv_uses = {boollist}", boollist=extra_uv_uses)
+    vertex_data = reader.read_array(vertex_dtype(model_ver, extra_uv_uses), vertex_count)
+    profiler.stage('weights')
+    log("Reading unknown count at 0x{num:02X}", num=reader.tell())
+    unknown_count = reader.read_i32()
+    reader.skip(TANGENT_DTYPE.itemsize * unknown_count)
+    weight_data = reader.read_array(WEIGHT_DTYPE, vertex_count)
+    progress_update(0.5)
+    # 面情報読み込み
+    profiler.stage('faces')
+    face_data = []
+    for i in range(mesh_count):
+        face_count = int(reader.read_i32() / 3)
+        datum = reader.read_array('<u2', face_count * 3).reshape((face_count, 3))[:, ::-1]
+        face_data.append(datum)
+    progress_update(0.6)
+
+    # マテリアル情報読み込み
+    # TODO MaterialHandlerに変更
+    profiler.stage('materials')
+    material_names = {}
+    material_data = []
+    material_count = reader.read_i32()
+    for i in range(material_count):
+        log("mate count: {num} of {count} @ 0x{pos:02X}", num=i, count=material_count, pos=reader.tell())
+        data = cm3d2_data.MaterialHandler.read(reader, read_header=False, version=model_ver)
+        
+        data.name1 = data.name.lower()
+        if data.name1 in material_names:
+            log("duplicate material name found! {name}", name=data.name1)
+            material_names[data.name1] += 1
+            new_name = data.name.lower() + "_" + str(material_names.get(data.name.lower()))
+            data.name1 = new_name
+        
+        material_names[data.name1] = 1
+        material_data.append(data)
+        
+        # name1 = common.read_str(reader)
+        # name2 = common.read_str(reader)
+        # name3 = common.read_str(reader)
+        # data_list = []
+        # material_data.append({'name1': name1, 'name2': name2, 'name3': name3, 'data': data_list})
+        # while True:
+        #     data_type = common.read_str(reader)
+        #     if data_type == 'tex':
+        #         data_item = {'type': data_type}
+        #         data_list.append(data_item)
+        #         data_item['name'] = common.read_str(reader)
+        #         data_item['type2'] = common.read_str(reader)
+        #         if data_item['type2'] == 'tex2d':
+        #             data_item['name2'] = common.read_str(reader)
+        #             data_item['path'] = common.read_str(reader)
+        #             data_item['tex_map'] = struct.unpack('<4f', reader.read(4*4))
+        #     elif data_type == 'col':
+        #         name = common.read_str(reader)
+        #         col = struct.unpack('<4f', reader.read(4*4))
+        #         data_list.append({'type': data_type, 'name': name, 'color': col})
+        #     elif data_type == 'f':
+        #         name = common.read_str(reader)
+        #         fval = struct.unpack('<f', reader.read(4))[0]
+        #         data_list.append({'type': data_type, 'name': name, 'float': fval})
+        #     else:
+        #         break
+
+    progress_update(0.8)
+
+    # その他情報読み込み
+    profiler.stage('morphs')
+    misc_data = []
+    while True:
+        #print(f_("Reading data_type at 0x{num:02X}", num=reader.tell()))
+        data_type = reader.read_str()
+        if data_type == 'morph':
+            misc_item = {'type': data_type}
+            misc_data.append(misc_item)
+            misc_item['name'] = reader.read_str()
+            morph_vert_count = reader.read_i32()
+            morph_extra_uvs = False
+            if model_ver >= 2102: # CR Edit Mode
+                morph_extra_uvs = reader.unpack(codec.BOOL)[0]
+                misc_item['uvs'] = []
+                log("{morph}.morph_extra_uvs @ 0x{pos:02X} = {bool}", morph=misc_item['name'], bool=morph_extra_uvs, pos=reader.tell()-1)
+            misc_item['data'] = reader.read_array(morph_dtype(morph_extra_uvs), morph_vert_count)
+        else:
+            break
+
+    model = ModelData(getattr(reader, 'name', None))
+    model.version = model_ver
+    model.name = model_name1
+    model.base_bone_name = model_name2
+    model.bone_data = bone_data
+    model.local_bone_data = local_bone_data
+    model.extra_uv_uses = extra_uv_uses
+    model.vertex_data = vertex_data
+    model.weight_data = weight_data
+    model.face_data = face_data
+    model.material_data = material_data
+    model.misc_data = misc_data
+    return model
+
+
+def print_log(msg, **kwargs):
+    """read_model() の log に渡す、翻訳して出力する関数 (メインスレッドから使う)"""
+    print(f_(msg, **kwargs))
+
+
+def model_file_error_message(error: ModelFileError) -> list[str]:
+    """ModelFileError を翻訳したメッセージにする (メインスレッドから呼ぶこと)"""
+    if error.kind == 'open':
+        return [f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", error.filepath)]
+    if error.kind == 'cache':
+        return [f_tip_("Failed to write model cache: {error}", error=error.error)]
+    return [
+        f_tip_("Error reading file at byte 0x{num:02X}", num=error.position) + "\n",
+        str(error.error) + "\n",
+        *traceback.format_tb(error.error.__traceback__)
+    ]
+
+
+def get_model_cache() -> model_cache.ModelCache | None:
+    """設定でキャッシュが有効であれば ModelCache を返す (メインスレッドから呼ぶこと)"""
+    prefs = common.preferences()
+    if not prefs.is_model_cache:
+        return None
+    directory = prefs.model_cache_path and bpy.path.abspath(prefs.model_cache_path)
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), "CM3D2 Converter", "model_cache")
+    return model_cache.ModelCache(directory, prefs.model_cache_size * 1024 * 1024)
+
+
+def store_model_cache(cache: model_cache.ModelCache, model_data: ModelData) -> ModelFileError | None:
+    """キャッシュへの保存に失敗してもインポートは続ける (失敗した場合はそのエラーを返す)"""
+    try:
+        cache.store(model_data.filepath, model_data)
+    except Exception as e:
+        return ModelFileError(model_data.filepath, 'cache', e)
+    return None
+
+
+def load_model_file(filepath, cache: model_cache.ModelCache | None = None, profiler: profiling.StageProfiler | None = None) -> tuple[ModelData | None, ModelFileError | None]:
+    """ファイルを開いて read_model() を行う (bpy を使わないので別スレッドから呼べる)
+
+    成功した場合は (ModelData, None) を、失敗した場合は (None, ModelFileError) を返す。
+    cache が指定された場合は、有効なキャッシュがあればそれを使い、無ければ読み込み結果を保存する。
+    キャッシュへの保存だけに失敗した場合は (ModelData, ModelFileError) を返す。
+    """
+    profiler = profiler or profiling.StageProfiler(enabled=False)
+    if cache:
+        profiler.stage('cache read')
+        model_data = cache.load(filepath, ModelData)
+        profiler.end_stage()
+        if model_data:
+            return model_data, None
+    try:
+        reader = fileutil.MemoryMappedReader(filepath)
+    except OSError as e:
+        return None, ModelFileError(filepath, 'open', e)
+    with reader:
+        try:
+            model_data = read_model(reader, profiler=profiler)
+        except (UnicodeDecodeError, struct.error, common.CM3D2ImportError) as e:
+            return None, ModelFileError.from_read_error(filepath, reader, e)
+        finally:
+            profiler.end_stage()
+        model_data.filepath = filepath
+        error = None
+        if cache:
+            profiler.stage('cache write')
+            error = store_model_cache(cache, model_data)
+            profiler.end_stage()
+        return model_data, error
+
+
+_BONE_PENDING = -1
+_BONE_ORPHAN = -2
+
+def sort_child_bone_data(bone_data: list[dict], bone_names: list[str]) -> tuple[list[int], list[int]]:
+    """子ボーンのインデックスを作成順 (親ボーンが必ず先) に並べて返す
+
+    以前の「親が未作成のボーンをキューの末尾に回す」処理と同じ順番を線形時間で求める。
+    親をたどれない (存在しない/循環している) ボーンは2つ目のリストで返す。
+    """
+    name_to_index = {}
+    for index, name in enumerate(bone_names):
+        name_to_index.setdefault(name, index)
+
+    parents = []
+    rounds = []
+    for data in bone_data:
+        if not data['parent_name']:
+            parents.append(None)
+            rounds.append(0)
+        else:
+            parents.append(name_to_index.get(bone_names[data['parent_index']]))
+            rounds.append(None)
+
+    # rounds[i] : そのボーンが作成される、キューの何周目か (基幹ボーンは 0)
+    for start in range(len(bone_data)):
+        path = []
+        index = start
+        while index is not None and rounds[index] is None:
+            rounds[index] = _BONE_PENDING
+            path.append(index)
+            index = parents[index]
+        if index is None or rounds[index] < 0:
+            parent_round = _BONE_ORPHAN
+        else:
+            parent_round = rounds[index]
+        for index in reversed(path):
+            if parent_round == _BONE_ORPHAN:
+                rounds[index] = _BONE_ORPHAN
+            elif parent_round == 0:
+                rounds[index] = 1
+            else:
+                # 同じ周で親より後ろにあれば、その周のうちに作成される
+                rounds[index] = parent_round + (0 if index > parents[index] else 1)
+            parent_round = rounds[index]
+
+    child_order = sorted((index for index, r in enumerate(rounds) if r > 0), key=lambda index: (rounds[index], index))
+    orphans = [index for index, r in enumerate(rounds) if r == _BONE_ORPHAN]
+    return child_order, orphans
+
+
 # メインオペレーター
 @compat.BlRegister()
 #@bpy_extras.io_utils.orientation_helper(axis_forward='-Z', axis_up='Y')
@@ -25,6 +353,8 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
     bl_options = {'REGISTER'}
 
     filepath = bpy.props.StringProperty(subtype='FILE_PATH')
+    files = bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory = bpy.props.StringProperty(subtype='DIR_PATH', options={'HIDDEN', 'SKIP_SAVE'})
     filename_ext = ".model"
     filter_glob = bpy.props.StringProperty(default="*.model", options={'HIDDEN'})
 
@@ -52,6 +382,9 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
     is_bone_data_obj_property = bpy.props.BoolProperty(name="オブジェクトのカスタムプロパティ", default=True, description="メッシュオブジェクトのカスタムプロパティにボーン情報を埋め込みます")
     is_bone_data_arm_property = bpy.props.BoolProperty(name="アーマチュアのカスタムプロパティ", default=True, description="アーマチュアデータのカスタムプロパティにボーン情報を埋め込みます")
     texpath_dict = None
+    image_cache = None  # 複数ファイルのインポート中のみ使用
+    material_cache = None  # 複数ファイルのインポート中のみ使用
+    profiler = profiling.StageProfiler(enabled=False)  # インポート中のみ設定される
 
     @classmethod
     def poll(cls, context):
@@ -121,6 +454,10 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         box.prop(self, 'is_bone_data_arm_property', icon='ARMATURE_DATA')
 
     def execute(self, context):
+        filepaths = self.get_filepaths()
+        if len(filepaths) > 1:
+            return self.execute_batch(context, filepaths)
+
         start_time = time.time()
 
         prefs = common.preferences()
@@ -135,229 +472,144 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
 
         #global_matrix = bpy_extras.io_utils.axis_conversion(from_forward=self.axis_forward, from_up=self.axis_up).to_4x4()
 
-        try:
-            reader = open(self.filepath, 'rb')
-        except:
-            self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
-            return {'CANCELLED'}
+        profiler = profiling.create_profiler(prefs, os.path.basename(self.filepath))
+        cache = get_model_cache()
+        model_data = None
+        if cache:
+            profiler.stage('cache read')
+            model_data = cache.load(self.filepath, ModelData)
+        if not model_data:
+            try:
+                reader = fileutil.MemoryMappedReader(self.filepath)
+            except:
+                profiler.finish()
+                self.report(type={'ERROR'}, message=f_tip_("ファイルを開くのに失敗しました、アクセス不可かファイルが存在しません。file={}", self.filepath))
+                return {'CANCELLED'}
 
+            with reader:
+                try:
+                    model_data = read_model(reader, context.window_manager.progress_update, profiler, log=print_log)
+                except (UnicodeDecodeError, struct.error, common.CM3D2ImportError) as e:
+                    profiler.finish()
+                    msg = model_file_error_message(ModelFileError.from_read_error(self.filepath, reader, e))
+                    self.report(type={'ERROR'}, message="".join(reversed(msg))[0:-1])
+                    print("".join(msg))
+                    return {'CANCELLED'}
+                model_data.filepath = self.filepath
+                if cache:
+                    profiler.stage('cache write')
+                    error = store_model_cache(cache, model_data)
+                    if error:
+                        self.report(type={'WARNING'}, message="".join(model_file_error_message(error)))
+                    cache.evict()
+        self.report(type={'INFO'}, message=f_tip_("Model Version = {version}", version=model_data.version))
+
+        profiler.stage('texture index')
         self.texpath_dict = common.get_texpath_dict(reload=self.reload_tex_cache)
 
-        with reader:
-            # ヘッダー
-            ext = None
-            try: # luvoid : utf-8 decoding could possibly throw an error here
-                ext = common.read_str(reader)
-            except:
-                ext = False
-            if ext != 'CM3D2_MESH':
-                self.report(type={'ERROR'}, message="これはカスタムメイド3D2のモデルファイルではありません")
-                return {'CANCELLED'}
-            model_ver = struct.unpack('<i', reader.read(4))[0]
-            self.report(type={'INFO'}, message=f_tip_("Model Version = {version}", version=model_ver))
-            context.window_manager.progress_update(0.1)
+        self.profiler = profiler
+        try:
+            self.build_model(context, model_data, custom_bone_ob)
+        finally:
+            self.profiler = profiling.StageProfiler(enabled=False)
+            profiler.output(prefs.profile_log_path)
+        context.window_manager.progress_end()
 
-            try:
-                # 名前群を取得
-                model_name1 = common.read_str(reader)
-                model_name2 = common.read_str(reader)
-                context.window_manager.progress_update(0.2)
-
-                # ボーン情報読み込み
-                bone_data = []
-                bone_count = struct.unpack('<i', reader.read(4))[0]
-                for i in range(bone_count):
-                    name = common.read_str(reader)
-                    scl = struct.unpack('<B', reader.read(1))[0]
-                    bone_data.append({'name': name, 'scl': scl})
-
-                for i in range(bone_count):
-                    parent_index = struct.unpack('<i', reader.read(4))[0]
-                    parent_name = None
-                    if parent_index != -1:
-                        parent_name = bone_data[parent_index]['name']
-                    bone_data[i]['parent_index'] = parent_index
-                    bone_data[i]['parent_name'] = parent_name
-
-                for i in range(bone_count):
-                    x, y, z = struct.unpack('<3f', reader.read(3*4))
-                    bone_data[i]['co'] = mathutils.Vector((x, y, z))
-
-                    x, y, z = struct.unpack('<3f', reader.read(3*4))
-                    w = struct.unpack('<f', reader.read(4))[0]
-                    bone_data[i]['rot'] = mathutils.Quaternion((w, x, y, z))
-                    if model_ver >= 2001:
-                        use_scale = struct.unpack('<B', reader.read(1))[0]
-                        if use_scale:
-                            print(bone_data[i]['name'],"has scale data!")
-                            scale_x, scale_y, scale_z = struct.unpack('<3f', reader.read(3*4))
-                            bone_data[i]['scale'] = [scale_x, scale_y, scale_z]
-
-                context.window_manager.progress_update(0.3)
-
-                print(f_("Reading vertex, mesh, and local bone count at 0x{num:02X}", num=reader.tell()))
-                vertex_count, mesh_count, local_bone_count = struct.unpack('<3i', reader.read(3*4))
-
-                # ローカルボーン情報読み込み
-                local_bone_data = []
-                for i in range(local_bone_count):
-                    local_bone_data.append({'name': common.read_str(reader)})
-
-                for i in range(local_bone_count):
-                    row0 = struct.unpack('<4f', reader.read(4 * 4))
-                    row1 = struct.unpack('<4f', reader.read(4 * 4))
-                    row2 = struct.unpack('<4f', reader.read(4 * 4))
-                    row3 = struct.unpack('<4f', reader.read(4 * 4))
-                    local_bone_data[i]['matrix'] = mathutils.Matrix([row0, row1, row2, row3])
-                context.window_manager.progress_update(0.4)
-
-                # 頂点情報読み込み
-                vertex_data = []
-                print(f_("Reading vertex data at 0x{num:02X}", num=reader.tell()))
-                extra_uv_uses = [False] * 7
-                if model_ver >= 2102: # CR Edit Mode
-                    extra_uv_uses = struct.unpack('<7?', reader.read(7))
-                    print(f_("extra_uv_uses = {boollist}", boollist=extra_uv_uses))
-                for i in range(vertex_count):
-                    co = struct.unpack('<3f', reader.read(3 * 4))
-                    no = struct.unpack('<3f', reader.read(3 * 4))
-                    uv = struct.unpack('<2f', reader.read(2 * 4))
-                    extra_uvs = [] # CR Edit
-                    for i, used in enumerate(extra_uv_uses):
-                        if used:
-                            extra_uvs.append(struct.unpack('<2f', reader.read(2 * 4)))
-                    vertex_data.append({'co': co, 'normal': no, 'uv': uv, 'extra_uvs': extra_uvs})
-                if self.is_remove_doubles:
-                    comparison_data = list(hash(repr(v['co']) + " " + repr(v['normal'])) for v in vertex_data)
-                    comparison_counter = Counter(comparison_data)
-                    comparison_data = list((comparison_counter[h] > 1) for h in comparison_data)
-                    del comparison_counter
-                print(f_("Reading unknown count at 0x{num:02X}", num=reader.tell()))
-                unknown_count = struct.unpack('<i', reader.read(4))[0]
-                for i in range(unknown_count):
-                    struct.unpack('<4f', reader.read(4 * 4))
-                for i in range(vertex_count):
-                    indexes = struct.unpack('<4H', reader.read(4 * 2))
-                    values = struct.unpack('<4f', reader.read(4 * 4))
-                    vertex_data[i]['weights'] = list({
-                            'index': index,
-                            'value': value,
-                            'name': local_bone_data[index]['name'],
-                        } for index, value in zip(indexes, values))
-                context.window_manager.progress_update(0.5)
-                # 面情報読み込み
-                face_data = []
-                for i in range(mesh_count):
-                    face_count = int(struct.unpack('<i', reader.read(4))[0] / 3)
-                    datum = [tuple(reversed(struct.unpack('<3H', reader.read(3 * 2)))) for j in range(face_count)]
-                    face_data.append(datum)
-                context.window_manager.progress_update(0.6)
-
-                # マテリアル情報読み込み
-                # TODO MaterialHandlerに変更
-                material_names = {}
-                material_data = []
-                material_count = struct.unpack('<i', reader.read(4))[0]
-                for i in range(material_count):
-                    print(f_("mate count: {num} of {count} @ 0x{pos:02X}", num=i, count=material_count, pos=reader.tell()))
-                    data = cm3d2_data.MaterialHandler.read(reader, read_header=False, version=model_ver)
-                    
-                    data.name1 = data.name.lower()
-                    if data.name1 in material_names:
-                        print(f"duplicate material name found! {data.name1}")
-                        material_names[data.name1] += 1
-                        new_name = data.name.lower() + "_" + str(material_names.get(data.name.lower()))
-                        data.name1 = new_name
-                    
-                    material_names[data.name1] = 1
-                    material_data.append(data)
-                    
-                    # name1 = common.read_str(reader)
-                    # name2 = common.read_str(reader)
-                    # name3 = common.read_str(reader)
-                    # data_list = []
-                    # material_data.append({'name1': name1, 'name2': name2, 'name3': name3, 'data': data_list})
-                    # while True:
-                    #     data_type = common.read_str(reader)
-                    #     if data_type == 'tex':
-                    #         data_item = {'type': data_type}
-                    #         data_list.append(data_item)
-                    #         data_item['name'] = common.read_str(reader)
-                    #         data_item['type2'] = common.read_str(reader)
-                    #         if data_item['type2'] == 'tex2d':
-                    #             data_item['name2'] = common.read_str(reader)
-                    #             data_item['path'] = common.read_str(reader)
-                    #             data_item['tex_map'] = struct.unpack('<4f', reader.read(4*4))
-                    #     elif data_type == 'col':
-                    #         name = common.read_str(reader)
-                    #         col = struct.unpack('<4f', reader.read(4*4))
-                    #         data_list.append({'type': data_type, 'name': name, 'color': col})
-                    #     elif data_type == 'f':
-                    #         name = common.read_str(reader)
-                    #         fval = struct.unpack('<f', reader.read(4))[0]
-                    #         data_list.append({'type': data_type, 'name': name, 'float': fval})
-                    #     else:
-                    #         break
-
-                context.window_manager.progress_update(0.8)
-
-                # その他情報読み込み
-                misc_data = []
-                while True:
-                    #print(f_("Reading data_type at 0x{num:02X}", num=reader.tell()))
-                    data_type = common.read_str(reader)
-                    if data_type == 'morph':
-                        misc_item = {'type': data_type}
-                        misc_data.append(misc_item)
-                        misc_item['name'] = common.read_str(reader)
-                        misc_item['data'] = data_list = []
-                        morph_vert_count = struct.unpack('<i', reader.read(4))[0]
-                        morph_extra_uvs = False
-                        if model_ver >= 2102: # CR Edit Mode
-                            morph_extra_uvs = struct.unpack('<?', reader.read(1))[0]
-                            misc_item['uvs'] = []
-                            print(f_("{morph}.morph_extra_uvs @ 0x{pos:02X} = {bool}", morph=misc_item['name'], bool=morph_extra_uvs, pos=reader.tell()-1))
-                        for i in range(morph_vert_count):
-                            index = struct.unpack('<H', reader.read(2))[0]
-                            co = mathutils.Vector(struct.unpack('<3f', reader.read(3 * 4)))
-                            normal = struct.unpack('<3f', reader.read(3 * 4))
-                            extra_uvs = () # CR Edit
-                            if morph_extra_uvs:
-                                extra_uvs = struct.unpack('<4f', reader.read(4 * 4))
-                            data_list.append({'index': index, 'co': co, 'normal': normal, 'color': extra_uvs})
-                    else:
-                        break
-            
-            except UnicodeDecodeError as e:
-                msg = [
-                    f_tip_("Error reading file at byte 0x{num:02X}", num=reader.tell()-len(e.object)) + "\n",
-                    str(e) + "\n",
-                    *traceback.format_tb(e.__traceback__)
-                ]
-                self.report(type={'ERROR'}, message="".join(reversed(msg))[0:-1])
-                print("".join(msg))
-                return {'CANCELLED'}
-            
-            except struct.error as e:
-                msg = [
-                    f_tip_("Error reading file at byte 0x{num:02X}", num=reader.tell()) + "\n",
-                    str(e) + "\n",
-                    *traceback.format_tb(e.__traceback__)
-                ]
-                self.report(type={'ERROR'}, message="".join(reversed(msg))[0:-1])
-                print("".join(msg))
-                return {'CANCELLED'}
+        require_time = time.time() - start_time
+        filesize = os.path.getsize(self.filepath)
+        filesize_str = "バイト"
+        if 1024 * 1024 < filesize:
+            filesize = filesize / (1024 * 1024.0)
+            filesize_str = "MB"
+        elif 1024 < filesize:
+            filesize = filesize / 1024.0
+            filesize_str = "KB"
+        self.report(type={'INFO'}, message=f_tip_("modelのインポートが完了しました ({} {}/ {:.2f} 秒)", filesize, filesize_str, require_time))
+        return {'FINISHED'}
+
+    def get_filepaths(self) -> list[str]:
+        """ファイルブラウザで選択されたファイルのパスを返す"""
+        if self.directory and len(self.files):
+            filepaths = [os.path.join(self.directory, file.name) for file in self.files if file.name]
+            if filepaths:
+                return filepaths
+        return [self.filepath]
+
+    def execute_batch(self, context, filepaths):
+        """複数のmodelファイルをまとめてインポートする
+
+        ファイルの読み込み (bpy を使わない部分) はスレッドで並列に行い、
+        オブジェクトの作成はメインスレッドで行う。
+        テクスチャのパス索引・画像・マテリアルはファイル間で共有する。
+        """
+        start_time = time.time()
+
+        prefs = common.preferences()
+        prefs.model_import_path = filepaths[0]
+        prefs.scale = self.scale
+
+        custom_bone_ob = context.active_object
+        if not custom_bone_ob:
+            self.is_custom_bones = False
 
-            except common.CM3D2ImportError as e:
-                msg = [
-                    f_tip_("Error reading file at byte 0x{num:02X}", num=reader.tell()) + "\n",
-                    str(e) + "\n",
-                    *traceback.format_tb(e.__traceback__)
-                ]
-                self.report(type={'ERROR'}, message="".join(reversed(msg))[0:-1])
+        self.texpath_dict = common.get_texpath_dict(reload=self.reload_tex_cache)
+        self.image_cache = {}
+        self.material_cache = {}
+
+        cache = get_model_cache()
+        profilers = [profiling.create_profiler(prefs, os.path.basename(filepath)) for filepath in filepaths]
+        max_workers = min(len(filepaths), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(load_model_file, filepaths, [cache] * len(filepaths), profilers))
+        if cache:
+            cache.evict()
+
+        import_count = 0
+        for filepath, (model_data, error), profiler in zip(filepaths, results, profilers):
+            if model_data is None:
+                profiler.finish()
+                msg = model_file_error_message(error)
+                self.report(type={'ERROR'}, message=f_tip_("Failed to import {file}", file=os.path.basename(filepath)) + "\n" + "".join(reversed(msg)).rstrip("\n"))
                 print("".join(msg))
-                return {'CANCELLED'}
+                continue
+            if error:
+                self.report(type={'WARNING'}, message="".join(model_file_error_message(error)))
+            context.window_manager.progress_begin(0, 10)
+            self.profiler = profiler
+            try:
+                self.build_model(context, model_data, custom_bone_ob)
+            finally:
+                self.profiler = profiling.StageProfiler(enabled=False)
+                profiler.output(prefs.profile_log_path)
+            context.window_manager.progress_end()
+            import_count += 1
+
+        self.image_cache = None
+        self.material_cache = None
+
+        require_time = time.time() - start_time
+        self.report(type={'INFO'}, message=f_tip_("Imported {count} of {total} model files ({time:.2f} sec)", count=import_count, total=len(filepaths), time=require_time))
+        return {'FINISHED'} if import_count else {'CANCELLED'}
 
+    def build_model(self, context, model_data: ModelData, custom_bone_ob=None):
+        """読み込んだ ModelData からアーマチュアやメッシュを作成する"""
+        prefs = common.preferences()
+        model_ver = model_data.version
+        model_name1 = model_data.name
+        model_name2 = model_data.base_bone_name
+        bone_data = model_data.bone_data
+        local_bone_data = model_data.local_bone_data
+        extra_uv_uses = model_data.extra_uv_uses
+        vertex_data = model_data.vertex_data
+        weight_data = model_data.weight_data
+        face_data = model_data.face_data
+        material_data = model_data.material_data
+        material_count = len(material_data)
+        misc_data = model_data.misc_data
+        if self.is_remove_doubles:
+            comparison_data = duplicate_vertex_mask(vertex_data)
+        is_odd_scale_bone = False
+        is_local_bones_corrupt = False
         context.window_manager.progress_update(1)
 
         try:
@@ -367,6 +619,7 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         bpy.ops.object.select_all(action='DESELECT')
 
         # アーマチュア作成
+        self.profiler.stage('armature')
         if self.is_armature:
             arm    = bpy.data.armatures.new(model_name1 + ".armature")
             arm_ob = bpy.data.objects.new  (model_name1 + ".armature", arm)
@@ -387,11 +640,15 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
 
             is_odd_scale_bone = False
 
+            # ボーン名は一度だけ変換する
+            bone_names = [common.decode_bone_name(data['name'], self.is_convert_bone_weight_names) for data in bone_data]
+            edit_bones = {}
+
             # 基幹ボーンのみ作成
-            child_data = []
-            for data in bone_data:
+            for index, data in enumerate(bone_data):
                 if not data['parent_name']:
-                    bone = arm.edit_bones.new(common.decode_bone_name(data['name'], self.is_convert_bone_weight_names))
+                    bone = arm.edit_bones.new(bone_names[index])
+                    edit_bones[bone.name] = bone
                     bone.head, bone.tail = (0, 0, 0), (0, 1, 0)
                     bone.use_deform = False
 
@@ -407,8 +664,8 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                     #rot = compat.convert_cm_to_bl_bone_rotation(rot)
                     #mat = compat.mul(mathutils.Matrix.Translation(co), rot.to_matrix().to_4x4())
                     
-                    co_mat  = mathutils.Matrix.Translation(data['co'].copy() * self.scale)
-                    rot     = mathutils.Quaternion(data['rot'].copy())
+                    co_mat  = mathutils.Matrix.Translation(mathutils.Vector(data['co']) * self.scale)
+                    rot     = mathutils.Quaternion(data['rot'])
                     #rot     = compat.convert_cm_to_bl_bone_rotation(rot)
                     rot_mat = rot.to_matrix().to_4x4()
                     #rot_mat = compat.convert_cm_to_bl_bone_rotation(rot_mat)
@@ -440,16 +697,18 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                         #look = bone.tail - bone.head
                         #look *= scale.y
                         #bone.tail = look + bone.head
-                else:
-                    child_data.append(data)
             context.window_manager.progress_update(1.333)
 
-            # 子ボーンを追加していく
-            while len(child_data):
-                data = child_data.pop(0)
-                parent = arm.edit_bones.get(common.decode_bone_name(data['parent_name'], self.is_convert_bone_weight_names))
+            # 子ボーンを追加していく (親ボーンが先に作成されるように並べ替え済み)
+            child_order, orphan_indices = sort_child_bone_data(bone_data, bone_names)
+            for index in orphan_indices:
+                self.report(type={'WARNING'}, message=f_tip_("Bone '{bone_name}' could not be connected to its parent '{parent_name}' and was skipped", bone_name=bone_names[index], parent_name=bone_data[index]['parent_name']))
+            for index in child_order:
+                data = bone_data[index]
+                parent = edit_bones.get(bone_names[data['parent_index']])
                 if parent:
-                    bone = arm.edit_bones.new(common.decode_bone_name(data['name'], self.is_convert_bone_weight_names))
+                    bone = arm.edit_bones.new(bone_names[index])
+                    edit_bones[bone.name] = bone
                     bone.parent = parent
                     bone.head, bone.tail = (0, 0, 0), (0, 1, 0)
                     bone.use_deform = False
@@ -484,8 +743,8 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
 
                     parent_mat = parent.matrix
                     
-                    local_co      = data['co' ].copy() * self.scale
-                    local_rot     = data['rot'].copy()
+                    local_co      = mathutils.Vector(data['co']) * self.scale
+                    local_rot     = mathutils.Quaternion(data['rot'])
                     #local_rot     = compat.convert_cm_to_bl_bone_rotation(rot)
                     local_co_mat  = mathutils.Matrix.Translation(local_co)
                     local_rot_mat = local_rot.to_matrix().to_4x4()
@@ -540,13 +799,11 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                         #look = bone.tail - bone.head
                         #look *= scale.y
                         #bone.tail = look + bone.head
-                else:
-                    child_data.append(data)
             context.window_manager.progress_update(1.666)
             
             # Configure bones in local bone data
             is_local_bones_corrupt = False
-            base_bone = arm.edit_bones.get(common.decode_bone_name(model_name2, self.is_convert_bone_weight_names))
+            base_bone = edit_bones.get(common.decode_bone_name(model_name2, self.is_convert_bone_weight_names))
             base_bone_offset = base_bone.matrix.copy()
             base_bone_offset = compat.mul(mathutils.Matrix.Scale(-1, 4, (1, 0, 0)), base_bone_offset)
             base_bone_offset = compat.convert_bl_to_cm_bone_rotation(base_bone_offset)
@@ -579,16 +836,15 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                     #self.report(type={'WARNING'}, message="Found potentially corrupt local bone data, please re-import with \"Use Local Bone Data\" disabled.")
                 return mat
 
+            local_bone_names = [common.decode_bone_name(data['name'], self.is_convert_bone_weight_names) for data in local_bone_data]
             for data in local_bone_data:
                 if self.is_use_local_bones and data['name'] == model_name2:
-                    bone = arm.edit_bones.get(common.decode_bone_name(data['name'], self.is_convert_bone_weight_names))
-                    mat = mathutils.Matrix(data['matrix'])
                     print("Found base bone in local bone data!")
                     #base_bone_offset = compat.mul(compat.transform_inverse(base_bone_offset), setup_local_bone(bone, mat, isRoot=True))
 
 
-            for data in local_bone_data:
-                bone = arm.edit_bones.get(common.decode_bone_name(data['name'], self.is_convert_bone_weight_names))
+            for name, data in zip(local_bone_names, local_bone_data):
+                bone = edit_bones.get(name)
                 bone.use_deform = True
                 if self.is_use_local_bones and not data['name'] == model_name2:
                     mat = mathutils.Matrix(data['matrix'])
@@ -601,19 +857,26 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                 return w.dot(d) / d.dot(d)
             
             # ボーン整頓
-            for bone in arm.edit_bones:
-                if len(bone.children) == 0:
+            # EditBone.children は毎回全ボーンを走査するので、先に親子関係をまとめておく
+            edit_bone_list = arm.edit_bones[:]
+            bone_children = {bone.name: [] for bone in edit_bone_list}
+            for bone in edit_bone_list:
+                if bone.parent:
+                    bone_children[bone.parent.name].append(bone)
+            for bone in edit_bone_list:
+                children = bone_children[bone.name]
+                if len(children) == 0:
                     if bone.parent:
                         bone.length = bone.parent.length * 0.5
                     else:
                         bone.length = 0.2 * self.scale
-                elif len(bone.children) == 1:
-                    co = bone.children[0].head - bone.head
+                elif len(children) == 1:
+                    co = children[0].head - bone.head
                     bone.length = co.length
-                elif len(bone.children) >= 2:
+                elif len(children) >= 2:
                     if bone.parent:
                         max_len = 0.0
-                        for child_bone in bone.children:
+                        for child_bone in children:
                             if "Pelvis" in bone.name:
                                 dist = (child_bone.head - bone.head).length
                             else:
@@ -623,25 +886,22 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                         bone.length = max_len
                     else:
                         bone.length = 0.2 * self.scale
-            for bone in arm.edit_bones:
-                if len(bone.children) == 0:
+            for bone in edit_bone_list:
+                if len(bone_children[bone.name]) == 0:
                     if bone.parent:
                         bone.length = bone.parent.length * 0.5
             
             # Make sure no bones are length 0, otherwise blender deletes them
-            for bone in arm.edit_bones:
+            for bone in edit_bone_list:
                 min_length = 0.0001
                 if bone.length < min_length:
                     bone.length = min_length
             
             # 一部ボーン削除
             if self.is_armature_clean:
-                for bone in arm.edit_bones:
-                    for b in local_bone_data:
-                        name = common.decode_bone_name(b['name'], self.is_convert_bone_weight_names)
-                        if bone.name == name:
-                            break
-                    else:
+                local_bone_name_set = set(local_bone_names)
+                for bone in edit_bone_list:
+                    if bone.name not in local_bone_name_set:
                         arm.edit_bones.remove(bone)
 
             arm.layers[16] = True
@@ -655,28 +915,32 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         context.window_manager.progress_update(2)
 
         if self.is_mesh:
+            self.profiler.stage('mesh build')
             ob, me = self.create_mesh(context, model_name1, vertex_data, face_data)
             # オブジェクト変形
             CNV_OT_align_to_cm3d2_base_bone.from_bone_data(ob, bone_data, local_bone_data, base_bone_name=model_name2, scale=self.scale)
             context.window_manager.progress_update(3)
             
+            self.profiler.stage('uvs')
             self.create_uvs(context, me, vertex_data, extra_uv_uses)
             context.window_manager.progress_update(4)
 
-            self.create_vertex_groups(context, ob, vertex_data, local_bone_data)
+            self.profiler.stage('vertex groups')
+            self.create_vertex_groups(context, ob, weight_data, local_bone_data)
             context.window_manager.progress_update(5)
 
+            self.profiler.stage('shape keys')
             self.create_shapekeys(context, ob, misc_data)
             context.window_manager.progress_update(6)
 
             # マテリアル追加
+            self.profiler.stage('textures')
             progress_count_total = 0.0
             for data in material_data:
                 progress_count_total += 1 #len(data['data'])
             self.progress_plus_value = 1.0 / (progress_count_total if progress_count_total > 0.0 else 1.0)
             self.progress_count = 6.0
 
-            face_seek = 0
             mates_set = set()
             override = context.copy()
             override['object'] = ob
@@ -687,16 +951,23 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                 
                 mates_set.add(data.name)
                 #common.preferences().mate_unread_same_value
-                bpy.ops.object.material_slot_add(override)
-                mate = context.blend_data.materials.new(data.name)#['name1'])
-                #mate['shader1'] = data['name2']
-                #mate['shader2'] = data['name3']
 
-                ob.material_slots[-1].material = mate
-                # 面にマテリアル割り当て
-                for i in range(face_seek, face_seek + len(face_data[index])):
-                    me.polygons[i].material_index = index
-                face_seek += len(face_data[index])
+                # 複数ファイルのインポートでは、内容が同じマテリアルを使い回す
+                mate_key = None
+                mate = None
+                if self.material_cache is not None:
+                    mate_key = data.to_text()
+                    mate = self.material_cache.get(mate_key)
+                is_new_mate = mate is None
+                if is_new_mate:
+                    mate = context.blend_data.materials.new(data.name)#['name1'])
+                    #mate['shader1'] = data['name2']
+                    #mate['shader2'] = data['name3']
+
+                me.materials.append(mate)
+
+                if not is_new_mate:
+                    continue
 
                 # テクスチャ追加
                 if compat.IS_LEGACY:
@@ -705,14 +976,23 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                     common.decorate_material(mate, self.is_decorate, me, index)
                 else:
                     #self.create_mateprop(context, me, texes_set, mate, index, data)
-                    cm3d2_data.MaterialHandler.apply_to(override, mate, data)
+                    cm3d2_data.MaterialHandler.apply_to(override, mate, data, image_cache=self.image_cache)
                     common.decorate_material(mate, self.is_decorate, me, index)
                 common.setup_material(mate)
+                if mate_key is not None:
+                    self.material_cache[mate_key] = mate
+
+            # 面にマテリアル割り当て (面はメッシュ (マテリアル) ごとの順に並んでいる)
+            if face_data:
+                material_indices = np.repeat(np.arange(len(face_data), dtype=np.int32), [len(faces) for faces in face_data])
+                material_indices[material_indices >= len(material_data)] = 0
+                me.polygons.foreach_set('material_index', material_indices)
 
             ob.active_material_index = 0
             context.window_manager.progress_update(7)
 
             # メッシュ整頓
+            self.profiler.stage('mesh cleanup')
             pre_mesh_select_mode = context.tool_settings.mesh_select_mode[:]
             
             # Too buggy on versions before 2.91 so just disable it outright
@@ -736,9 +1016,7 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                 if not self.is_sharp or not can_mark_sharp:
                     bpy.ops.mesh.select_all(action='DESELECT')
                     bpy.ops.object.mode_set(mode='OBJECT')
-                    for is_comparison, vert in zip(comparison_data, me.vertices):
-                        if is_comparison:
-                            vert.select = True
+                    me.vertices.foreach_set('select', comparison_data)
                     bpy.ops.object.mode_set(mode='EDIT')
                 else:
                     bpy.ops.mesh.select_all(action='SELECT')
@@ -770,6 +1048,7 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         context.window_manager.progress_update(8)
 
         # マテリアル情報のテキスト埋め込み
+        self.profiler.stage('text data')
         if self.is_mate_data_text:
             for index, data in enumerate(material_data):
                 txt_name = "Material:" + str(index)
@@ -808,36 +1087,21 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         context.window_manager.progress_update(9)
 
         # ボーン情報のテキスト埋め込み
+        is_compact_bone_data = prefs.is_compact_bone_data
         if self.is_bone_data_text:
             if "BoneData" in context.blend_data.texts:
                 txt = context.blend_data.texts["BoneData"]
                 txt.clear()
             else:
                 txt = context.blend_data.texts.new("BoneData")
-        for i, data in enumerate(bone_data):
-            s = ",".join([data['name'], str(data['scl']), ""])
-            parent_index = data['parent_index']
-            if -1 < parent_index:
-                s += bone_data[parent_index]['name'] + ","
-            else:
-                s += "None" + ","
-            s += " ".join([str(data['co'][0]), str(data['co'][1]), str(data['co'][2])]) + ","
-            s += " ".join([str(data['rot'][0]), str(data['rot'][1]), str(data['rot'][2]), str(data['rot'][3])])
-            if model_ver >= 2001:
-                if 'scale' in data:
-                    s += ",1," + " ".join(map(str, data['scale']))
-                else:
-                    s += ",0"
-
-            if self.is_bone_data_text:
+            for s in bone_data_property.format_bone_data(bone_data, model_ver):
                 txt.write(s + "\n")
-            if self.is_mesh and self.is_bone_data_obj_property:
-                ob["BoneData:" + str(i)] = s
-            if self.is_armature and self.is_bone_data_arm_property:
-                arm["BoneData:" + str(i)] = s
-        if self.is_bone_data_text:
             txt['BaseBone'] = model_name2
             txt.current_line_index = 0
+        if self.is_mesh and self.is_bone_data_obj_property:
+            bone_data_property.write_bone_data(ob, bone_data, model_ver, compact=is_compact_bone_data)
+        if self.is_armature and self.is_bone_data_arm_property:
+            bone_data_property.write_bone_data(arm, bone_data, model_ver, compact=is_compact_bone_data)
         context.window_manager.progress_update(10)
 
         # ローカルボーン情報のテキスト埋め込み
@@ -847,26 +1111,14 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
                 txt.clear()
             else:
                 txt = context.blend_data.texts.new("LocalBoneData")
-        for i, data in enumerate(local_bone_data):
-            s = data['name'] + ","
-
-            mat_list = list(data['matrix'][0])
-            mat_list.extend(list(data['matrix'][1]))
-            mat_list.extend(list(data['matrix'][2]))
-            mat_list.extend(list(data['matrix'][3]))
-            for j, f in enumerate(mat_list):
-                mat_list[j] = str(f)
-            s += " ".join(mat_list)
-
-            if self.is_bone_data_text:
+            for s in bone_data_property.format_local_bone_data(local_bone_data):
                 txt.write(s + "\n")
-            if self.is_mesh and self.is_bone_data_obj_property:
-                ob["LocalBoneData:" + str(i)] = s
-            if self.is_armature and self.is_bone_data_arm_property:
-                arm["LocalBoneData:" + str(i)] = s
-        if self.is_bone_data_text:
             txt['BaseBone'] = model_name2
             txt.current_line_index = 0
+        if self.is_mesh and self.is_bone_data_obj_property:
+            bone_data_property.write_local_bone_data(ob, local_bone_data, compact=is_compact_bone_data)
+        if self.is_armature and self.is_bone_data_arm_property:
+            bone_data_property.write_local_bone_data(arm, local_bone_data, compact=is_compact_bone_data)
 
         if self.is_mesh and self.is_bone_data_obj_property:
             ob['BaseBone'] = model_name2
@@ -876,43 +1128,31 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
             arm['BaseBone'] = model_name2
             if model_ver >= 1000:
                 arm['ModelVersion'] = model_ver
-        context.window_manager.progress_end()
 
-        require_time = time.time() - start_time
-        filesize = os.path.getsize(self.filepath)
-        filesize_str = "バイト"
-        if 1024 * 1024 < filesize:
-            filesize = filesize / (1024 * 1024.0)
-            filesize_str = "MB"
-        elif 1024 < filesize:
-            filesize = filesize / 1024.0
-            filesize_str = "KB"
-        self.report(type={'INFO'}, message=f_tip_("modelのインポートが完了しました ({} {}/ {:.2f} 秒)", filesize, filesize_str, require_time))
-        
         if is_odd_scale_bone:
             self.report(type={'WARNING'}, message="Found bone with a scale not equal to 1.")
         if is_local_bones_corrupt:
             self.report(type={'ERROR'}, message="Found potentially corrupt local bone data, please re-import with \"Use Local Bone Data\" disabled.")
-        return {'FINISHED'}
 
     def create_mesh(self, context: bpy.types.Context, model_name1, vertex_data, face_data) -> tuple[bpy.types.Object, bpy.types.Mesh]:
         # メッシュ作成
         me = context.blend_data.meshes.new(model_name1)
-        verts, faces = [], []
-        for data in vertex_data:
-            #co = list(data['co'][:])
-            #co[0] = -co[0]
-            #co[0] *= self.scale
-            #co[1] *= self.scale
-            #co[2] *= self.scale
-            co = compat.convert_cm_to_bl_space( mathutils.Vector(data['co']) * self.scale )
-            #co = mathutils.Vector(data['co']) * self.scale
-            verts.append(co)
+        verts = compat.convert_cm_to_bl_space_array(vertex_data['co'], self.scale)
         context.window_manager.progress_update(2.25)
-        for data in face_data:
-            faces.extend(data)
+        if face_data:
+            faces = np.concatenate(face_data).astype(np.int32)
+        else:
+            faces = np.empty((0, 3), dtype=np.int32)
         context.window_manager.progress_update(2.5)
-        me.from_pydata(verts, [], faces)
+        me.vertices.add(len(verts))
+        me.vertices.foreach_set('co', verts.ravel())
+        me.loops.add(faces.size)
+        me.loops.foreach_set('vertex_index', faces.ravel())
+        me.polygons.add(len(faces))
+        me.polygons.foreach_set('loop_start', np.arange(0, faces.size, 3, dtype=np.int32))
+        me.polygons.foreach_set('loop_total', np.full(len(faces), 3, dtype=np.int32))
+        me.polygons.foreach_set('use_smooth', np.ones(len(faces), dtype=bool))
+        me.update(calc_edges=True)
 
         # オブジェクト化
         ob = context.blend_data.objects.new(model_name1, me)
@@ -920,7 +1160,6 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         compat.link(context.scene, ob)
         compat.set_select(ob, True)
         compat.set_active(context, ob)
-        bpy.ops.object.shade_smooth()
         context.window_manager.progress_update(2.75)
 
         # Custom Split Normals
@@ -937,26 +1176,43 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         #        )
         #me.normals_split_custom_set(normals)
         me.normals_split_custom_set_from_vertices(
-            tuple(
-                compat.convert_cm_to_bl_space( mathutils.Vector(vert['normal']) )
-                for vert in vertex_data
-            )
+            compat.convert_cm_to_bl_space_array(vertex_data['normal'])
         )
         me.use_auto_smooth = True
 
         return ob, me
 
-    def create_vertex_groups(self, context: bpy.types.Context, ob: bpy.types.Object, vertex_data, local_bone_data):
+    def create_vertex_groups(self, context: bpy.types.Context, ob: bpy.types.Object, weight_data, local_bone_data):
         # 頂点グループ作成
-        for data in local_bone_data:
-            ob.vertex_groups.new(name=common.decode_bone_name(data['name'], self.is_convert_bone_weight_names))
+        vertex_group_names = [
+            common.decode_bone_name(data['name'], self.is_convert_bone_weight_names)
+            for data in local_bone_data
+        ]
+        for name in vertex_group_names:
+            ob.vertex_groups.new(name=name)
+        # 同名のローカルボーンがある場合は、名前で引ける最初のグループに割り当てる
+        local_vertex_groups = [ob.vertex_groups[name] for name in vertex_group_names]
         context.window_manager.progress_update(4.333)
 
-        for vert_index, data in enumerate(vertex_data):
-            for weight in data['weights']:
-                if 0.0 < weight['value']:
-                    vertex_group = ob.vertex_groups[common.decode_bone_name(weight['name'], self.is_convert_bone_weight_names)]
-                    vertex_group.add([vert_index], weight['value'], 'REPLACE')
+        # 頂点ごとの groups の並び順を保つため、スロット順に追加していく
+        # 各スロットでは (グループ, ウェイト) の組ごとに一度だけ add を呼ぶ
+        used_vertex_group_names = set()
+        indexes = weight_data['index']
+        values = weight_data['value']
+        for slot in range(indexes.shape[1]):
+            vert_indices = np.flatnonzero(0.0 < values[:, slot])
+            if not len(vert_indices):
+                continue
+            slot_indexes = indexes[vert_indices, slot]
+            slot_values = values[vert_indices, slot]
+            keys = (slot_indexes.astype(np.uint64) << np.uint64(32)) | slot_values.view(np.uint32)
+            keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+            for i, (index, value) in enumerate(zip(slot_indexes[first].tolist(), slot_values[first].tolist())):
+                vertex_group = local_vertex_groups[index]
+                vertex_group.add(vert_indices[order[bounds[i]:bounds[i + 1]]].tolist(), value, 'REPLACE')
+                used_vertex_group_names.add(vertex_group.name)
         context.window_manager.progress_update(4.666)
 
         if self.is_vertex_group_sort:
@@ -964,34 +1220,31 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
 
         if self.is_remove_empty_vertex_group:
             for vg in ob.vertex_groups[:]:
-                for vert in ob.data.vertices:
-                    for group in vert.groups:
-                        if group.group == vg.index:
-                            if 0.0 < group.weight:
-                                break
-                    else: # if for-loop didn't break
-                        continue
-                    break
-                else: # if for-loop didn't break
+                if vg.name not in used_vertex_group_names:
                     ob.vertex_groups.remove(vg)
         
         ob.vertex_groups.active_index = 0
     
     def create_uvs(self, context: bpy.types.Context, me: bpy.types.Mesh, vertex_data, extra_uv_uses):
         # UV作成
-        bm = bmesh.new()
-        bm.from_mesh(me)
-        bm.loops.layers.uv.new(f_data_("MainUV"))
-        for i, used in enumerate(extra_uv_uses):    
-            if used:
-                bm.loops.layers.uv.new(f_data_("ExtraUV{num}", num=i))
-        for face in bm.faces:
-            for loop in face.loops:
-                loop[bm.loops.layers.uv[0]].uv = vertex_data[loop.vert.index]['uv']
-                for extra_uv_index, extra_uv in enumerate(vertex_data[loop.vert.index]['extra_uvs']):
-                    loop[bm.loops.layers.uv[extra_uv_index+1]].uv = extra_uv
-        bm.to_mesh(me)
-        bm.free()
+        uv_sources = [(f_data_("MainUV"), vertex_data['uv'])]
+        if 'extra_uvs' in vertex_data.dtype.names:
+            # extra_uvs には使用されている ExtraUV だけが順番に並んでいる
+            extra_uvs = vertex_data['extra_uvs']
+            extra_uv_nums = [i for i, used in enumerate(extra_uv_uses) if used]
+            for column, num in enumerate(extra_uv_nums):
+                uv_sources.append((f_data_("ExtraUV{num}", num=num), extra_uvs[:, column]))
+
+        loop_vert_indices = np.empty(len(me.loops), dtype=np.int32)
+        me.loops.foreach_get('vertex_index', loop_vert_indices)
+        for name, uvs in uv_sources:
+            if compat.IS_LEGACY:
+                me.uv_textures.new(name=name)
+                uv_layer = me.uv_layers[-1]
+            else:
+                uv_layer = me.uv_layers.new(name=name, do_init=False)
+            loop_uvs = np.ascontiguousarray(uvs[loop_vert_indices], dtype=np.float32)
+            uv_layer.data.foreach_set('uv', loop_uvs.ravel())
 
     def create_shapekeys(self, context: bpy.types.Context, ob: bpy.types.Object, misc_data):
         # モーフ追加
@@ -1004,43 +1257,33 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
         #    bpy.ops.object.mode_set(mode='VERTEX_PAINT')
         #    prev_brush_color = context.tool_settings.vertex_paint.brush.color
         
-        vert_loops = {vertex_index: list() for vertex_index in range(len(me.vertices))}
-        for loop_index, loop in enumerate(me.loops):
-            vert_loops[loop.vertex_index].append(loop_index)
-            
-        loose_vertices = []
-        for vert_index, loop_indices in vert_loops.items():
-            if not loop_indices:
-                loose_vertices.append(vert_index)
-        if loose_vertices:
-            print(f"Found loose vertices: {loose_vertices}")
-            
-        
-        def fill_color_layer(layer, color):
-            import numpy as np
-            color_np = np.array(color, dtype=float)
-            color_values = np.broadcast_to(color_np, (len(me.loops), len(color_np)))
-            layer.data.foreach_set('color', color_values.ravel())
+        loop_vert_indices = np.empty(len(me.loops), dtype=np.int32)
+        me.loops.foreach_get('vertex_index', loop_vert_indices)
+
+        loose_vertices = np.setdiff1d(np.arange(len(me.vertices)), loop_vert_indices)
+        if len(loose_vertices):
+            print(f"Found loose vertices: {loose_vertices.tolist()}")
+
+        def gather_loop_colors(loop_colors, vert_indices, vert_colors):
+            # 同じ頂点が複数回現れた場合は、従来通り最後の値を使う
+            last = len(vert_indices) - 1 - np.unique(vert_indices[::-1], return_index=True)[1]
+            is_morph_vert = np.zeros(len(me.vertices), dtype=bool)
+            is_morph_vert[vert_indices[last]] = True
+            colors = np.zeros((len(me.vertices), 4), dtype=np.float32)
+            colors[vert_indices[last]] = vert_colors[last]
+            is_morph_loop = is_morph_vert[loop_vert_indices]
+            loop_colors[is_morph_loop] = colors[loop_vert_indices[is_morph_loop]]
+            return loop_colors
 
         def create_normals_color(name):
-            default_color = (0.5, 0.5, 0.5, 1.0)
-
-            #if is_fast_create:
-            #    bpy.ops.geometry.color_attribute_add(name=name, domain='CORNER', data_type='FLOAT_COLOR', color=default_color)
-            #    return me.attributes.active
-            
             if is_use_attributes:
-                normals_color = me.attributes.new(name, 'FLOAT_COLOR', 'CORNER')
+                return me.attributes.new(name, 'FLOAT_COLOR', 'CORNER')
             else:
-                normals_color = me.vertex_colors.new(name=name, do_init=False) or me.vertex_colors[-1]
-
-            fill_color_layer(normals_color, default_color)
-            
-            return normals_color
+                return me.vertex_colors.new(name=name, do_init=False) or me.vertex_colors[-1]
         
         def create_unknown_color(data):
             unknown_color = None
-            if len(data['data']) and data['data'][0]['color']:
+            if len(data['data']) and 'color' in data['data'].dtype.names:
                 if is_use_attributes:
                     unknown_color = me.attributes.new(f"{data['name']}_unknown", 'FLOAT_COLOR', 'CORNER')
                 else:
@@ -1048,30 +1291,36 @@ class CNV_OT_import_cm3d2_model(bpy.types.Operator, bpy_extras.io_utils.ImportHe
             return unknown_color
 
         def set_shape_key_data(shape_key, normals_color, unknown_color):
-            for vert in data['data']:
-                vert_index = vert['index']
-                co = compat.convert_cm_to_bl_space( mathutils.Vector(vert['co']) * self.scale )
-                no = compat.convert_cm_to_bl_space( mathutils.Vector(vert['normal']))
-                shape_key.data[vert_index].co = shape_key.data[vert_index].co + co
-
-                write_vertex_colors(vert, no, normals_color, unknown_color)
-
-        def write_vertex_colors(vert, no, normals_color, unknown_color):
-            for loop_index in vert_loops[vert['index']]:
-                normals_color.data[loop_index].color = ( # convert from range(-1, 1) to range(0, 1)
-                    no[0] * 0.5 + 0.5,
-                    no[1] * 0.5 + 0.5,
-                    no[2] * 0.5 + 0.5,
-                    1,
-                )
-                if not vert['color']:
-                    continue
-                unknown_color.data[loop_index].color = ( # convert from range(-1, 1) to range(0, 1)
-                    vert['color'][0] * 0.5 * vert['color'][3] + 0.5,
-                    vert['color'][1] * 0.5 * vert['color'][3] + 0.5,
-                    vert['color'][2] * 0.5 * vert['color'][3] + 0.5,
-                    1,
-                )
+            morph_data = data['data']
+            vert_indices = morph_data['index'].astype(np.intp)
+
+            cos = np.empty(len(shape_key.data) * 3, dtype=np.float32)
+            shape_key.data.foreach_get('co', cos)
+            cos = cos.reshape((-1, 3))
+            np.add.at(cos, vert_indices, compat.convert_cm_to_bl_space_array(morph_data['co'], self.scale))
+            shape_key.data.foreach_set('co', cos.ravel())
+
+            write_vertex_colors(morph_data, vert_indices, normals_color, unknown_color)
+
+        def write_vertex_colors(morph_data, vert_indices, normals_color, unknown_color):
+            # convert from range(-1, 1) to range(0, 1)
+            no = compat.convert_cm_to_bl_space_array(morph_data['normal']).astype(np.float64)
+            vert_colors = np.ones((len(morph_data), 4), dtype=np.float32)
+            vert_colors[:, :3] = no * 0.5 + 0.5
+            loop_colors = np.empty((len(me.loops), 4), dtype=np.float32)
+            loop_colors[:] = (0.5, 0.5, 0.5, 1.0)
+            gather_loop_colors(loop_colors, vert_indices, vert_colors)
+            normals_color.data.foreach_set('color', loop_colors.ravel())
+
+            if not unknown_color:
+                return
+            color = morph_data['color'].astype(np.float64)
+            vert_colors = np.ones((len(morph_data), 4), dtype=np.float32)
+            vert_colors[:, :3] = color[:, :3] * 0.5 * color[:, 3:4] + 0.5
+            loop_colors = np.empty(len(me.loops) * 4, dtype=np.float32)
+            unknown_color.data.foreach_get('color', loop_colors)
+            gather_loop_colors(loop_colors.reshape((-1, 4)), vert_indices, vert_colors)
+            unknown_color.data.foreach_set('color', loop_colors)
 
         morph_count = -1
         for data in misc_data:
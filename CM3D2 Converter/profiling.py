@@ -0,0 +1,135 @@
+"""インポート・エクスポートの処理段階ごとの所要時間とメモリ使用量を記録する (bpy は使わない)"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+import tracemalloc
+
+
+# tracemalloc は全体で1つなので、使用中のプロファイラーの数を数えておく
+_trace_lock = threading.Lock()
+_trace_users = 0
+_trace_started = False
+
+
+def _start_tracing():
+    global _trace_users, _trace_started
+    with _trace_lock:
+        if _trace_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _trace_started = True
+        _trace_users += 1
+
+
+def _stop_tracing():
+    global _trace_users, _trace_started
+    with _trace_lock:
+        _trace_users -= 1
+        if _trace_users == 0 and _trace_started:
+            tracemalloc.stop()
+            _trace_started = False
+
+
+class StageProfiler():
+    """処理段階ごとの所要時間とメモリのピークを記録するクラス
+
+    stage() で次の段階を開始すると、それまでの段階は終了する。
+    trace_memory が有効な場合は tracemalloc で Python 側 (NumPy を含む) の割り当てを計測する。
+    Blender 内部の割り当ては含まれず、複数のスレッドで同時に計測した場合は他のスレッドの分も含まれる。
+    enabled が False の場合は何もしない。
+    """
+    def __init__(self, name: str = "", enabled: bool = True, trace_memory: bool = False):
+        self.name = name
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages = []
+        self.__stage_name = None
+        self.__stage_start = 0.0
+        self.__stage_memory = 0
+        self.__is_tracing = False
+
+    def stage(self, name: str):
+        """name の段階を開始する"""
+        if not self.enabled:
+            return
+        self.end_stage()
+        if self.trace_memory:
+            if not self.__is_tracing:
+                _start_tracing()
+                self.__is_tracing = True
+            tracemalloc.reset_peak()
+            self.__stage_memory = tracemalloc.get_traced_memory()[0]
+        self.__stage_name = name
+        self.__stage_start = time.perf_counter()
+
+    def finish(self):
+        """計測を終了する"""
+        if not self.enabled:
+            return
+        self.end_stage()
+        if self.__is_tracing:
+            _stop_tracing()
+            self.__is_tracing = False
+
+    def end_stage(self):
+        """実行中の段階を終了する (次の stage() までの時間は記録しない)"""
+        if not self.enabled:
+            return
+        if self.__stage_name is None:
+            return
+        stage = {
+            'name': self.__stage_name,
+            'time': time.perf_counter() - self.__stage_start,
+        }
+        if self.__is_tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # 段階開始時からの増加量
+            stage['peak_memory'] = max(peak - self.__stage_memory, 0)
+            stage['memory'] = current - self.__stage_memory
+        self.stages.append(stage)
+        self.__stage_name = None
+
+    @property
+    def total_time(self) -> float:
+        return sum(stage['time'] for stage in self.stages)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'total_time': self.total_time,
+            'stages': self.stages,
+        }
+
+    def report(self) -> str:
+        """コンソール出力用の表を返す"""
+        lines = [f"{self.name}: {self.total_time:.3f} sec"]
+        for stage in self.stages:
+            line = f"  {stage['name']:<16} {stage['time'] * 1000:10.1f} ms"
+            if 'peak_memory' in stage:
+                line += f"  peak {stage['peak_memory'] / (1024 * 1024):8.2f} MB"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write_json(self, filepath):
+        """結果を1行のJSONとしてファイルに追記する (JSON Lines)"""
+        with open(filepath, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(self.to_dict(), ensure_ascii=False) + "\n")
+
+    def output(self, filepath=None):
+        """計測を終了し、結果をコンソールと (指定されていれば) JSONファイルに出力する"""
+        if not self.enabled:
+            return
+        self.finish()
+        print(self.report())
+        if filepath:
+            try:
+                self.write_json(filepath)
+            except OSError as e:
+                print(f"Failed to write profile to {filepath}: {e}")
+
+
+def create_profiler(prefs, name: str) -> StageProfiler:
+    """アドオン設定に従って StageProfiler を作る"""
+    return StageProfiler(name, enabled=prefs.is_profile_io, trace_memory=prefs.is_profile_memory)
@@ -1,6 +1,6 @@
 import bpy
 import os
-import struct
+from . import codec
 from . import common
 from . import compat
 from .translations.pgettext_functions import *
@@ -116,23 +116,24 @@ class CNV_OT_export_cm3d2_tex(bpy.types.Operator):
             os.remove(temp_path)
 
         # 本命ファイルに書き込み
-        common.write_str(file, 'CM3D2_TEX')
-        file.write(struct.pack('<i', version))
-        common.write_str(file, self.path)
+        binary = codec.BinaryWriter(file)
+        binary.write_str('CM3D2_TEX')
+        binary.write_int32(version)
+        binary.write_str(self.path)
         if version >= 1010:
             if version >= 1011:
                 uv_rects = bpy.types.Scene.MyUVRects if hasattr(bpy.types.Scene, 'MyUVRects') else None
                 num_rects = len(uv_rects) if uv_rects else 0
-                file.write(struct.pack('<i', num_rects))
+                binary.write_int32(num_rects)
                 if num_rects > 0:
                     for uv_rect in uv_rects:
-                        file.write( struct.pack('<4f', uv_rect[0], uv_rect[1], uv_rect[2], uv_rect[3]) )
+                        binary.pack(codec.VEC4, uv_rect[0], uv_rect[1], uv_rect[2], uv_rect[3])
 
             width, height = img.size
-            file.write(struct.pack('<i', width))
-            file.write(struct.pack('<i', height))
-            file.write(struct.pack('<i', 5))  # tex_format TODO ダイアログで指定
-        file.write(struct.pack('<i', len(temp_data)))
+            binary.write_int32(width)
+            binary.write_int32(height)
+            binary.write_int32(5)  # tex_format TODO ダイアログで指定
+        binary.write_int32(len(temp_data))
         file.write(temp_data)
 
 
@@ -0,0 +1,87 @@
+import io
+import logging
+import os
+import struct
+import timeit
+from unittest import TestCase, skipUnless
+
+import cm3d2converter
+
+codec = cm3d2converter.codec
+
+
+# 以前の common.write_str / read_str の実装 (比較用)
+def legacy_write_str(file, raw_str):
+    b_str = format(len(raw_str.encode('utf-8')), 'b')
+    for i in range(9):
+        if len(b_str) > 7:
+            file.write(struct.pack('<B', int("1" + b_str[-7:], 2)))
+            b_str = b_str[:-7]
+        else:
+            file.write(struct.pack('<B', int(b_str, 2)))
+            break
+    file.write(raw_str.encode('utf-8'))
+
+
+def legacy_read_str(file, total_b=""):
+    for i in range(9):
+        b_str = format(struct.unpack('<B', file.read(1))[0], '08b')
+        total_b = b_str[1:] + total_b
+        if b_str[0] == '0':
+            break
+    return file.read(int(total_b, 2)).decode('utf-8')
+
+
+class CodecTest(TestCase):
+    strings = ['', 'end', 'Bip01 Spine1a', 'マテリアル', 'a' * 127, 'b' * 128, 'c' * 20000, 'd' * 3000000]
+
+    def test_str_compatible(self):
+        for raw_str in self.strings:
+            legacy = io.BytesIO()
+            legacy_write_str(legacy, raw_str)
+            self.assertEqual(codec.encode_str(raw_str), legacy.getvalue())
+
+            self.assertEqual(codec.BinaryReader(io.BytesIO(legacy.getvalue())).read_str(), raw_str)
+            self.assertEqual(codec.decode_str(legacy.getvalue()), (raw_str, len(legacy.getvalue())))
+
+    def test_truncated_str(self):
+        data = codec.encode_str('CM3D2_MESH')
+        with self.assertRaises(struct.error):
+            codec.decode_str(data[:-1])
+        with self.assertRaises(struct.error):
+            codec.BinaryReader(io.BytesIO(b'\x80')).read_str()
+
+    @skipUnless(os.environ.get('CM3D2_BENCHMARK'), "set CM3D2_BENCHMARK=1 to run benchmarks")
+    def test_benchmark(self):
+        """ボーン名のような短い文字列の読み書きの速さを以前の実装と比べる (結果は logging の INFO で出力する)"""
+        names = [f'Bip01 Spine{i}' for i in range(1000)]
+        data = b''.join(codec.encode_str(name) for name in names)
+
+        def legacy_write():
+            file = io.BytesIO()
+            for name in names:
+                legacy_write_str(file, name)
+            return file.getvalue()
+
+        def codec_write():
+            file = io.BytesIO()
+            writer = codec.BinaryWriter(file)
+            for name in names:
+                writer.write_str(name)
+            return file.getvalue()
+
+        def legacy_read():
+            file = io.BytesIO(data)
+            return [legacy_read_str(file) for i in range(len(names))]
+
+        def codec_read():
+            reader = codec.BinaryReader(io.BytesIO(data))
+            return [reader.read_str() for i in range(len(names))]
+
+        logger = logging.getLogger(__name__)
+        for name, legacy, new in (('write_str', legacy_write, codec_write), ('read_str', legacy_read, codec_read)):
+            # 速さは環境によるので比較せず、結果が同じことだけを確かめる
+            self.assertEqual(new(), legacy())
+            legacy_time = min(timeit.repeat(legacy, number=20, repeat=5))
+            new_time = min(timeit.repeat(new, number=20, repeat=5))
+            logger.info("%s: legacy %.1f ms, codec %.1f ms (%.1fx)", name, legacy_time * 1000, new_time * 1000, legacy_time / new_time)
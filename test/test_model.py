@@ -1,10 +1,137 @@
 import bpy
+import bmesh
+import json
+import os
+import shutil
+import struct
+import numpy as np
+from mathutils import Vector
 from pathlib import Path
 
 import cm3d2converter
 from blenderunittest import BlenderTestCase
 
 
+# 以前の ModelWriter.calc_tangents の実装 (比較用)
+def legacy_calc_tangents(cm_tris, cm_verts, cm_norms, cm_uvs):
+    count = len(cm_verts)
+    tan1 = [Vector((0, 0, 0)) for i in range(count)]
+    tan2 = [Vector((0, 0, 0)) for i in range(count)]
+    for tris in cm_tris:
+        for tri_idx in range(0, len(tris), 3):
+            i1, i2, i3 = tris[tri_idx], tris[tri_idx + 1], tris[tri_idx + 2]
+            v1, v2, v3 = cm_verts[i1], cm_verts[i2], cm_verts[i3]
+            w1, w2, w3 = cm_uvs[i1], cm_uvs[i2], cm_uvs[i3]
+            a1 = v2 - v1
+            a2 = v3 - v1
+            s1 = w2 - w1
+            s2 = w3 - w1
+            r_inverse = (s1.x * s2.y - s2.x * s1.y)
+            if r_inverse != 0:
+                r = 1.0 / r_inverse
+                sdir = Vector(((s2.y * a1.x - s1.y * a2.x) * r, (s2.y * a1.y - s1.y * a2.y) * r, (s2.y * a1.z - s1.y * a2.z) * r))
+                tan1[i1] += sdir
+                tan1[i2] += sdir
+                tan1[i3] += sdir
+                tdir = Vector(((s1.x * a2.x - s2.x * a1.x) * r, (s1.x * a2.y - s2.x * a1.y) * r, (s1.x * a2.z - s2.x * a1.z) * r))
+                tan2[i1] += tdir
+                tan2[i2] += tdir
+                tan2[i3] += tdir
+
+    tangents = [None] * count
+    for i in range(count):
+        n = cm_norms[i]
+        ti = tan1[i]
+        t = (ti - n * n.dot(ti)).normalized()
+        val = n.cross(ti).dot(tan2[i])
+        w = 1.0 if val < 0 else -1.0
+        tangents[i] = (-t.x, t.y, t.z, w)
+    return tangents
+
+
+# 以前の ModelWriter.write_model の頂点・面情報の書き出し (比較用)
+# 戻り値は (頂点ブロック, 元の頂点ごとの分割後の頂点数, マテリアルごとの面ブロック)
+def legacy_write_vertices_and_faces(me, scale, material_count):
+    compat = cm3d2converter.compat
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    uv_lay = bm.loops.layers.uv.active
+    vert_uvs = []
+    vert_iuv = {}
+    vert_indices = {}
+    vert_count = 0
+    for vert in bm.verts:
+        vert_uv = []
+        vert_uvs.append(vert_uv)
+        for loop in vert.link_loops:
+            uv = loop[uv_lay].uv
+            if uv not in vert_uv:
+                vert_uv.append(uv)
+                vert_iuv[hash((vert.index, uv.x, uv.y))] = vert_count
+                vert_indices[vert.index] = vert_count
+                vert_count += 1
+
+    if me.has_custom_normals:
+        custom_normals = [Vector() for i in range(len(me.vertices))]
+        me.calc_normals_split()
+        for loop in me.loops:
+            custom_normals[loop.vertex_index] += loop.normal
+        for no in custom_normals:
+            no.normalize()
+
+    vertex_block = bytearray()
+    for i, vert in enumerate(bm.verts):
+        co = compat.convert_bl_to_cm_space(vert.co * scale)
+        if me.has_custom_normals:
+            no = custom_normals[vert.index]
+        else:
+            no = vert.normal.copy()
+        no = compat.convert_bl_to_cm_space(no)
+        for uv in vert_uvs[i]:
+            vertex_block += struct.pack('<3f', co.x, co.y, co.z)
+            vertex_block += struct.pack('<3f', no.x, no.y, no.z)
+            vertex_block += struct.pack('<2f', uv.x, uv.y)
+
+    def vert_index_from_loops(loops):
+        for loop in loops:
+            uv = loop[uv_lay].uv
+            v_index = loop.vert.index
+            vert_index = vert_iuv.get(hash((v_index, uv.x, uv.y)))
+            if vert_index is None:
+                vert_index = vert_indices.get(v_index, 0)
+            yield vert_index
+
+    # 三角面と四角面だけに対応する (四角面は短い方の対角線で分ける)
+    face_blocks = []
+    for mate_index in range(material_count):
+        tris_faces = []
+        for face in bm.faces:
+            if face.material_index != mate_index:
+                continue
+            if len(face.verts) == 3:
+                tris_faces.extend(vert_index_from_loops(reversed(face.loops)))
+            elif len(face.verts) == 4:
+                v1 = face.loops[0].vert.co - face.loops[2].vert.co
+                v2 = face.loops[1].vert.co - face.loops[3].vert.co
+                if v1.length < v2.length:
+                    f1 = [0, 1, 2]
+                    f2 = [0, 2, 3]
+                else:
+                    f1 = [0, 1, 3]
+                    f2 = [1, 2, 3]
+                faces, faces2 = [], []
+                for i, vert_index in enumerate(vert_index_from_loops(reversed(face.loops))):
+                    if i in f1:
+                        faces.append(vert_index)
+                    if i in f2:
+                        faces2.append(vert_index)
+                tris_faces.extend(faces)
+                tris_faces.extend(faces2)
+        face_blocks.append(struct.pack(f'<{len(tris_faces)}H', *tris_faces))
+    bm.free()
+    return bytes(vertex_block), [len(uvs) for uvs in vert_uvs], face_blocks
+
+
 
 class ModelTest(BlenderTestCase):
     # override
@@ -103,6 +230,150 @@ class ModelTest(BlenderTestCase):
             material_slot2: bpy.types.MaterialSlot
             self.assertEqual(material_slot1.name, material_slot2.name.removesuffix(".001"))
 
+    def test_model_scan(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        summary = cm3d2converter.model_format.scan_model(in_file)
+
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=in_file)
+        imported_mesh_object = bpy.data.objects.get('body001')
+        imported_mesh: bpy.types.Mesh = imported_mesh_object.data
+
+        self.assertEqual(summary.name, 'body001')
+        self.assertEqual(summary.vertex_count, len(imported_mesh.vertices))
+        self.assertEqual(sum(summary.face_counts), len(imported_mesh.polygons))
+        self.assertEqual(summary.material_names,
+                         [slot.material.name.removesuffix(".001") for slot in imported_mesh_object.material_slots])
+        self.assertEqual(summary.morph_names,
+                         [shape_key.name for shape_key in imported_mesh.shape_keys.key_blocks[1:]])
+        self.assertEqual(len(summary.bone_names), len(bpy.data.armatures.get('body001.armature').bones))
+
+        model_data, error = cm3d2converter.model_import.load_model_file(in_file)
+        self.assertEqual([mate.shader for mate in summary.materials],
+                         [mate.shader1 for mate in model_data.material_data])
+        self.assertEqual(summary.texture_paths,
+                         list(dict.fromkeys(tex_item[2] for mate in model_data.material_data
+                                            for tex_item in mate.tex_list if len(tex_item) >= 3)))
+
+        with self.assertRaises(cm3d2converter.model_format.ModelFileError) as cm:
+            cm3d2converter.model_format.scan_model(f'{self.output_dir}/{self._testMethodName}_missing.model')
+        self.assertEqual(cm.exception.kind, 'open')
+
+    def test_model_import_multiple(self):
+        bpy.ops.import_mesh.import_cm3d2_model(
+            directory=self.resources_dir,
+            files=[{'name': 'body001.model'}, {'name': 'duplicate_materials.model'}]
+        )
+
+        standard_mesh_object = bpy.data.objects.get('body001_standard')
+        imported_mesh_object = bpy.data.objects.get('body001')
+        self.assertIsNotNone(imported_mesh_object)
+        self.assertMeshEqual(standard_mesh_object.data, imported_mesh_object.data)
+        self.assertIsNotNone(bpy.data.objects.get('body001.armature'))
+
+    def test_model_cache(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        model_import = cm3d2converter.model_import
+        cache = cm3d2converter.model_cache.ModelCache(f'{self.output_dir}/{self._testMethodName}', 64 * 1024 * 1024)
+        cache.clear()
+
+        parsed, msg = model_import.load_model_file(in_file, cache)
+        self.assertIsNone(msg)
+        cached = cache.load(in_file, model_import.ModelData)
+        self.assertIsNotNone(cached)
+
+        self.assertEqual(cached.name, parsed.name)
+        self.assertEqual(cached.extra_uv_uses, list(parsed.extra_uv_uses))
+        self.assertEqual(cached.vertex_data.tobytes(), parsed.vertex_data.tobytes())
+        self.assertEqual(cached.weight_data.tobytes(), parsed.weight_data.tobytes())
+        self.assertEqual([faces.tolist() for faces in cached.face_data],
+                         [faces.tolist() for faces in parsed.face_data])
+        self.assertEqual([data['name'] for data in cached.bone_data], [data['name'] for data in parsed.bone_data])
+        self.assertEqual([data['co'] for data in cached.bone_data], [data['co'] for data in parsed.bone_data])
+        self.assertEqual([mate.to_text() for mate in cached.material_data],
+                         [mate.to_text() for mate in parsed.material_data])
+        self.assertEqual([item['data'].tobytes() for item in cached.misc_data],
+                         [item['data'].tobytes() for item in parsed.misc_data])
+
+        # 内容が同じであれば、別の場所にコピーしたファイルや更新日時だけ変わったファイルでもキャッシュを使う
+        copied_file = f'{self.output_dir}/{self._testMethodName}.model'
+        shutil.copyfile(in_file, copied_file)
+        os.utime(copied_file, ns=(0, 0))
+        self.assertIsNotNone(cache.load(copied_file, model_import.ModelData))
+        with open(cache.path_record_path(copied_file), 'r', encoding='utf-8') as file:
+            self.assertEqual(json.load(file)['mtime'], 0)
+
+        cache.max_size = 0
+        cache.evict()
+        self.assertIsNone(cache.load(in_file, model_import.ModelData))
+
+    def test_model_read_error(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        model_import = cm3d2converter.model_import
+        MemoryMappedReader = cm3d2converter.fileutil.MemoryMappedReader
+
+        # 途中で切れたファイル
+        truncated_file = f'{self.output_dir}/{self._testMethodName}_truncated.model'
+        with open(in_file, 'rb') as src, open(truncated_file, 'wb') as dst:
+            dst.write(src.read(os.path.getsize(in_file) // 2))
+        model_data, error = model_import.load_model_file(truncated_file)
+        self.assertIsNone(model_data)
+        self.assertEqual(error.kind, 'read')
+        self.assertIsInstance(error.error, struct.error)
+
+        # 頂点数が負のファイル
+        negative_file = f'{self.output_dir}/{self._testMethodName}_negative.model'
+        with open(negative_file, 'wb') as file:
+            writer = cm3d2converter.codec.BinaryWriter(file)
+            writer.write_str('CM3D2_MESH')
+            writer.write_int32(1000)
+            writer.write_str('negative')
+            writer.write_str('Bip01')
+            writer.write_int32(0) # bone_count
+            writer.pack(cm3d2converter.codec.INT32x3, -1, 1, 0)
+            file.write(bytes(64))
+        model_data, error = model_import.load_model_file(negative_file)
+        self.assertIsNone(model_data)
+        self.assertEqual(error.kind, 'read')
+        self.assertIsInstance(error.error, struct.error)
+        with self.assertRaises(cm3d2converter.model_format.ModelFileError) as cm:
+            cm3d2converter.model_format.scan_model(negative_file)
+        self.assertEqual(cm.exception.kind, 'read')
+        self.assertIsInstance(cm.exception.error, struct.error)
+
+        with MemoryMappedReader(negative_file) as reader:
+            with self.assertRaises(struct.error):
+                reader.skip(-1)
+            with self.assertRaises(struct.error):
+                reader.read_view(-1)
+            with self.assertRaises(struct.error):
+                reader.read_array('<f4', -1)
+            self.assertEqual(reader.tell(), 0)
+
+    def test_model_profile(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        out_file = f'{self.output_dir}/{self._testMethodName}.model'
+        log_file = Path(self.output_dir) / f'{self._testMethodName}.jsonl'
+        log_file.unlink(missing_ok=True)
+        prefs = cm3d2converter.common.preferences()
+
+        prefs.is_profile_io = True
+        prefs.profile_log_path = str(log_file)
+        try:
+            bpy.ops.import_mesh.import_cm3d2_model(filepath=in_file)
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=out_file)
+        finally:
+            prefs.is_profile_io = False
+            prefs.profile_log_path = ""
+
+        import_log, export_log = [json.loads(line) for line in log_file.read_text(encoding='utf-8').splitlines()]
+        import_stages = [stage['name'] for stage in import_log['stages']]
+        for name in ('header', 'bones', 'vertices', 'weights', 'faces', 'materials', 'morphs',
+                     'mesh build', 'uvs', 'vertex groups', 'shape keys', 'textures'):
+            self.assertIn(name, import_stages)
+        export_stages = [stage['name'] for stage in export_log['stages']]
+        for name in ('bone data', 'vertices', 'weights', 'faces', 'materials', 'morphs'):
+            self.assertIn(name, export_stages)
+
     def test_model_export(self):
         bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
 
@@ -112,6 +383,520 @@ class ModelTest(BlenderTestCase):
         bpy.ops.export_mesh.export_cm3d2_model(
             filepath=f'{self.output_dir}/{self._testMethodName}.model')
 
+    def test_model_export_golden(self):
+        """頂点・ウェイト・面のブロックが、配列でまとめて書くように変更する前のエクスポーターの出力と同じか
+
+        比較用のブロックは、変更前の書き出し (legacy_write_vertices_and_faces) を
+        エクスポーターと同じくシャープな辺を分割したメッシュに対して実行して作る。
+        """
+        out_file = f'{self.output_dir}/{self._testMethodName}.model'
+        model_import = cm3d2converter.model_import
+        scale = 0.2
+
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        ob = bpy.data.objects.get('body001')
+        self.activate_object(ob)
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=out_file, scale=scale, is_align_to_base_bone=False, is_split_sharp=True)
+        exported, error = model_import.load_model_file(out_file)
+        self.assertIsNone(error)
+
+        # 変更前のエクスポーターと同じく、複製したオブジェクトのシャープな辺を分割してから書き出す
+        legacy_ob = ob.copy()
+        legacy_ob.data = ob.data.copy()
+        ob.users_collection[0].objects.link(legacy_ob)
+        self.activate_object(legacy_ob)
+        bpy.ops.object.mode_set(mode='EDIT')
+        bpy.ops.mesh.split_sharp()
+        bpy.ops.object.mode_set(mode='OBJECT')
+        vertex_block, split_counts, face_blocks = legacy_write_vertices_and_faces(
+            legacy_ob.data, scale, len(legacy_ob.material_slots))
+
+        self.assertEqual(exported.vertex_data.tobytes(), vertex_block, "vertex block not equal")
+        self.assertEqual(len(exported.face_data), len(face_blocks))
+        for i, (faces, face_block) in enumerate(zip(exported.face_data, face_blocks)):
+            # 面は読み込み時に逆順にされているので、書き出した順に戻す
+            self.assertEqual(faces[:, ::-1].astype('<u2').tobytes(), face_block, f"face block {i} not equal")
+
+        # ウェイトは元の頂点ごとのものを、分割後の頂点の数だけ続けて書き出す
+        weight_data = exported.weight_data
+        self.assertEqual(len(weight_data), sum(split_counts))
+        split_starts = np.cumsum([0] + split_counts[:-1])
+        legacy_weights = b''.join(weight_data[start].tobytes() * count for start, count in zip(split_starts, split_counts))
+        self.assertEqual(weight_data.tobytes(), legacy_weights, "weight block not equal")
+
+    def test_export_tangent(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        out_file = f'{self.output_dir}/{self._testMethodName}.model'
+        model_import = cm3d2converter.model_import
+
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=in_file)
+        self.activate_object(bpy.data.objects.get('body001'))
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=out_file, export_tangent=True)
+
+        exported, error = model_import.load_model_file(out_file)
+        self.assertIsNone(error)
+        vertex_data = exported.vertex_data
+        with open(out_file, 'rb') as reader:
+            data = reader.read()
+        # 接空間情報は頂点ブロックの直後にある
+        vertex_bytes = vertex_data.tobytes()
+        offset = data.index(vertex_bytes) + len(vertex_bytes)
+        tangent_count = struct.unpack_from('<i', data, offset)[0]
+        self.assertEqual(tangent_count, len(vertex_data))
+        tangents = data[offset + 4:offset + 4 + tangent_count * 16]
+
+        # 面は読み込み時に逆順にされているので、書き出した順に戻す
+        cm_tris = [faces[:, ::-1].ravel().tolist() for faces in exported.face_data]
+        expected = legacy_calc_tangents(
+            cm_tris,
+            [Vector(co) for co in vertex_data['co']],
+            [Vector(no) for no in vertex_data['normal']],
+            [Vector(uv) for uv in vertex_data['uv']],
+        )
+        self.assertEqual(tangents, np.array(expected, dtype='<f4').tobytes())
+
+    def test_split_vertices_by_uv(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        me: bpy.types.Mesh = bpy.data.objects.get('body001').data
+        split_counts, split_uvs, loop_split_indices = cm3d2converter.model_export.split_vertices_by_uv(me)
+        # 重複頂点を結合せずにインポートしているので、分割されない
+        self.assertEqual(len(split_uvs), len(me.vertices))
+        self.assertTrue((split_counts == 1).all())
+        for loop in me.loops:
+            self.assertEqual(loop_split_indices[loop.index], loop.vertex_index)
+
+        bm = bmesh.new()
+        bm.from_mesh(me)
+        bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=1e-6)
+        bm.to_mesh(me)
+        bm.free()
+        split_counts, split_uvs, loop_split_indices = cm3d2converter.model_export.split_vertices_by_uv(me)
+        uv_layer = me.uv_layers.active
+        for loop in me.loops:
+            split_index = loop_split_indices[loop.index]
+            self.assertEqual(tuple(split_uvs[split_index]), tuple(uv_layer.data[loop.index].uv))
+        self.assertEqual(split_counts.sum(), len(split_uvs))
+
+        # 同じ頂点の中では BMVert.link_loops で最初に出てくる順に並ぶ
+        bm = bmesh.new()
+        bm.from_mesh(me)
+        uv_lay = bm.loops.layers.uv.active
+        expected_uvs = []
+        for vert in bm.verts:
+            vert_uvs = []
+            for loop in vert.link_loops:
+                uv = tuple(loop[uv_lay].uv)
+                if uv not in vert_uvs:
+                    vert_uvs.append(uv)
+            expected_uvs.extend(vert_uvs)
+        bm.free()
+        self.assertEqual([tuple(uv) for uv in split_uvs.tolist()], expected_uvs)
+
+    @staticmethod
+    def replace_with_test_mesh(ob: bpy.types.Object, verts, faces, material_indices):
+        """ob のメッシュを、全頂点が 'Bip01' にウェイト 1.0 で割り当てられた新しいメッシュに置き換える"""
+        materials = list(ob.data.materials)
+        me = bpy.data.meshes.new(ob.data.name + '.test')
+        me.from_pydata(verts, [], faces)
+        me.uv_layers.new()
+        for mat in materials[:max(material_indices) + 1]:
+            me.materials.append(mat)
+        me.polygons.foreach_set('material_index', material_indices)
+        me.update()
+        ob.data = me
+        vertex_group = ob.vertex_groups.get('Bip01') or ob.vertex_groups.new(name='Bip01')
+        vertex_group.add(range(len(verts)), 1.0, 'REPLACE')
+        return me
+
+    def test_quad_split_method(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        out_files = {}
+        for method in ('SHORTEST_DIAGONAL', 'BLENDER'):
+            out_files[method] = f'{self.output_dir}/{self._testMethodName}_{method.lower()}.model'
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=out_files[method], quad_split_method=method)
+
+        # 三角面だけのメッシュでは分割方法によらず同じになる
+        with open(out_files['SHORTEST_DIAGONAL'], 'rb') as reader:
+            shortest_data = reader.read()
+        with open(out_files['BLENDER'], 'rb') as reader:
+            blender_data = reader.read()
+        self.assertEqual(shortest_data, blender_data)
+
+        # 四角面と五角形を含むメッシュ
+        mesh_object = bpy.data.objects.get('body001')
+        verts = [
+            (0, 0, 1), (-2, 0, 0), (0, 0, -1), (2, 0, 0),      # 0-3: 対角線 0-2 の方が短い四角面
+            (5, 0, 2), (4, 0, 0), (5, 0, -2), (6, 0, 0),       # 4-7: 対角線 1-3 の方が短い四角面
+            (10, 0, 0), (11, 0, 0), (10, 0, 1),                # 8-10: 三角面
+            (20, 0, 0), (22, 0, 0), (23, 0, 2), (21, 0, 3), (19, 0, 2),  # 11-15: 五角形
+            (30, 0, 2), (29, 0, 0), (30, 0, -2), (31, 0, 0),   # 16-19: 対角線 1-3 の方が短い四角面
+        ]
+        faces = [(0, 1, 2, 3), (4, 5, 6, 7), (8, 9, 10), (11, 12, 13, 14, 15), (16, 17, 18, 19)]
+        material_indices = [0, 1, 0, 1, 0]
+        me = self.replace_with_test_mesh(mesh_object, verts, faces, material_indices)
+        me.calc_loop_triangles()
+        ngon_tris = [tuple(tri.vertices) for tri in me.loop_triangles if tri.polygon_index == 3]
+        self.assertEqual(len(ngon_tris), 3)
+
+        self.activate_object(mesh_object)
+        exported = {}
+        for method in ('SHORTEST_DIAGONAL', 'BLENDER'):
+            out_file = f'{self.output_dir}/{self._testMethodName}_quads_{method.lower()}.model'
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=out_file, quad_split_method=method, is_align_to_base_bone=False)
+            model_data, error = cm3d2converter.model_import.load_model_file(out_file)
+            self.assertIsNone(error)
+            # 頂点はUVで分割されないので、インデックスは元の頂点と同じ
+            self.assertEqual(len(model_data.vertex_data), len(verts))
+            # 読み込み時に面の向きが元に戻されるので、Blender のループ順になっている
+            exported[method] = [[tuple(tri) for tri in faces.tolist()] for faces in model_data.face_data]
+
+        # 材質ごとに面の順番で並ぶ
+        self.assertEqual(exported['SHORTEST_DIAGONAL'], [
+            [(0, 1, 2), (0, 2, 3), (8, 9, 10), (16, 17, 19), (17, 18, 19)],
+            [(4, 5, 7), (5, 6, 7), *ngon_tris],
+        ])
+        # Blender は四角面を常に 0-2 の対角線で分割する
+        self.assertEqual(exported['BLENDER'], [
+            [(0, 1, 2), (0, 2, 3), (8, 9, 10), (16, 17, 18), (16, 18, 19)],
+            [(4, 5, 6), (4, 6, 7), *ngon_tris],
+        ])
+
+    def test_evaluated_mesh_export(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        copied_file = f'{self.output_dir}/{self._testMethodName}_copied.model'
+        evaluated_file = f'{self.output_dir}/{self._testMethodName}_evaluated.model'
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=copied_file)
+
+        object_count = len(bpy.data.objects)
+        mesh_count = len(bpy.data.meshes)
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=evaluated_file, use_evaluated_mesh=True)
+        # 作業用のデータは作られない
+        self.assertEqual(len(bpy.data.objects), object_count)
+        self.assertEqual(len(bpy.data.meshes), mesh_count)
+
+        with open(copied_file, 'rb') as reader:
+            copied_data = reader.read()
+        with open(evaluated_file, 'rb') as reader:
+            evaluated_data = reader.read()
+        self.assertEqual(copied_data, evaluated_data)
+
+    def assertModelFileAlmostEqual(self, file1, file2, atol=1e-5, msg=None):
+        """2つのmodelファイルの頂点・ウェイト・面・モーフが同じか (座標と法線は誤差を許す)"""
+        msg = f" : {msg}" if not msg is None else ""
+        model_import = cm3d2converter.model_import
+        model1, error = model_import.load_model_file(file1)
+        self.assertIsNone(error, file1)
+        model2, error = model_import.load_model_file(file2)
+        self.assertIsNone(error, file2)
+
+        self.assertEqual([bone['name'] for bone in model1.local_bone_data], [bone['name'] for bone in model2.local_bone_data],
+                         "local_bone_data not equal" + msg)
+        self.assertEqual(len(model1.vertex_data), len(model2.vertex_data), "len(vertex_data) not equal" + msg)
+        for field in ('co', 'normal'):
+            np.testing.assert_allclose(model1.vertex_data[field], model2.vertex_data[field], atol=atol,
+                                       err_msg=f"vertex_data['{field}'] not equal" + msg)
+        self.assertEqual(model1.vertex_data['uv'].tobytes(), model2.vertex_data['uv'].tobytes(), "vertex_data['uv'] not equal" + msg)
+        self.assertEqual(model1.weight_data['index'].tobytes(), model2.weight_data['index'].tobytes(), "weight_data['index'] not equal" + msg)
+        np.testing.assert_allclose(model1.weight_data['value'], model2.weight_data['value'], atol=1e-6,
+                                   err_msg="weight_data['value'] not equal" + msg)
+        self.assertEqual(len(model1.face_data), len(model2.face_data), "len(face_data) not equal" + msg)
+        for i, (faces1, faces2) in enumerate(zip(model1.face_data, model2.face_data)):
+            self.assertEqual(faces1.tobytes(), faces2.tobytes(), f"face_data[{i}] not equal" + msg)
+
+        morphs1 = [item for item in model1.misc_data if item['type'] == 'morph']
+        morphs2 = [item for item in model2.misc_data if item['type'] == 'morph']
+        self.assertEqual([item['name'] for item in morphs1], [item['name'] for item in morphs2], "morph names not equal" + msg)
+        for morph1, morph2 in zip(morphs1, morphs2):
+            self.assertEqual(morph1['data']['index'].tobytes(), morph2['data']['index'].tobytes(),
+                             f"morph \"{morph1['name']}\" indices not equal" + msg)
+            for field in ('co', 'normal'):
+                np.testing.assert_allclose(morph1['data'][field], morph2['data'][field], atol=atol,
+                                           err_msg=f"morph \"{morph1['name']}\" {field} not equal" + msg)
+
+    def export_copied_and_evaluated(self, **kwargs):
+        """選択中のオブジェクトを、複製・適用・結合する方法と評価後のメッシュを読み込む方法の両方でエクスポートする"""
+        copied_file = f'{self.output_dir}/{self._testMethodName}_copied.model'
+        evaluated_file = f'{self.output_dir}/{self._testMethodName}_evaluated.model'
+        prefs = cm3d2converter.common.preferences()
+        prefs.is_apply_modifiers = True
+        try:
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=copied_file, **kwargs)
+            object_count = len(bpy.data.objects)
+            mesh_count = len(bpy.data.meshes)
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=evaluated_file, use_evaluated_mesh=True, **kwargs)
+        finally:
+            prefs.is_apply_modifiers = False
+        # 作業用のデータは作られない
+        self.assertEqual(len(bpy.data.objects), object_count)
+        self.assertEqual(len(bpy.data.meshes), mesh_count)
+        return copied_file, evaluated_file
+
+    def test_evaluated_mesh_export_join(self):
+        """複数オブジェクトの結合で、頂点グループと材質のインデックスが名前とマテリアルでまとめられるか"""
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        other_object = mesh_object.copy()
+        other_object.data = mesh_object.data.copy()
+        bpy.context.scene.collection.objects.link(other_object)
+        other_object.shape_key_clear()
+        other_object.vertex_groups.clear()
+        other_object.location = (0.5, 0.25, 0.0)
+        other_object.rotation_euler = (0.0, 0.0, 0.5)
+
+        # 頂点グループは 'Bip01' だけ、材質は逆の順番にする
+        verts = [(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1), (2, 0, 0), (2, 0, 1)]
+        me = self.replace_with_test_mesh(other_object, verts, [(0, 1, 2, 3), (1, 4, 5, 2)], [0, 1])
+        materials = list(me.materials)
+        me.materials[0], me.materials[1] = materials[1], materials[0]
+        self.assertNotEqual(mesh_object.vertex_groups.find('Bip01'), other_object.vertex_groups.find('Bip01'))
+
+        self.activate_object(mesh_object)
+        other_object.select_set(True)
+        copied_file, evaluated_file = self.export_copied_and_evaluated()
+        self.assertModelFileAlmostEqual(copied_file, evaluated_file)
+
+    def test_evaluated_mesh_export_shape_keys(self):
+        """モディファイアのあるオブジェクトのシェイプキーを、そのキーだけを表示した状態で読み込めるか"""
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        modifier = mesh_object.modifiers.new('Displace', 'DISPLACE')
+        modifier.direction = 'Z'
+        modifier.strength = 0.01
+        mesh_object.active_shape_key_index = 2
+        mesh_object.show_only_shape_key = False
+
+        self.activate_object(mesh_object)
+        copied_file, evaluated_file = self.export_copied_and_evaluated()
+        self.assertModelFileAlmostEqual(copied_file, evaluated_file)
+        # シェイプキーの表示は元に戻される
+        self.assertEqual(mesh_object.active_shape_key_index, 2)
+        self.assertFalse(mesh_object.show_only_shape_key)
+
+    def test_evaluated_mesh_export_split_sharp(self):
+        """シャープな辺での頂点の分割と法線の再計算が bpy.ops.mesh.split_sharp と同じになるか"""
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        me = mesh_object.data
+        is_sharp = np.zeros(len(me.edges), dtype=bool)
+        is_sharp[::7] = True
+        me.edges.foreach_set('use_edge_sharp', is_sharp)
+
+        self.activate_object(mesh_object)
+        copied_file, evaluated_file = self.export_copied_and_evaluated(is_split_sharp=True)
+        self.assertModelFileAlmostEqual(copied_file, evaluated_file, atol=1e-4)
+        model_data, error = cm3d2converter.model_import.load_model_file(evaluated_file)
+        self.assertIsNone(error)
+        self.assertGreater(len(model_data.vertex_data), len(me.vertices))
+
+    def test_evaluated_mesh_export_align(self):
+        """基点ボーンに合わせる変換 (calc_align_matrix) が bpy.ops.object.align_to_cm3d2_base_bone と同じになるか"""
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        mesh_object.location = (0.1, -0.2, 0.3)
+        mesh_object.rotation_euler = (0.2, 0.3, 0.4)
+        mesh_object.scale = (1.5, 1.5, 1.5)
+
+        self.activate_object(mesh_object)
+        copied_file, evaluated_file = self.export_copied_and_evaluated(is_align_to_base_bone=True)
+        self.assertModelFileAlmostEqual(copied_file, evaluated_file)
+
+    def test_evaluated_mesh_export_mirror(self):
+        """頂点グループをミラーするミラーモディファイアで、反対側の頂点グループが無くても同じウェイトになるか"""
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        mesh_object.shape_key_clear()
+        mesh_object.vertex_groups.clear()
+        verts = [(0.1, 0, 0), (1, 0, 0), (1, 0, 1), (0.1, 0, 1)]
+        self.replace_with_test_mesh(mesh_object, verts, [(0, 1, 2, 3)], [0])
+        mesh_object.vertex_groups.new(name='Bip01 * Thigh.L').add(range(len(verts)), 0.5, 'REPLACE')
+        modifier = mesh_object.modifiers.new('Mirror', 'MIRROR')
+        modifier.use_mirror_vertex_groups = True
+        modifier.use_mirror_merge = False
+
+        self.activate_object(mesh_object)
+        copied_file, evaluated_file = self.export_copied_and_evaluated()
+        self.assertModelFileAlmostEqual(copied_file, evaluated_file)
+        # 一時的に追加した頂点グループは残らない
+        self.assertEqual([vg.name for vg in mesh_object.vertex_groups], ['Bip01', 'Bip01 * Thigh.L'])
+
+        model_data, error = cm3d2converter.model_import.load_model_file(evaluated_file)
+        self.assertIsNone(error)
+        # ミラーされた側の頂点は反対側のボーンに割り当てられる
+        bone_names = [bone['name'] for bone in model_data.local_bone_data]
+        self.assertIn('Bip01 R Thigh', bone_names)
+        weight_data = model_data.weight_data
+        is_mirrored = ((weight_data['index'] == bone_names.index('Bip01 R Thigh')) & (weight_data['value'] > 0)).any(axis=1)
+        self.assertEqual(is_mirrored.sum(), len(verts))
+
+    def test_evaluated_mesh_data_restore(self):
+        """EvaluatedMeshData が一時的に変更したオブジェクトの状態を、失敗した場合も含めて元に戻すか"""
+        mesh_data_module = cm3d2converter.mesh_data
+        with self.assertRaises(TypeError):
+            mesh_data_module.MeshData()
+
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        mesh_object = bpy.data.objects.get('body001')
+        modifier = mesh_object.modifiers.new('Mirror', 'MIRROR')
+        modifier.use_mirror_vertex_groups = True
+        mesh_object.show_only_shape_key = False
+        mesh_object.active_shape_key_index = 0
+        vertex_group_names = [vg.name for vg in mesh_object.vertex_groups]
+
+        mesh_data = mesh_data_module.EvaluatedMeshData(bpy.context, [mesh_object], mesh_object, apply_modifiers=True)
+        self.assertEqual([vg.name for vg in mesh_object.vertex_groups], vertex_group_names)
+        out = np.empty((mesh_data.vertex_count, 3), dtype=float)
+        mesh_data.shape_key_cos(0, out)
+        # シェイプキーの表示は free() まで変更したまま
+        self.assertTrue(mesh_object.show_only_shape_key)
+        mesh_data.free()
+        self.assertFalse(mesh_object.show_only_shape_key)
+        self.assertEqual(mesh_object.active_shape_key_index, 0)
+
+        # シェイプキーの読み込みに失敗した場合は、その場で元に戻す
+        class FailingMeshData(mesh_data_module.EvaluatedMeshData):
+            is_failing = False
+            def transform(self, index, cos, vertex_normals, loop_normals):
+                if self.is_failing:
+                    raise cm3d2converter.common.CM3D2ExportError("test")
+                return super().transform(index, cos, vertex_normals, loop_normals)
+        mesh_data = FailingMeshData(bpy.context, [mesh_object], mesh_object, apply_modifiers=True)
+        mesh_data.is_failing = True
+        with self.assertRaises(cm3d2converter.common.CM3D2ExportError):
+            mesh_data.shape_key_cos(0, out)
+        self.assertFalse(mesh_object.show_only_shape_key)
+        self.assertEqual(mesh_object.active_shape_key_index, 0)
+
+    def test_incremental_export(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        full_file = f'{self.output_dir}/{self._testMethodName}_full.model'
+        incremental_file = f'{self.output_dir}/{self._testMethodName}_incremental.model'
+        cm3d2converter.export_cache.clear()
+
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=incremental_file, is_incremental=True)
+        section_cache = cm3d2converter.export_cache.get_section_cache(incremental_file)
+        self.assertEqual(section_cache.reused_count, 0)
+
+        # シェイプキーを1つだけ変更すると、そのモーフ以外は前回のものが使われる
+        me: bpy.types.Mesh = bpy.data.objects.get('body001').data
+        shape_key = me.shape_keys.key_blocks[1]
+        shape_key.data[0].co.x += 0.01
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=incremental_file, is_incremental=True)
+        self.assertEqual(section_cache.reused_count, section_cache.section_count - 1)
+
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=full_file)
+        with open(full_file, 'rb') as reader:
+            full_data = reader.read()
+        with open(incremental_file, 'rb') as reader:
+            incremental_data = reader.read()
+        self.assertEqual(full_data, incremental_data)
+
+    def test_batch_export(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        single_file = f'{self.output_dir}/{self._testMethodName}_single.model'
+        batch_dir = Path(self.output_dir) / self._testMethodName
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        batch_dir.mkdir(parents=True)
+
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=single_file, use_evaluated_mesh=True)
+
+        # body001.001 は body001 と同じファイル名になるので書き出されず、
+        # body003 はウェイトが無いので失敗する (他のオブジェクトは書き出される)
+        mesh_object = bpy.data.objects.get('body001')
+        objects = [mesh_object]
+        for name in ('body001.001', 'body002', 'body003'):
+            copied_object = mesh_object.copy()
+            copied_object.data = mesh_object.data.copy()
+            copied_object.name = name
+            bpy.context.scene.collection.objects.link(copied_object)
+            objects.append(copied_object)
+        self.assertEqual([ob.name for ob in objects], ['body001', 'body001.001', 'body002', 'body003'])
+        objects[3].vertex_groups.clear()
+        bpy.ops.object.select_all(action='DESELECT')
+        for ob in objects:
+            ob.select_set(True)
+        self.activate_object(mesh_object)
+
+        ret = bpy.ops.export_mesh.batch_export_cm3d2_model(directory=str(batch_dir), thread_count=2)
+        self.assertEqual(ret, {'FINISHED'})
+        self.assertEqual(sorted(path.name for path in batch_dir.glob('*.model')), ['body001.model', 'body002.model'])
+        with open(single_file, 'rb') as reader:
+            single_data = reader.read()
+        with open(batch_dir / 'body001.model', 'rb') as reader:
+            batch_data = reader.read()
+        self.assertEqual(single_data, batch_data)
+        model_data, error = cm3d2converter.model_import.load_model_file(str(batch_dir / 'body002.model'))
+        self.assertIsNone(error)
+        self.assertEqual(model_data.name, 'body002')
+        # 選択状態は元に戻される
+        self.assertEqual(bpy.context.active_object, mesh_object)
+        self.assertTrue(all(ob.select_get() for ob in objects))
+
+    def test_write_behind_export(self):
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
+        direct_file = f'{self.output_dir}/{self._testMethodName}_direct.model'
+        write_behind_file = f'{self.output_dir}/{self._testMethodName}_write_behind.model'
+        prefs = cm3d2converter.common.preferences()
+
+        bpy.ops.export_mesh.export_cm3d2_model(filepath=direct_file)
+        prefs.is_write_behind = True
+        try:
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=write_behind_file)
+        finally:
+            prefs.is_write_behind = False
+        with open(direct_file, 'rb') as reader:
+            direct_data = reader.read()
+        with open(write_behind_file, 'rb') as reader:
+            write_behind_data = reader.read()
+        self.assertEqual(direct_data, write_behind_data)
+
+    def test_compact_bone_data(self):
+        in_file = f'{self.resources_dir}/body001.model'
+        legacy_file = f'{self.output_dir}/{self._testMethodName}_legacy.model'
+        compact_file = f'{self.output_dir}/{self._testMethodName}_compact.model'
+        bone_data_property = cm3d2converter.bone_data_property
+        prefs = cm3d2converter.common.preferences()
+
+        bpy.ops.import_mesh.import_cm3d2_model(filepath=in_file)
+        legacy_ob = bpy.context.object
+        self.assertIn("BoneData:0", legacy_ob)
+        legacy_bone_data = bone_data_property.read_bone_data(legacy_ob)
+        legacy_local_bone_data = bone_data_property.read_local_bone_data(legacy_ob)
+
+        prefs.is_compact_bone_data = True
+        try:
+            # エクスポートでは従来形式のプロパティを変更しない
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=legacy_file, bone_info_mode='OBJECT_PROPERTY')
+            self.assertIn("BoneData:0", legacy_ob)
+            self.assertNotIn(bone_data_property.BONE_DATA_KEY, legacy_ob)
+
+            bpy.ops.import_mesh.import_cm3d2_model(filepath=in_file)
+            compact_ob = bpy.context.object
+            bpy.ops.export_mesh.export_cm3d2_model(filepath=compact_file, bone_info_mode='OBJECT_PROPERTY')
+        finally:
+            prefs.is_compact_bone_data = False
+        self.assertNotIn("BoneData:0", compact_ob)
+        # 配列は float32 / int32 のバイト列で保存される
+        packed = compact_ob[bone_data_property.BONE_DATA_KEY]
+        self.assertIsInstance(packed['co'], bytes)
+        self.assertEqual(len(packed['co']), len(legacy_bone_data) * 3 * 4)
+        self.assertEqual(len(packed['parent_index']), len(legacy_bone_data) * 4)
+        self.assertEqual(bone_data_property.read_bone_data(compact_ob), legacy_bone_data)
+        self.assertEqual(bone_data_property.read_local_bone_data(compact_ob), legacy_local_bone_data)
+
+        with open(legacy_file, 'rb') as reader:
+            legacy_data = reader.read()
+        with open(compact_file, 'rb') as reader:
+            compact_data = reader.read()
+        self.assertEqual(legacy_data, compact_data)
+
+        # 従来形式からの変換は明示的に行う
+        bpy.context.view_layer.objects.active = legacy_ob
+        bpy.ops.object.convert_object_bone_data_property()
+        self.assertNotIn("BoneData:0", legacy_ob)
+        self.assertIn(bone_data_property.BONE_DATA_KEY, legacy_ob)
+        self.assertEqual(bone_data_property.read_bone_data(legacy_ob), legacy_bone_data)
+        self.assertEqual(bone_data_property.read_local_bone_data(legacy_ob), legacy_local_bone_data)
+
     def test_model_recursive(self):
         bpy.ops.import_mesh.import_cm3d2_model(filepath=f'{self.resources_dir}/body001.model')
 